@@ -1,14 +1,45 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types
+import signal
+import time
+from aiohttp import web
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from db.database import get_user, create_user, update_subscription, get_active_users
-from bot.paypalych_api import create_payment_link, check_payment_status
-from vpn.vpn_manager import generate_v2ray_config, create_v2ray_user, remove_v2ray_user
+from db.fsm_storage import SQLiteStorage
+from db.async_database import (
+    get_user, expire_users, apply_payment, get_payment, mark_payment_provisioned,
+    get_unprovisioned_payments, expire_pending_payments, prune_payments, prune_outbox, unblock_chat,
+    get_telegram_file_id, save_telegram_file_id, get_user_traffic, prune_jobs,
+    get_job_stats, get_outbox_stats, init_db, suspend_user, get_due_suspensions, lift_suspension,
+    get_suspension
+)
+from bot.paypalych_api import create_payment_link, check_payment_status, refresh_pending_payments, close_client
+from bot.payment_webhook import setup_payment_webhook
+from bot.webhook import run_webhook
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from vpn.vpn_manager import (
+    generate_v2ray_config, generate_v2ray_qr, create_v2ray_user, remove_v2ray_user,
+    user_endpoint, maintain_nodes, get_traffic_collector, set_mutation_fence, get_node_pool
+)
+from vpn.traffic import format_bytes
+from vpn.access_log import (
+    AccessLogMonitor, ACCESS_LOG_ENABLED, DEVICE_LIMIT, DEVICE_WINDOW_SECONDS, DEVICE_LIMIT_ACTION,
+    DEVICE_SUSPEND_MINUTES
+)
+from vpn.artifacts import artifact_key, file_id_cache
+from bot.expiry import ExpiryScheduler
+from bot.notifier import notifier
+from bot.jobs import job_queue
+from bot.leader import LeaderElector, LEADER_ELECTION
+from bot.handlers import router as handlers_router
+from bot import metrics
+from bot.throttling import setup_throttling
+from db.cache import user_cache
 from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
@@ -18,6 +49,25 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 PAYPALYCH_API_KEY = os.getenv("PAYPALYCH_API_KEY")
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Адрес Bot API (например, локальный сервер Bot API или заглушка bot.fake_telegram)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# HTTP-сервер для уведомлений об оплате от PayPalych
+PAYMENT_WEBHOOK_ENABLED = os.getenv("PAYMENT_WEBHOOK_ENABLED", "false").lower() == "true"
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
+WEB_SERVER_PORT = int(os.getenv("WEB_SERVER_PORT", "8080"))
+# Время жизни неоплаченного платежа и срок хранения завершенных записей
+PAYMENT_PENDING_TTL_HOURS = int(os.getenv("PAYMENT_PENDING_TTL_HOURS", "24"))
+PAYMENTS_RETENTION_DAYS = int(os.getenv("PAYMENTS_RETENTION_DAYS", "90"))
+# Интервал пакетной сверки ожидающих платежей с PayPalych (секунды)
+PAYMENT_REFRESH_INTERVAL = float(os.getenv("PAYMENT_REFRESH_INTERVAL", "60"))
+# Срок хранения отправленных уведомлений
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# Срок хранения выполненных фоновых задач
+JOBS_RETENTION_DAYS = int(os.getenv("JOBS_RETENTION_DAYS", "30"))
+# Интервал проверки узлов V2Ray и переноса пользователей (секунды)
+NODE_CHECK_INTERVAL = float(os.getenv("V2RAY_NODE_CHECK_INTERVAL", "60"))
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -28,9 +78,17 @@ class BuyStates(StatesGroup):
     waiting_for_payment = State()
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+# Несколько процессов (LEADER_ELECTION) не должны работать с копиями состояний FSM в памяти
+storage = SQLiteStorage(shared=LEADER_ELECTION)
 dp = Dispatcher(storage=storage)
+dp.include_router(handlers_router)
+metrics.setup_metrics(dp)
+# Ограничение частоты сообщений (администратор без ограничений)
+throttling = setup_throttling(dp, exempt=(ADMIN_ID,))
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -39,14 +97,17 @@ async def cmd_start(message: types.Message):
         "Доступные команды:\n"
         "/buy - купить подписку\n"
         "/status - проверить статус подписки\n"
+        "/config - получить файл конфигурации и QR-код\n"
         "/renew - продлить подписку"
     )
+    # Пользователь снова пишет боту - рассылки ему можно возобновить
+    await unblock_chat(message.from_user.id)
     await message.answer(welcome_text)
 
 @dp.message(Command("buy"))
 async def cmd_buy(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    existing_user = get_user(user_id)
+    existing_user = await get_user(user_id)
     
     if existing_user and existing_user['end_date'] and datetime.now() < datetime.fromisoformat(existing_user['end_date']):
         await message.answer("У вас уже есть активная подписка!")
@@ -85,7 +146,7 @@ async def cmd_buy(message: types.Message, state: FSMContext):
 @dp.message(Command("status"))
 async def cmd_status(message: types.Message):
     user_id = message.from_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     
     if not user:
         await message.answer("Вы не зарегистрированы в системе. Купите подписку сначала.")
@@ -98,16 +159,42 @@ async def cmd_status(message: types.Message):
             days = remaining.days
             hours, remainder = divmod(remaining.seconds, 3600)
             minutes, _ = divmod(remainder, 60)
-            await message.answer(f"Ваша подписка активна. Осталось: {days} дней {hours} часов {minutes} минут")
+            uplink, downlink = await get_user_traffic(user_id, time.time() - 30 * 86400)
+            await message.answer(
+                f"Ваша подписка активна. Осталось: {days} дней {hours} часов {minutes} минут\n"
+                f"Трафик за 30 дней: отправлено {format_bytes(uplink)}, получено {format_bytes(downlink)}"
+            )
         else:
             await message.answer("Ваша подписка истекла.")
     else:
         await message.answer("У вас нет активной подписки.")
 
+@dp.message(Command("config"))
+async def cmd_config(message: types.Message):
+    user_id = message.from_user.id
+    user = await get_user(user_id)
+    
+    if not user or not user['end_date'] or datetime.now() >= datetime.fromisoformat(user['end_date']):
+        await message.answer("У вас нет активной подписки. Купить: /buy")
+        return
+    if not user['v2ray_id']:
+        await message.answer("Конфигурация еще не готова. Попробуйте позже.")
+        return
+    suspended_until = await get_suspension(user_id)
+    if suspended_until is not None:
+        await message.answer(
+            "Доступ приостановлен из-за превышения числа устройств до "
+            f"{datetime.fromtimestamp(suspended_until).strftime('%H:%M')}. После этого придет уведомление."
+        )
+        return
+
+    await send_vpn_file(user_id, "config", "Ваша конфигурация VPN. Импортируйте файл в клиент v2ray.")
+    await send_vpn_file(user_id, "qr", "QR-код для подключения.")
+
 @dp.message(Command("renew"))
 async def cmd_renew(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     
     if not user:
         await message.answer("Вы не зарегистрированы в системе. Купите подписку сначала.")
@@ -143,7 +230,8 @@ async def cmd_renew(message: types.Message, state: FSMContext):
     else:
         await message.answer("Ошибка при создании платежа. Попробуйте позже.")
 
-@dp.message(BuyStates.waiting_for_payment)
+# Команды (в том числе из bot/handlers.py) не считаются ответом на ожидание оплаты
+@dp.message(BuyStates.waiting_for_payment, ~F.text.startswith("/"))
 async def handle_payment_check(message: types.Message, state: FSMContext):
     data = await state.get_data()
     payment_id = data.get('payment_id')
@@ -155,64 +243,403 @@ async def handle_payment_check(message: types.Message, state: FSMContext):
     status = await check_payment_status(payment_id)
     
     if status == 'completed':
-        user_id = message.from_user.id
-        # Обновляем или создаем пользователя
-        user = get_user(user_id)
-        if user:
-            # Продлеваем подписку
-            if user['end_date']:
-                current_end = datetime.fromisoformat(user['end_date'])
-                new_end = current_end + timedelta(days=30)
-            else:
-                new_end = datetime.now() + timedelta(days=30)
-            update_subscription(user_id, new_end.isoformat())
+        # Выдача доступа выполняется в фоне, здесь только постановка задачи
+        if await provision_payment(payment_id):
+            await message.answer("Оплата получена! Конфигурация VPN будет отправлена в течение минуты.")
         else:
-            # Создаем нового пользователя
-            create_user(user_id, (datetime.now() + timedelta(days=30)).isoformat())
-        
-        # Создаем пользователя в v2ray
-        await create_v2ray_user(user_id)
-        
-        # Отправляем конфигурацию
-        config = generate_v2ray_config(user_id)
-        await message.answer_document(
-            types.FSInputFile(config['file_path']),
-            caption="Ваша конфигурация VPN. Сохраните файл и импортируйте в клиент v2ray."
-        )
-        
-        await message.answer("Подписка успешно оформлена!")
+            # Платеж уже обработан (например, по уведомлению от PayPalych)
+            await message.answer("Платеж уже обработан, подписка активна. Проверить: /status")
         await state.clear()
     elif status == 'pending':
         await message.answer("Платеж еще не завершен. Пожалуйста, завершите оплату и повторите попытку.")
     else:
         await message.answer("Платеж не найден или не был завершен. Попробуйте снова.")
 
-async def check_subscriptions():
-    """Фоновая задача для проверки истекших подписок"""
-    users = get_active_users()
-    for user in users:
-        if user['end_date']:
-            end_date = datetime.fromisoformat(user['end_date'])
-            if datetime.now() >= end_date:
-                # Удаляем пользователя из v2ray
-                await remove_v2ray_user(user['user_id'])
-                
-                # Обновляем статус в БД
-                update_subscription(user['user_id'], None)
-                
-                # Уведомляем пользователя
-                try:
-                    await bot.send_message(
-                        user['user_id'],
-                        "Ваша подписка VPN истекла. Для продолжения использования, пожалуйста, продлите подписку командой /buy"
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось уведомить пользователя {user['user_id']}: {e}")
+async def provision_payment(payment_id: str) -> bool:
+    """
+    Применяет оплаченный платеж и ставит в очередь задачу выдачи доступа.
+    Возвращает False, если платеж уже обработан.
+    """
+    # Продление подписки, отметка о применении платежа и постановка задачи
+    # provision - одна транзакция, поэтому повторные уведомления и сообщения
+    # не продлевают подписку дважды, а сбой не оставляет оплату без выдачи доступа
+    applied = await apply_payment(payment_id)
+    if applied:
+        user_id, new_end = applied
+        expiry_scheduler.schedule(user_id, new_end)
+        job_queue.wake()
+        return True
+    
+    payment = await get_payment(payment_id)
+    if not payment or payment['status'] != 'completed' or payment['provisioned_at']:
+        return False
+    # Подписка уже продлена, но доступ еще не выдан: задача уже в очереди
+    # (повторная постановка ничего не изменит) или платеж применен до появления очереди
+    await job_queue.enqueue("provision", f"provision:{payment_id}", {"payment_id": payment_id})
+    return True
+
+async def enqueue_paid_payment(payment_id: str):
+    """
+    Ставит применение оплаченного платежа в очередь задач (уведомление PayPalych):
+    задачу выполняет ведущий процесс, а при ошибке она повторяется
+    """
+    await job_queue.enqueue("payment", f"payment:{payment_id}", {"payment_id": payment_id})
 
-async def main():
+async def payment_job(payload: dict):
+    """Задача payment: применение платежа, подтвержденного уведомлением"""
+    await provision_payment(payload['payment_id'])
+
+async def provision_job(payload: dict):
+    """
+    Задача provision: добавляет пользователя в v2ray и отправляет конфигурацию.
+    Безопасна при повторном выполнении: клиент V2Ray добавляется идемпотентно,
+    а уже выданный платеж пропускается.
+    """
+    payment_id = payload['payment_id']
+    payment = await get_payment(payment_id)
+    if not payment or payment['provisioned_at']:
+        return
+    user_id = payment['user_id']
+    
+    if await get_suspension(user_id) is not None:
+        # Продление во время блокировки за превышение числа устройств: клиент
+        # вернет задача restore после снятия блокировки
+        await notifier.enqueue(
+            [user_id],
+            "Оплата получена, подписка продлена. Доступ временно приостановлен за превышение "
+            "числа устройств и будет восстановлен после окончания блокировки.",
+            kind="device_limit"
+        )
+        await mark_payment_provisioned(payment_id)
+        return
+    
+    # Создаем пользователя в v2ray (при ошибке задача будет повторена)
+    await create_v2ray_user(user_id)
+    
+    try:
+        # Отправляем конфигурацию
+        await send_vpn_file(
+            user_id, "config",
+            "Ваша конфигурация VPN. Сохраните файл и импортируйте в клиент v2ray."
+        )
+        await bot.send_message(user_id, "Подписка успешно оформлена!")
+    except TelegramForbiddenError:
+        # Пользователь заблокировал бота: доступ выдан, конфигурацию он получит по /config
+        logger.warning(f"Пользователь {user_id} заблокировал бота, конфигурация не отправлена")
+    await mark_payment_provisioned(payment_id)
+    await dp.fsm.get_context(bot, chat_id=user_id, user_id=user_id).clear()
+
+async def restore_job(payload: dict):
+    """
+    Задача restore: возвращает клиента V2Ray после снятия блокировки за превышение
+    числа устройств. Выдается новый UUID: прежние копии конфигурации не работают.
+    """
+    user_id = payload['user_id']
+    if await get_suspension(user_id) is not None:
+        # Пользователь снова заблокирован
+        return
+    user = await get_user(user_id)
+    if not user or not user['end_date'] or datetime.now() >= datetime.fromisoformat(user['end_date']):
+        return
+    await create_v2ray_user(user_id)
+    await notifier.enqueue(
+        [user_id],
+        "Доступ к VPN восстановлен. Ключ подключения заменен: получите новую конфигурацию командой /config",
+        kind="device_limit"
+    )
+
+async def notify_dead_job(job_id: int, kind: str, payload: dict, error: str):
+    """Сообщает администратору о задаче, исчерпавшей попытки"""
+    await notifier.enqueue(
+        [ADMIN_ID],
+        f"Задача {job_id} ({kind}, {payload}) не выполнена: {error}\nПовторить: /retry {job_id}",
+        kind="admin"
+    )
+
+async def send_vpn_file(user_id: int, kind: str, caption: str):
+    """
+    Отправляет пользователю файл подключения ('config' или 'qr').
+    Уже загруженный в Telegram файл отправляется по file_id без повторной загрузки.
+    """
+    user = await get_user(user_id)
+    key = artifact_key(kind, user['v2ray_id'], *user_endpoint(user))
+    send = bot.send_photo if kind == "qr" else bot.send_document
+    
+    file_id = file_id_cache.get(key, None)
+    if file_id is None:
+        file_id = await get_telegram_file_id(key)
+        if file_id:
+            file_id_cache.set(key, file_id)
+    if file_id:
+        try:
+            await send(user_id, file_id, caption=caption)
+            return
+        except TelegramBadRequest as e:
+            # file_id больше не действителен - загружаем файл заново
+            logger.warning(f"file_id для {key} не принят Telegram: {e}")
+            file_id_cache.invalidate(key)
+            await save_telegram_file_id(key, user['v2ray_id'], None)
+    
+    generate = generate_v2ray_qr if kind == "qr" else generate_v2ray_config
+    artifact = await asyncio.to_thread(generate, user_id)
+    sent = await send(user_id, types.BufferedInputFile(artifact['data'], artifact['filename']), caption=caption)
+    file_id = sent.photo[-1].file_id if kind == "qr" else sent.document.file_id
+    file_id_cache.set(key, file_id)
+    await save_telegram_file_id(key, artifact['uuid'], file_id)
+
+async def resume_unprovisioned_payments():
+    """
+    Ставит в очередь выдачу доступа по оплаченным платежам, обработка которых
+    прервалась (например, примененным до появления очереди задач)
+    """
+    payments = await get_unprovisioned_payments()
+    for payment in payments:
+        if await provision_payment(payment['payment_id']):
+            logger.info(f"Возобновлена выдача доступа по платежу {payment['payment_id']}")
+
+async def payments_maintenance():
+    """Фоновая задача: просрочка неоплаченных платежей и очистка старых записей"""
+    while True:
+        try:
+            now = datetime.now()
+            expired = await expire_pending_payments((now - timedelta(hours=PAYMENT_PENDING_TTL_HOURS)).isoformat())
+            pruned = await prune_payments((now - timedelta(days=PAYMENTS_RETENTION_DAYS)).isoformat())
+            if expired or pruned:
+                logger.info(f"Платежи: просрочено {expired}, удалено старых записей {pruned}")
+            await prune_outbox(time.time() - OUTBOX_RETENTION_DAYS * 86400)
+            await prune_jobs(time.time() - JOBS_RETENTION_DAYS * 86400)
+        except Exception as e:
+            logger.error(f"Ошибка при обслуживании журнала платежей: {e}", exc_info=True)
+        await asyncio.sleep(3600)
+
+async def expire_subscriptions(user_ids):
+    """Отключает пользователей, чья подписка истекла (вызывается планировщиком)"""
+    expired = await expire_users(user_ids)
+    
+    # Удаляем пользователей из v2ray (изменения объединяются в один пакет)
+    await asyncio.gather(*(remove_v2ray_user(user_id) for user_id in expired))
+    
+    # Уведомления отправляются через очередь с учетом лимитов Telegram
+    await notifier.enqueue(
+        expired,
+        "Ваша подписка VPN истекла. Для продолжения использования, пожалуйста, продлите подписку командой /buy",
+        kind="expiry"
+    )
+
+async def reconcile_pending_payments():
+    """Фоновая задача: пакетная сверка ожидающих платежей (если уведомление не пришло)"""
+    while True:
+        await asyncio.sleep(PAYMENT_REFRESH_INTERVAL)
+        try:
+            for payment_id in await refresh_pending_payments():
+                await provision_payment(payment_id)
+        except Exception as e:
+            logger.error(f"Ошибка при сверке платежей с PayPalych: {e}")
+
+async def nodes_maintenance():
+    """Фоновая задача: проверка узлов V2Ray и перенос пользователей между ними"""
+    while True:
+        await asyncio.sleep(NODE_CHECK_INTERVAL)
+        try:
+            moved = await maintain_nodes()
+            if moved:
+                await notifier.enqueue(
+                    moved,
+                    "Ваш VPN-сервер изменен. Получите новую конфигурацию командой /config",
+                    kind="node_move"
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при обслуживании узлов V2Ray: {e}", exc_info=True)
+
+expiry_scheduler = ExpiryScheduler(expire_subscriptions)
+
+async def handle_device_violation(user_id: int, addresses: list):
+    """Подписка используется на большем числе устройств, чем DEVICE_LIMIT (вызывается AccessLogMonitor)"""
+    user = await get_user(user_id)
+    if not user or not user['end_date'] or datetime.now() >= datetime.fromisoformat(user['end_date']):
+        return
+    text = (
+        f"Пользователь {user_id}: {len(addresses)} IP-адресов за {DEVICE_WINDOW_SECONDS / 60:g} мин. "
+        f"(лимит {DEVICE_LIMIT}): {', '.join(addresses[:10])}"
+    )
+    if DEVICE_LIMIT_ACTION == "suspend" and await suspend_user(
+        user_id, len(addresses), time.time() + DEVICE_SUSPEND_MINUTES * 60
+    ):
+        await remove_v2ray_user(user_id)
+        text += f"\nДоступ приостановлен на {DEVICE_SUSPEND_MINUTES:g} мин."
+        await notifier.enqueue(
+            [user_id],
+            f"Доступ к VPN приостановлен на {DEVICE_SUSPEND_MINUTES:g} мин.: подписка используется "
+            f"одновременно на слишком большом числе устройств (не более {DEVICE_LIMIT}). "
+            "После этого ключ подключения будет заменен.",
+            kind="device_limit"
+        )
+    await notifier.enqueue([ADMIN_ID], text, kind="admin")
+
+access_monitor = AccessLogMonitor(handle_device_violation) if ACCESS_LOG_ENABLED else None
+
+async def restore_suspended_users():
+    """Фоновая задача: снятие истекших блокировок (клиента возвращает задача restore)"""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            lifted = [user_id for user_id in await get_due_suspensions(time.time())
+                      if await lift_suspension(user_id)]
+            if lifted:
+                job_queue.wake()
+        except Exception as e:
+            logger.error(f"Ошибка при снятии блокировок за превышение числа устройств: {e}", exc_info=True)
+
+# Размеры очередей для /metrics (собираются при запросе)
+metrics.gauge("bot_jobs", "Фоновые задачи по статусам", get_job_stats, ("status",))
+metrics.gauge("bot_outbox", "Уведомления по статусам", get_outbox_stats, ("status",))
+metrics.gauge(
+    "v2ray_pending_mutations", "Изменения конфигурации V2Ray в очереди",
+    lambda: get_node_pool().pending_mutations(), ("node",)
+)
+metrics.gauge("bot_expiry_scheduled", "Сроки окончания подписок в планировщике", lambda: expiry_scheduler.pending)
+metrics.gauge("bot_throttle_buckets", "Корзины ограничения частоты в памяти", lambda: throttling.size)
+metrics.gauge("db_user_cache_entries", "Записи в кэше пользователей", lambda: user_cache.stats()['size'])
+
+def create_web_app() -> web.Application:
+    """Создает приложение aiohttp с обработчиками уведомлений"""
+    app = web.Application()
+    if PAYMENT_WEBHOOK_ENABLED:
+        setup_payment_webhook(app, enqueue_paid_payment)
+    return app
+
+async def start_web_server(app: web.Application):
+    """Запускает HTTP-сервер (уведомления об оплате, webhook Telegram)"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # Несколько процессов бота (LEADER_ELECTION) принимают запросы на одном порту
+    await web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT, reuse_port=LEADER_ELECTION or None).start()
+    logger.info(f"HTTP-сервер запущен на {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
+    return runner
+
+# Фоновые задачи ведущего процесса
+leader_tasks = []
+
+async def start_leader_duties():
+    """
+    Запускает задачи, которые должны выполняться в единственном экземпляре:
+    V2Ray, планировщик подписок, очереди задач и уведомлений, сбор трафика,
+    анализ журнала доступа
+    """
     from vpn.vpn_manager import initialize_v2ray_server
     await initialize_v2ray_server()
-    await dp.start_polling(bot)
+    expiry_scheduler.start()
+    notifier.start(bot)
+    job_queue.start()
+    traffic_collector = get_traffic_collector()
+    if traffic_collector is not None:
+        traffic_collector.start()
+    await resume_unprovisioned_payments()
+    leader_tasks.extend([
+        asyncio.create_task(payments_maintenance()),
+        asyncio.create_task(reconcile_pending_payments()),
+        asyncio.create_task(nodes_maintenance()),
+        asyncio.create_task(restore_suspended_users())
+    ])
+    if access_monitor is not None:
+        access_monitor.start()
+
+async def stop_leader_duties():
+    """Останавливает задачи ведущего (остановка процесса или потеря аренды)"""
+    for task in leader_tasks:
+        task.cancel()
+    await asyncio.gather(*leader_tasks, return_exceptions=True)
+    leader_tasks.clear()
+    await expiry_scheduler.stop()
+    await job_queue.stop()
+    await notifier.stop()
+    traffic_collector = get_traffic_collector()
+    if traffic_collector is not None:
+        await traffic_collector.stop()
+    if access_monitor is not None:
+        await access_monitor.stop()
+
+polling_task = None
+
+async def start_leader_polling():
+    """В режиме polling обновления может получать только один процесс - ведущий"""
+    global polling_task
+    polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+
+async def stop_leader_polling():
+    global polling_task
+    if polling_task is None:
+        return
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        # Опрос еще не запущен или уже завершился
+        polling_task.cancel()
+    await asyncio.gather(polling_task, return_exceptions=True)
+    polling_task = None
+
+def install_shutdown_handlers() -> asyncio.Event:
+    """
+    SIGTERM/SIGINT завершают ожидание в main(), после чего выполняется штатная остановка
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def main():
+    # Схема базы данных обновляется до запуска обработчиков и фоновых задач
+    await init_db()
+    stop = install_shutdown_handlers()
+    job_queue.register("payment", payment_job)
+    job_queue.register("provision", provision_job)
+    job_queue.register("restore", restore_job)
+    job_queue.on_dead(notify_dead_job)
+    
+    elector = None
+    if LEADER_ELECTION:
+        # Кэши в памяти процесса не узнают об изменениях, сделанных другими процессами
+        user_cache.disable()
+        file_id_cache.disable()
+        # Узлы нужны каждому процессу (адрес для /config), а не только ведущему
+        await get_node_pool().load()
+        # Задачи ведущего запускаются при получении аренды, изменения V2Ray проверяют fencing token
+        elector = LeaderElector()
+        set_mutation_fence(elector.fence)
+        elector.on_elected(start_leader_duties)
+        elector.on_demoted(stop_leader_duties)
+        if BOT_MODE != "webhook":
+            elector.on_elected(start_leader_polling)
+            elector.on_demoted(stop_leader_polling)
+        elector.start()
+    else:
+        await start_leader_duties()
+    
+    metrics_runner = await metrics.start_metrics_server() if metrics.METRICS_ENABLED else None
+    app = create_web_app()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, app, start_web_server, stop=stop)
+        else:
+            runner = await start_web_server(app) if PAYMENT_WEBHOOK_ENABLED else None
+            try:
+                if elector is not None:
+                    await stop.wait()
+                else:
+                    # aiogram сам обрабатывает SIGTERM/SIGINT и завершает опрос
+                    await dp.start_polling(bot)
+            finally:
+                if runner is not None:
+                    await runner.cleanup()
+    finally:
+        if elector is not None:
+            await elector.stop()
+        else:
+            await stop_leader_duties()
+        await close_client()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,137 @@
+"""
+Планировщик окончания подписок.
+
+Держит в памяти min-heap ближайших сроков окончания (в пределах горизонта),
+спит до ближайшего срока и отключает истекших пользователей пакетами.
+Работа пропорциональна числу истекающих подписок, а не общему числу пользователей.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from datetime import datetime
+from db.async_database import get_users_expiring_before
+
+logger = logging.getLogger(__name__)
+
+# Горизонт, на который сроки загружаются из базы (секунды)
+EXPIRY_HORIZON = float(os.getenv("EXPIRY_HORIZON", "3600"))
+# Максимальный интервал сна, чтобы переживать переводы системных часов (секунды)
+EXPIRY_MAX_SLEEP = float(os.getenv("EXPIRY_MAX_SLEEP", "30"))
+# Максимальный размер пакета отключений
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "500"))
+
+
+def _to_timestamp(end_date) -> float:
+    if isinstance(end_date, (int, float)):
+        return float(end_date)
+    if isinstance(end_date, datetime):
+        return end_date.timestamp()
+    return datetime.fromisoformat(end_date).timestamp()
+
+
+class ExpiryScheduler:
+    """
+    on_expire(user_ids) вызывается с пакетом пользователей, срок которых наступил
+    """
+
+    def __init__(self, on_expire, horizon: float = EXPIRY_HORIZON,
+                 batch_size: int = EXPIRY_BATCH_SIZE):
+        self.on_expire = on_expire
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self._heap = []
+        # Актуальный срок для каждого пользователя; устаревшие записи heap пропускаются
+        self._deadlines = {}
+        self._loaded_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        """
+        Число отслеживаемых сроков окончания
+        """
+        return len(self._deadlines)
+
+    def schedule(self, user_id: int, end_date):
+        """
+        Учитывает новую подписку или продление. end_date=None снимает пользователя с учета.
+        """
+        if end_date is None:
+            self._deadlines.pop(user_id, None)
+            return
+        deadline = _to_timestamp(end_date)
+        if deadline > self._loaded_until:
+            # Срок за горизонтом: будет загружен из базы при следующем обновлении окна
+            self._deadlines.pop(user_id, None)
+            return
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._heap, (deadline, user_id))
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _load_window(self):
+        """
+        Загружает из базы сроки, наступающие до конца следующего окна
+        """
+        until = time.time() + self.horizon
+        rows = await get_users_expiring_before(until)
+        for user_id, end_date in rows:
+            deadline = _to_timestamp(end_date)
+            if self._deadlines.get(user_id) != deadline:
+                self._deadlines[user_id] = deadline
+                heapq.heappush(self._heap, (deadline, user_id))
+        self._loaded_until = until
+        logger.info(f"Планировщик подписок: загружено {len(rows)} сроков окончания")
+
+    def _pop_due(self, now: float):
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            deadline, user_id = heapq.heappop(self._heap)
+            if self._deadlines.get(user_id) == deadline:
+                del self._deadlines[user_id]
+                due.append(user_id)
+        return due
+
+    async def _run(self):
+        while True:
+            try:
+                now = time.time()
+                # Обновляем окно заранее, до того как оно будет исчерпано
+                if now >= self._loaded_until - self.horizon / 2:
+                    await self._load_window()
+
+                due = self._pop_due(now)
+                if due:
+                    await self.on_expire(due)
+                    continue
+
+                next_deadline = self._heap[0][0] if self._heap else float("inf")
+                refresh_at = self._loaded_until - self.horizon / 2
+                sleep_for = min(next_deadline, refresh_at) - time.time()
+                sleep_for = max(0.0, min(sleep_for, EXPIRY_MAX_SLEEP))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), sleep_for)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике окончания подписок: {e}", exc_info=True)
+                await asyncio.sleep(EXPIRY_MAX_SLEEP)
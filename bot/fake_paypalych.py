@@ -0,0 +1,179 @@
+"""
+Локальная заглушка платежного сервиса PayPalych для тестирования.
+
+Реализует bill/create, bill/status и bill/search, умеет добавлять задержку и
+ошибки в ответы API. Страница оплаты /pay/{bill_id} помечает счет оплаченным и
+отправляет подписанное уведомление на Result URL бота.
+
+Запуск: python -m bot.fake_paypalych --port 8090 --result-url http://127.0.0.1:8080/paypalych/result
+Для бота: PAYPALYCH_MOCK=false, PAYPALYCH_BASE_URL=http://127.0.0.1:8090/api/v1
+"""
+import argparse
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime
+from aiohttp import web, ClientSession
+from bot.payment_webhook import make_signature
+from bot.paypalych_api import PAYPALYCH_API_KEY
+
+logger = logging.getLogger(__name__)
+
+
+class FakePaypalych:
+    """
+    Имитирует API PayPalych и отправку уведомлений об оплате на Result URL.
+
+    latency - задержка ответов API (секунды), failure_rate - доля ответов HTTP 503,
+    fail_next - количество следующих запросов, которые гарантированно завершатся ошибкой.
+    """
+
+    def __init__(self, result_url: str = None, api_key: str = None, host: str = "127.0.0.1",
+                 port: int = 0, latency: float = 0.0, failure_rate: float = 0.0):
+        self.result_url = result_url
+        self.api_key = PAYPALYCH_API_KEY if api_key is None else api_key
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_next = 0
+        # Формат: {bill_id: {'id', 'order_id', 'amount', 'status', 'custom', 'created_at'}}
+        self.bills = {}
+        self.requests = 0
+        self.sent = []
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.base_url}/api/v1"
+
+    async def send_postback(self, inv_id: str, out_sum: str = "5.00", status: str = "SUCCESS",
+                            custom: str = "", signature: str = None) -> int:
+        """
+        Отправляет уведомление об оплате и возвращает HTTP-статус ответа бота
+        """
+        data = {
+            "InvId": inv_id,
+            "OutSum": out_sum,
+            "Commission": "0",
+            "TrsId": f"trs-{inv_id}",
+            "Status": status,
+            "CurrencyIn": "USD",
+            "custom": custom,
+            "SignatureValue": signature or make_signature(out_sum, inv_id, self.api_key),
+        }
+        async with ClientSession() as session:
+            async with session.post(self.result_url, data=data) as response:
+                self.sent.append((inv_id, status, response.status))
+                return response.status
+
+    async def pay(self, bill_id: str, status: str = "SUCCESS", notify: bool = True):
+        """
+        Меняет статус счета и (при наличии Result URL) отправляет уведомление
+        """
+        bill = self.bills[bill_id]
+        bill['status'] = status
+        if notify and self.result_url:
+            return await self.send_postback(bill['order_id'], bill['amount'], status, bill['custom'])
+
+    # --- API ---
+
+    @web.middleware
+    async def _inject_faults(self, request: web.Request, handler):
+        if request.path.startswith("/api/"):
+            self.requests += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.fail_next > 0 or random.random() < self.failure_rate:
+                self.fail_next = max(0, self.fail_next - 1)
+                return web.json_response({"success": False, "message": "unavailable"}, status=503)
+            if request.headers.get("Authorization") != f"Bearer {self.api_key}":
+                return web.json_response({"success": False, "message": "unauthorized"}, status=401)
+        return await handler(request)
+
+    async def _bill_create(self, request: web.Request):
+        data = await request.post()
+        bill_id = uuid.uuid4().hex[:10].upper()
+        self.bills[bill_id] = {
+            'id': bill_id,
+            'order_id': data.get("order_id", ""),
+            'amount': data.get("amount", "0"),
+            'status': "NEW",
+            'custom': data.get("custom", ""),
+            'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        return web.json_response({
+            "success": True,
+            "bill_id": bill_id,
+            "link_url": f"{self.base_url}/pay/{bill_id}",
+            "link_page_url": f"{self.base_url}/pay/{bill_id}",
+        })
+
+    async def _bill_status(self, request: web.Request):
+        bill = self.bills.get(request.query.get("id"))
+        if bill is None:
+            return web.json_response({"success": False, "message": "not found"}, status=404)
+        return web.json_response({"success": True, "id": bill['id'], "status": bill['status']})
+
+    async def _bill_search(self, request: web.Request):
+        per_page = int(request.query.get("per_page", 100))
+        page = int(request.query.get("page", 1))
+        bills = list(self.bills.values())
+        chunk = bills[(page - 1) * per_page:page * per_page]
+        last_page = max(1, (len(bills) + per_page - 1) // per_page)
+        return web.json_response({
+            "success": True,
+            "data": [{"id": b['id'], "status": b['status'], "created_at": b['created_at']} for b in chunk],
+            "meta": {"current_page": page, "last_page": last_page, "per_page": per_page},
+        })
+
+    async def _handle_pay(self, request: web.Request):
+        bill_id = request.match_info["bill_id"]
+        if bill_id not in self.bills:
+            # Платеж заглушки бота (без счета): отправляем только уведомление
+            code = await self.send_postback(bill_id, request.query.get("amount", "5.00"),
+                                            request.query.get("status", "SUCCESS"))
+        else:
+            code = await self.pay(bill_id, request.query.get("status", "SUCCESS"))
+        return web.Response(text=f"Оплата выполнена, ответ бота: {code}")
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject_faults])
+        app.router.add_post("/api/v1/bill/create", self._bill_create)
+        app.router.add_get("/api/v1/bill/status", self._bill_status)
+        app.router.add_get("/api/v1/bill/search", self._bill_search)
+        app.router.add_get("/pay/{bill_id}", self._handle_pay)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Заглушка PayPalych запущена на {self.base_url}")
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка платежного сервиса PayPalych")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--result-url", default="http://127.0.0.1:8080/paypalych/result")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fake = FakePaypalych(args.result_url, api_key=args.api_key, port=args.port,
+                         latency=args.latency, failure_rate=args.failure_rate)
+    web.run_app(fake.make_app(), port=args.port)
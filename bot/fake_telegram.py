@@ -0,0 +1,198 @@
+"""
+Локальная заглушка Telegram Bot API для тестирования бота без обращения к Telegram.
+
+Отвечает на методы Bot API (sendMessage, sendDocument, setWebhook, getUpdates и др.),
+записывает все вызовы и умеет доставлять обновления как через getUpdates (polling),
+так и POST-запросом на webhook бота.
+
+Для бота: TELEGRAM_API_URL=http://127.0.0.1:8081
+Запуск: python -m bot.fake_telegram --port 8081
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+from aiohttp import web, ClientSession
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+def make_message_update(update_id: int, user_id: int, text: str, message_id: int = None) -> dict:
+    """
+    Формирует обновление с текстовым сообщением пользователя в личном чате
+    """
+    entities = []
+    if text.startswith("/"):
+        entities.append({"type": "bot_command", "offset": 0, "length": len(text.split()[0])})
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id or update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+class FakeTelegram:
+    """
+    Имитирует Bot API. calls - список (method, params) в порядке поступления.
+    latency - задержка ответа на каждый вызов (секунды).
+    blocked_chats - чаты, заблокировавшие бота (ответ 403 на отправку сообщений),
+    flood_next - количество следующих отправок, на которые придет 429 с retry_after.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = []
+        self.blocked_chats = set()
+        self.flood_next = 0
+        self.retry_after = 1
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._updates = []
+        self._update_event = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def calls_of(self, method: str):
+        return [params for name, params in self.calls if name == method]
+
+    def push_update(self, update: dict):
+        """
+        Добавляет обновление для выдачи через getUpdates
+        """
+        self._updates.append(update)
+        self._update_event.set()
+
+    async def send_webhook_update(self, update: dict, url: str = None) -> int:
+        """
+        Доставляет обновление на webhook бота, возвращает HTTP-статус
+        """
+        headers = {}
+        if self.webhook_secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+        async with ClientSession() as session:
+            async with session.post(url or self.webhook_url, json=update, headers=headers) as response:
+                return response.status
+
+    def _message(self, chat_id, **fields) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    def _file_id(self, value) -> str:
+        """
+        file_id отправленного файла: переданный file_id или новый для загруженного файла
+        """
+        if isinstance(value, str) and not value.startswith("attach://"):
+            return value
+        return f"file-{next(self._message_ids)}"
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._update_event.clear()
+            try:
+                await asyncio.wait_for(self._update_event.wait(), min(timeout, 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {k: v for k, v in (await request.post()).items()}
+        self.calls.append((method, params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method.startswith("send") and "chat_id" in params:
+            if int(params["chat_id"]) in self.blocked_chats:
+                return web.json_response({
+                    "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"
+                }, status=403)
+            if self.flood_next > 0:
+                self.flood_next -= 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}
+                }, status=429)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            result = True
+        elif method in ("deleteWebhook", "answerCallbackQuery", "setMyCommands"):
+            result = True
+        elif method == "sendMessage":
+            result = self._message(params["chat_id"], text=params.get("text", ""))
+        elif method == "sendDocument":
+            document = params.get("document")
+            file_id = self._file_id(document)
+            result = self._message(params["chat_id"], document={
+                "file_id": file_id, "file_unique_id": file_id
+            }, caption=params.get("caption"))
+        elif method == "sendPhoto":
+            photo = params.get("photo")
+            file_id = self._file_id(photo)
+            result = self._message(params["chat_id"], photo=[{
+                "file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1
+            }], caption=params.get("caption"))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result}, dumps=lambda o: json.dumps(o, default=str))
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"Заглушка Telegram Bot API запущена на {self.base_url}")
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(FakeTelegram(port=args.port).make_app(), port=args.port)
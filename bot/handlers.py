@@ -4,7 +4,15 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from db.database import get_user, create_user, update_subscription
+import time
+from db.async_database import (
+    get_user, create_user, update_subscription, get_all_user_ids, get_outbox_stats, get_top_traffic,
+    get_job_stats, get_dead_jobs, retry_dead_job, get_stats, get_suspensions, lift_suspension
+)
+from bot.notifier import notifier
+from bot.jobs import job_queue
+from vpn.vpn_manager import get_node_pool
+from vpn.traffic import format_bytes
 from bot.paypalych_api import create_payment_link, check_payment_status
 from vpn.vpn_manager import generate_v2ray_config, create_v2ray_user
 from datetime import datetime, timedelta
@@ -35,7 +43,235 @@ async def cmd_admin(message: types.Message):
     ADMIN_ID = int(os.getenv("ADMIN_ID"))
     if message.from_user.id == ADMIN_ID:
         # Добавляем админские команды
-        admin_text = "Вы вошли в режим администратора. Доступны команды управления."
+        admin_text = (
+            "Вы вошли в режим администратора. Доступны команды управления:\n"
+            "/stats [дней] - подписчики, окончания подписок, новые пользователи и выручка по дням\n"
+            "/broadcast <текст> - отправить сообщение всем пользователям\n"
+            "/outbox - состояние очереди уведомлений\n"
+            "/nodes - узлы V2Ray и их загрузка\n"
+            "/drain <узел> - вывести узел (пользователи будут перенесены)\n"
+            "/activate <узел> - вернуть узел в работу\n"
+            "/top [N] [дней] - пользователи с наибольшим трафиком\n"
+            "/jobs - очередь фоновых задач и неудачные задачи\n"
+            "/retry <id> - повторить неудачную задачу\n"
+            "/suspended - блокировки за превышение числа устройств\n"
+            "/unsuspend <id> - снять блокировку (будет выдан новый UUID)"
+        )
         await message.answer(admin_text)
     else:
         await message.answer("У вас нет прав администратора.")
+
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    parts = (message.text or "").split()
+    try:
+        days = int(parts[1]) if len(parts) > 1 else 7
+    except ValueError:
+        await message.answer("Использование: /stats [дней], например: /stats 30")
+        return
+
+    stats = await get_stats(time.time(), max(1, min(days, 90)))
+    lines = [
+        "Статистика:",
+        f"Пользователей: {stats.get('users', 0)}, активных подписок: {stats.get('active', 0)}",
+        f"Заканчиваются за 24 ч: {stats['expiring_24h']}, за 7 дн.: {stats['expiring_7d']}"
+    ]
+    if stats['nodes']:
+        lines.append("Активные пользователи на узлах: " + ", ".join(
+            f"{node_id} - {count}" for node_id, count in stats['nodes'].items()
+        ))
+    lines.append("\nПо дням (новые пользователи, оплаты, выручка):")
+    for day, metrics in sorted(stats['daily'].items(), reverse=True):
+        revenue = ", ".join(
+            f"{value:g} {metric.split(':', 1)[1]}" for metric, value in sorted(metrics.items())
+            if metric.startswith("revenue:")
+        ) or "0"
+        lines.append(
+            f"{datetime.fromisoformat(day).strftime('%d.%m')}: {int(metrics.get('signups', 0))}, "
+            f"{int(metrics.get('subscriptions:payment', 0))}, {revenue}"
+        )
+    await message.answer("\n".join(lines))
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    parts = (message.text or "").split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await message.answer("Использование: /broadcast <текст сообщения>")
+        return
+
+    # Сообщения ставятся в очередь и отправляются в фоне с учетом лимитов Telegram
+    user_ids = await get_all_user_ids()
+    count = await notifier.enqueue(user_ids, parts[1].strip(), kind="broadcast")
+    await message.answer(f"Рассылка поставлена в очередь: {count} сообщений.")
+
+@router.message(Command("outbox"))
+async def cmd_outbox(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    stats = await get_outbox_stats()
+    await message.answer(
+        "Очередь уведомлений:\n"
+        f"Ожидают отправки: {stats.get('pending', 0)}\n"
+        f"Отправлено: {stats.get('sent', 0)}\n"
+        f"Бот заблокирован: {stats.get('blocked', 0)}\n"
+        f"Ошибки: {stats.get('failed', 0)}"
+    )
+
+
+@router.message(Command("nodes"))
+async def cmd_nodes(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    pool = get_node_pool()
+    await pool.refresh_loads()
+    lines = ["Узлы V2Ray:"]
+    for node_id, node in pool.nodes.items():
+        health = "доступен" if pool.healthy.get(node_id, True) else "недоступен"
+        lines.append(
+            f"{node_id} ({node['address']}:{node['port']}): {pool.loads.get(node_id, 0)}/{node['capacity']}, "
+            f"{node['status']}, {health}"
+        )
+    await message.answer("\n".join(lines))
+
+@router.message(Command("drain", "activate"))
+async def cmd_node_status(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) < 2:
+        await message.answer("Укажите идентификатор узла, например: /drain main")
+        return
+
+    command = parts[0].lstrip("/").split("@")[0]
+    status = "draining" if command == "drain" else "active"
+    if not await get_node_pool().set_status(parts[1], status):
+        await message.answer(f"Узел {parts[1]} не найден.")
+        return
+    if status == "draining":
+        await message.answer(f"Узел {parts[1]} выводится, пользователи будут перенесены на другие узлы.")
+    else:
+        await message.answer(f"Узел {parts[1]} снова принимает пользователей.")
+
+@router.message(Command("top"))
+async def cmd_top(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    parts = (message.text or "").split()
+    try:
+        limit = int(parts[1]) if len(parts) > 1 else 10
+        days = float(parts[2]) if len(parts) > 2 else 1
+    except ValueError:
+        await message.answer("Использование: /top [N] [дней], например: /top 20 7")
+        return
+
+    rows = await get_top_traffic(time.time() - days * 86400, min(limit, 100))
+    if not rows:
+        await message.answer("Нет данных о трафике за этот период.")
+        return
+    lines = [f"Топ-{len(rows)} по трафику за {days:g} дн.:"]
+    for position, (user_id, uplink, downlink) in enumerate(rows, 1):
+        lines.append(
+            f"{position}. {user_id}: {format_bytes(uplink + downlink)} "
+            f"(отправлено {format_bytes(uplink)}, получено {format_bytes(downlink)})"
+        )
+    await message.answer("\n".join(lines))
+
+@router.message(Command("jobs"))
+async def cmd_jobs(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    stats = await get_job_stats()
+    lines = [
+        "Очередь задач:",
+        f"Ожидают: {stats.get('pending', 0)}",
+        f"Выполняются: {stats.get('running', 0)}",
+        f"Выполнено: {stats.get('done', 0)}",
+        f"Неудачные: {stats.get('dead', 0)}"
+    ]
+    dead = await get_dead_jobs(10)
+    if dead:
+        lines.append("\nПоследние неудачные задачи (/retry <id>):")
+        for job_id, kind, job_key, attempts, updated_at, error in dead:
+            when = datetime.fromtimestamp(updated_at).strftime('%d.%m %H:%M')
+            lines.append(f"{job_id}. {job_key}, попыток {attempts}, {when}: {error}")
+    await message.answer("\n".join(lines))
+
+@router.message(Command("retry"))
+async def cmd_retry_job(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Использование: /retry <id задачи>")
+        return
+    if not await retry_dead_job(int(parts[1])):
+        await message.answer(f"Неудачная задача {parts[1]} не найдена.")
+        return
+    job_queue.wake()
+    await message.answer(f"Задача {parts[1]} снова поставлена в очередь.")
+
+@router.message(Command("suspended"))
+async def cmd_suspended(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    rows = await get_suspensions()
+    if not rows:
+        await message.answer("Заблокированных пользователей нет.")
+        return
+    lines = [f"Блокировки за превышение числа устройств ({len(rows)}):"]
+    for user_id, devices, suspended_at, until in rows[:50]:
+        lines.append(
+            f"{user_id}: {devices} устройств, с {datetime.fromtimestamp(suspended_at).strftime('%d.%m %H:%M')} "
+            f"до {datetime.fromtimestamp(until).strftime('%d.%m %H:%M')}"
+        )
+    await message.answer("\n".join(lines))
+
+@router.message(Command("unsuspend"))
+async def cmd_unsuspend(message: types.Message):
+    ADMIN_ID = int(os.getenv("ADMIN_ID"))
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("У вас нет прав администратора.")
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Использование: /unsuspend <id пользователя>")
+        return
+    user_id = int(parts[1])
+    # Клиента V2Ray возвращает ведущий процесс (задача restore)
+    if not await lift_suspension(user_id):
+        await message.answer(f"Пользователь {user_id} не заблокирован.")
+        return
+    job_queue.wake()
+    await message.answer(f"Блокировка пользователя {user_id} снята, доступ будет восстановлен в течение минуты.")
@@ -0,0 +1,147 @@
+"""
+Постоянная очередь фоновых задач в базе данных (таблица jobs).
+
+Обработчики сообщений только ставят задачу в очередь и сразу отвечают, а
+выполняют ее несколько фоновых исполнителей. Задача забирается с арендой
+(locked_until): если процесс упал во время выполнения, после истечения аренды
+задача будет выполнена снова, поэтому обработчики должны быть идемпотентными.
+Ошибки повторяются с нарастающей задержкой, а задачи, исчерпавшие попытки,
+остаются в списке неудачных (status = 'dead') до ручного повтора.
+"""
+import asyncio
+import logging
+import os
+import time
+from db.async_database import claim_jobs, enqueue_job, finish_job, get_next_job_time
+
+logger = logging.getLogger(__name__)
+
+# Число одновременно выполняемых задач
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "8"))
+# Задержка перед повтором: JOB_RETRY_BASE * 2^попытка, но не больше JOB_RETRY_MAX (секунды)
+JOB_RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", "5"))
+JOB_RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", "1800"))
+# Время, на которое задача закрепляется за исполнителем (секунды)
+JOB_LEASE = float(os.getenv("JOB_LEASE", "300"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+
+
+class JobQueue:
+    """
+    Исполнитель задач из очереди jobs с пулом фоновых обработчиков
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_attempts: int = JOB_MAX_ATTEMPTS,
+                 lease: float = JOB_LEASE, poll_interval: float = JOB_POLL_INTERVAL):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._on_dead = None
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.done = 0
+        self.retried = 0
+        self.dead = 0
+
+    def register(self, kind: str, handler):
+        """
+        Назначает обработчик задач вида kind: async handler(payload)
+        """
+        self._handlers[kind] = handler
+
+    def on_dead(self, callback):
+        """
+        Назначает обработчик задач, исчерпавших попытки: async callback(job_id, kind, payload, error)
+        """
+        self._on_dead = callback
+
+    def start(self):
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def enqueue(self, kind: str, job_key: str, payload: dict) -> bool:
+        """
+        Ставит задачу в очередь. Возвращает False, если задача с таким ключом уже есть.
+        """
+        created = await enqueue_job(kind, job_key, payload)
+        if created:
+            self.wake()
+        return created
+
+    async def _wait_for_work(self):
+        next_time = await get_next_job_time()
+        timeout = self.poll_interval
+        if next_time is not None:
+            timeout = min(timeout, max(0.0, next_time - time.time()))
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            try:
+                jobs = await claim_jobs(time.time(), 1, self.lease)
+                if not jobs:
+                    await self._wait_for_work()
+                    continue
+                await self._execute(*jobs[0])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка исполнителя задач: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _execute(self, job_id: int, kind: str, payload: dict, attempts: int):
+        handler = self._handlers.get(kind)
+        if handler is None:
+            await self._bury(job_id, kind, payload, attempts, f"Нет обработчика для задач вида {kind}")
+            return
+        try:
+            await handler(payload)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if attempts >= self.max_attempts:
+                await self._bury(job_id, kind, payload, attempts, error)
+            else:
+                delay = min(JOB_RETRY_MAX, JOB_RETRY_BASE * 2 ** (attempts - 1))
+                logger.warning(f"Задача {job_id} ({kind}), попытка {attempts}: {error}. Повтор через {delay:.0f} с")
+                await finish_job(job_id, "pending", attempts, time.time() + delay, error)
+                self.retried += 1
+            return
+        await finish_job(job_id, "done", attempts)
+        self.done += 1
+
+    async def _bury(self, job_id: int, kind: str, payload: dict, attempts: int, error: str):
+        """
+        Переносит задачу в список неудачных
+        """
+        logger.error(f"Задача {job_id} ({kind}) не выполнена после {attempts} попыток: {error}")
+        await finish_job(job_id, "dead", attempts, error=error)
+        self.dead += 1
+        if self._on_dead is not None:
+            try:
+                await self._on_dead(job_id, kind, payload, error)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика неудачной задачи {job_id}: {e}")
+
+
+job_queue = JobQueue()
@@ -0,0 +1,175 @@
+"""
+Выбор ведущего процесса через аренду в базе SQLite (таблица leases).
+
+Несколько процессов бота могут работать на одной базе: все принимают обновления
+(в режиме webhook), но фоновые задачи в единственном экземпляре - планировщик
+окончания подписок, очереди задач и уведомлений, изменения конфигурации V2Ray,
+сбор трафика - выполняет только ведущий. Ведущий продлевает аренду каждые
+LEADER_HEARTBEAT секунд; если он упал, аренда истекает через LEADER_LEASE_TTL
+секунд и ее захватывает другой процесс. Каждый захват увеличивает fencing
+token: изменения конфигурации V2Ray проверяют, что токен все еще действителен,
+поэтому отставший бывший ведущий не может перезаписать конфигурацию.
+Обработчики получения роли выполняются в отдельной задаче, чтобы долгий запуск
+задач ведущего не мешал продлению аренды; при потере роли эта задача отменяется.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from db import database
+from db.async_database import acquire_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+# Включить выбор ведущего (несколько процессов бота)
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "false").lower() == "true"
+LEADER_LEASE_NAME = os.getenv("LEADER_LEASE_NAME", "bot-leader")
+# Время жизни аренды и интервал ее продления (секунды)
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "10"))
+LEADER_HEARTBEAT = float(os.getenv("LEADER_HEARTBEAT", "2"))
+
+
+class LeaderElector:
+    """
+    Участник выбора ведущего. on_elected/on_demoted - асинхронные обработчики
+    получения и потери роли ведущего.
+    """
+
+    def __init__(self, name: str = LEADER_LEASE_NAME, ttl: float = LEADER_LEASE_TTL,
+                 heartbeat: float = LEADER_HEARTBEAT, holder: str = None):
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.token = None
+        # Момент (time.monotonic), до которого аренда гарантированно наша
+        self._valid_until = 0.0
+        self._on_elected = []
+        self._on_demoted = []
+        self._task = None
+        # Запуск задач ведущего (обработчики on_elected)
+        self._duties = None
+        self.elections = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    def on_elected(self, callback):
+        self._on_elected.append(callback)
+
+    def on_demoted(self, callback):
+        self._on_demoted.append(callback)
+
+    def fence(self) -> bool:
+        """
+        Синхронная проверка fencing token перед изменением общего состояния
+        (вызывается из потока записи конфигурации)
+        """
+        token = self.token
+        return token is not None and database.check_lease(self.name, self.holder, token)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """
+        Снимает роль ведущего и освобождает аренду, чтобы другой процесс занял ее сразу
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.token is not None:
+            await self._demote("остановка процесса")
+            try:
+                await release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.warning(f"Не удалось освободить аренду {self.name}: {e}")
+
+    async def _promote(self, token: int):
+        self.token = token
+        self.elections += 1
+        logger.info(f"Процесс {self.holder} стал ведущим (token {token})")
+        # Аренда продолжает продлеваться, пока запускаются задачи ведущего
+        self._duties = asyncio.get_running_loop().create_task(self._start_duties())
+
+    async def _start_duties(self):
+        for callback in self._on_elected:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"Ошибка при запуске задач ведущего: {e}", exc_info=True)
+
+    async def _demote(self, reason: str):
+        logger.warning(f"Процесс {self.holder} больше не ведущий: {reason}")
+        self.token = None
+        self._valid_until = 0.0
+        if self._duties is not None:
+            # Запуск мог не завершиться: прерываем его до остановки задач ведущего
+            self._duties.cancel()
+            await asyncio.gather(self._duties, return_exceptions=True)
+            self._duties = None
+        for callback in self._on_demoted:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"Ошибка при остановке задач ведущего: {e}", exc_info=True)
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                token = await asyncio.wait_for(
+                    acquire_lease(self.name, self.holder, self.ttl), self.ttl / 2
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Не удалось продлить аренду {self.name}: {e}")
+                token = None
+                if self.token is not None and time.monotonic() < self._valid_until:
+                    # Аренда еще действует - попробуем продлить на следующем шаге
+                    await asyncio.sleep(self.heartbeat)
+                    continue
+
+            if token is not None:
+                # Отсчет от начала запроса: аренда истечет не раньше этого момента
+                self._valid_until = started + self.ttl
+                if self.token is None:
+                    await self._promote(token)
+                elif token != self.token:
+                    # Аренда истекла и была захвачена заново тем же процессом
+                    self.token = token
+            elif self.token is not None:
+                await self._demote("аренда захвачена другим процессом")
+
+            await asyncio.sleep(max(0.0, self.heartbeat - (time.monotonic() - started)))
+
+
+async def _serve():
+    """
+    Участник выбора без задач: для проверки переключения ведущего несколькими процессами
+    """
+    await asyncio.to_thread(database.init_db)
+    elector = LeaderElector()
+    elector.on_elected(lambda: asyncio.sleep(0))
+    elector.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await elector.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
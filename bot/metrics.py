@@ -0,0 +1,108 @@
+"""
+Метрики бота: middleware обработки обновлений Telegram и HTTP-сервер /metrics.
+
+Счетчики, гистограммы и реестр метрик - в db/metrics.py (без зависимости от
+aiogram и aiohttp); здесь они реэкспортируются для модулей бота.
+
+Сервер метрик (METRICS_ENABLED) слушает локальный адрес METRICS_HOST:METRICS_PORT.
+Если порт занят (несколько процессов бота с LEADER_ELECTION), процесс занимает
+следующий свободный из METRICS_PORT_SPAN портов.
+"""
+import logging
+import os
+import time
+from aiohttp import web
+from aiogram import BaseMiddleware
+from dotenv import load_dotenv
+from db.metrics import LATENCY_BUCKETS, REGISTRY, Counter, Gauge, Histogram, counter, gauge, histogram
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Число портов начиная с METRICS_PORT, которые пробуют процессы бота
+METRICS_PORT_SPAN = int(os.getenv("METRICS_PORT_SPAN", "8"))
+
+
+# --- Метрики обработки обновлений Telegram ---
+
+UPDATE_SECONDS = histogram("bot_update_seconds", "Время обработки обновления Telegram", ("type",))
+UPDATE_ERRORS = counter("bot_update_errors_total", "Ошибки при обработке обновлений Telegram", ("type",))
+HANDLER_SECONDS = histogram("bot_handler_seconds", "Время работы обработчика", ("handler",))
+HANDLER_ERRORS = counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware dp.update: время обработки и ошибки по типам обновлений
+    """
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.labels(event.event_type).inc()
+            raise
+        finally:
+            UPDATE_SECONDS.labels(event.event_type).observe(time.perf_counter() - started)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware наблюдателя: время работы и исключения по обработчикам
+    """
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+def setup_metrics(dp):
+    """
+    Подключает middleware метрик к диспетчеру. Внутренние middleware наблюдателей
+    диспетчера действуют и на обработчики вложенных роутеров.
+    """
+    dp.update.outer_middleware(MetricsMiddleware())
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(HandlerMetricsMiddleware())
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(
+        text=await REGISTRY.render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT,
+                               span: int = METRICS_PORT_SPAN) -> web.AppRunner:
+    """
+    Запускает HTTP-сервер с /metrics на первом свободном порту из port..port+span-1.
+    Возвращает None, если все порты заняты (бот продолжает работу без сервера метрик).
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    for candidate in range(port, port + max(span, 1)):
+        try:
+            await web.TCPSite(runner, host, candidate).start()
+        except OSError:
+            continue
+        logger.info(f"Метрики доступны на http://{host}:{candidate}/metrics")
+        return runner
+    await runner.cleanup()
+    logger.warning(f"Сервер метрик не запущен: порты {port}-{port + max(span, 1) - 1} на {host} заняты")
+    return None
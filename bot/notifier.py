@@ -0,0 +1,236 @@
+"""
+Массовая отправка уведомлений через очередь в базе данных (таблица outbox).
+
+Сообщения ставятся в очередь и отправляются фоновой задачей с ограничением
+скорости: общий лимит Telegram (~30 сообщений в секунду) и лимит на один чат.
+При TelegramRetryAfter отправка приостанавливается на указанное время, временные
+ошибки повторяются с нарастающей задержкой, заблокировавшие бота пользователи
+отмечаются и исключаются из дальнейших рассылок.
+"""
+import asyncio
+import logging
+import os
+import time
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+)
+from db.async_database import (
+    enqueue_notifications, fetch_due_notifications, get_next_notification_time,
+    save_notification_results
+)
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит отправки (сообщений в секунду)
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", "30"))
+# Лимит на один чат (сообщений в секунду) и допустимый всплеск
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))
+NOTIFY_CHAT_BURST = float(os.getenv("NOTIFY_CHAT_BURST", "3"))
+# Размер пакета, выбираемого из очереди за один раз
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "100"))
+# Максимальное число одновременных запросов к Telegram
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "30"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5"))
+# Интервал проверки очереди, если нет новых сообщений (секунды)
+NOTIFY_POLL_INTERVAL = float(os.getenv("NOTIFY_POLL_INTERVAL", "5"))
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не более capacity накопленных
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float = None) -> float:
+        """
+        Через сколько секунд будет доступен токен (0 - доступен сейчас)
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """
+        Приостанавливает выдачу токенов (ответ RetryAfter от Telegram)
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    @property
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.take()
+                return
+            await asyncio.sleep(wait)
+
+
+class Notifier:
+    """
+    Фоновый отправитель уведомлений из очереди outbox
+    """
+
+    def __init__(self, rate: float = NOTIFY_RATE, chat_rate: float = NOTIFY_CHAT_RATE,
+                 chat_burst: float = NOTIFY_CHAT_BURST, batch_size: int = NOTIFY_BATCH_SIZE,
+                 concurrency: int = NOTIFY_CONCURRENCY, max_attempts: int = NOTIFY_MAX_ATTEMPTS,
+                 poll_interval: float = NOTIFY_POLL_INTERVAL):
+        self.bot = None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._bucket = TokenBucket(rate, rate)
+        self._chat_buckets = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """
+        Будит отправителя после постановки сообщений в очередь
+        """
+        self._wakeup.set()
+
+    async def enqueue(self, chat_ids, text: str, kind: str = None) -> int:
+        """
+        Ставит сообщение text в очередь для каждого чата из chat_ids.
+        Возвращает количество поставленных в очередь сообщений.
+        """
+        count = await enqueue_notifications([(chat_id, text, kind) for chat_id in chat_ids])
+        if count:
+            self.wake()
+        return count
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _evict_idle_buckets(self):
+        # Заполненная корзина ничем не отличается от новой, ее можно удалить
+        for chat_id in [c for c, bucket in self._chat_buckets.items() if bucket.full]:
+            del self._chat_buckets[chat_id]
+
+    async def _wait_for_work(self):
+        next_time = await get_next_notification_time()
+        timeout = self.poll_interval
+        if next_time is not None:
+            timeout = min(timeout, max(0.0, next_time - time.time()))
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            try:
+                rows = await fetch_due_notifications(time.time(), self.batch_size)
+                if not rows:
+                    self._evict_idle_buckets()
+                    await self._wait_for_work()
+                    continue
+                await self._send_batch(rows)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомлений: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _send_batch(self, rows):
+        """
+        Отправляет пакет с учетом лимитов и сохраняет результаты одной транзакцией
+        """
+        sent, retries, failures = [], [], []
+        tasks = []
+        for notification_id, chat_id, text, attempts in rows:
+            chat_bucket = self._chat_bucket(chat_id)
+            wait = chat_bucket.delay()
+            if wait > 0:
+                # Лимит чата исчерпан: откладываем, не задерживая остальные чаты
+                retries.append((time.time() + wait, attempts, None, notification_id))
+                continue
+            chat_bucket.take()
+            await self._bucket.acquire()
+            await self._semaphore.acquire()
+            tasks.append(asyncio.create_task(
+                self._send_one(notification_id, chat_id, text, attempts, sent, retries, failures)
+            ))
+        if tasks:
+            await asyncio.gather(*tasks)
+        await save_notification_results(sent, retries, failures)
+
+    async def _send_one(self, notification_id, chat_id, text, attempts, sent, retries, failures):
+        try:
+            await self.bot.send_message(chat_id, text)
+            sent.append(notification_id)
+            self.sent += 1
+        except TelegramRetryAfter as e:
+            # Превышен лимит Telegram: приостанавливаем всю отправку
+            logger.warning(f"Telegram попросил подождать {e.retry_after} с")
+            self._bucket.pause(e.retry_after)
+            retries.append((time.time() + e.retry_after, attempts, "retry_after", notification_id))
+            self.retried += 1
+        except TelegramForbiddenError as e:
+            failures.append(("blocked", str(e), notification_id))
+            self.blocked += 1
+        except TelegramBadRequest as e:
+            failures.append(("failed", str(e), notification_id))
+            self.failed += 1
+        except (TelegramAPIError, asyncio.TimeoutError, OSError) as e:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                failures.append(("failed", str(e), notification_id))
+                self.failed += 1
+            else:
+                retries.append((time.time() + min(600, 2 ** attempts), attempts, str(e), notification_id))
+                self.retried += 1
+        finally:
+            self._semaphore.release()
+
+
+notifier = Notifier()
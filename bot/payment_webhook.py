@@ -0,0 +1,110 @@
+"""
+Прием уведомлений об оплате (Result URL / postback) от PayPalych (pally.info).
+
+PayPalych отправляет POST с полями InvId, OutSum, CurrencyIn, Status, TrsId,
+custom и SignatureValue = MD5("OutSum:InvId:API_KEY") в верхнем регистре.
+"""
+import hashlib
+import hmac
+import logging
+import os
+from aiohttp import web
+from dotenv import load_dotenv
+from bot.paypalych_api import PAYPALYCH_API_KEY
+from db.async_database import get_payment, set_payment_status
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_WEBHOOK_PATH = os.getenv("PAYMENT_WEBHOOK_PATH", "/paypalych/result")
+
+# Статусы PayPalych -> внутренние статусы платежа
+_STATUS_MAP = {
+    "SUCCESS": "completed",
+    "OVERPAID": "completed",
+    "FAIL": "failed",
+}
+
+def make_signature(out_sum: str, inv_id: str, api_key: str = None) -> str:
+    """
+    Вычисляет подпись уведомления PayPalych
+    """
+    api_key = PAYPALYCH_API_KEY if api_key is None else api_key
+    return hashlib.md5(f"{out_sum}:{inv_id}:{api_key}".encode()).hexdigest().upper()
+
+
+def verify_signature(out_sum: str, inv_id: str, signature: str, api_key: str = None) -> bool:
+    """
+    Проверяет подпись уведомления (сравнение за постоянное время)
+    """
+    expected = make_signature(out_sum, inv_id, api_key)
+    return hmac.compare_digest(expected, (signature or "").upper())
+
+
+def _amount_matches(out_sum: str, amount: float, status: str) -> bool:
+    """
+    Проверяет сумму уведомления по сумме платежа (OVERPAID допускает переплату)
+    """
+    try:
+        paid = round(float(out_sum), 2)
+    except (TypeError, ValueError):
+        return False
+    expected = round(float(amount), 2)
+    return paid >= expected if status == "OVERPAID" else paid == expected
+
+
+def setup_payment_webhook(app: web.Application, on_payment, path: str = PAYMENT_WEBHOOK_PATH):
+    """
+    Регистрирует обработчик уведомлений об оплате в приложении aiohttp.
+    on_payment(payment_id) вызывается для каждого успешного платежа и должен быстро
+    поставить его обработку в очередь: при ошибке PayPalych получает 500 и повторит уведомление.
+    Без PAYPALYCH_API_KEY подпись не защищает от подделки, поэтому запуск прерывается.
+    """
+    if not PAYPALYCH_API_KEY:
+        raise RuntimeError("PAYPALYCH_API_KEY не задан: прием уведомлений об оплате невозможен")
+
+    async def handle_result(request: web.Request):
+        data = await request.post()
+        inv_id = data.get("InvId", "")
+        out_sum = data.get("OutSum", "")
+        status = data.get("Status", "").upper()
+
+        if not verify_signature(out_sum, inv_id, data.get("SignatureValue")):
+            logger.warning(f"Уведомление об оплате {inv_id}: неверная подпись")
+            return web.Response(status=403, text="bad signature")
+
+        payment = await get_payment(inv_id)
+        if payment is None:
+            logger.warning(f"Уведомление об оплате: платеж {inv_id} не найден")
+            return web.Response(status=404, text="unknown payment")
+
+        new_status = _STATUS_MAP.get(status)
+        if new_status == 'completed':
+            currency = data.get("CurrencyIn")
+            if not _amount_matches(out_sum, payment['amount'], status) or \
+                    (currency and currency.upper() != (payment['currency'] or "").upper()):
+                logger.warning(f"Уведомление об оплате {inv_id}: сумма {out_sum} {currency} "
+                               f"не совпадает с платежом {payment['amount']} {payment['currency']}")
+                return web.Response(status=400, text="amount mismatch")
+
+        if new_status is None:
+            logger.info(f"Уведомление об оплате {inv_id}: статус {status} пропущен")
+            return web.Response(text="OK")
+
+        # Переход выполняется из pending (или expired -> completed); повторные уведомления ничего не меняют
+        await set_payment_status(inv_id, new_status)
+
+        if new_status == 'completed':
+            # Выдача доступа выполняется очередью задач; повторная постановка ничего не меняет
+            try:
+                await on_payment(inv_id)
+            except Exception as e:
+                logger.error(f"Уведомление об оплате {inv_id}: не удалось поставить в очередь: {e}", exc_info=True)
+                return web.Response(status=500, text="retry later")
+
+        logger.info(f"Уведомление об оплате {inv_id}: {status}")
+        return web.Response(text="OK")
+
+    app.router.add_post(path, handle_result)
+    return app
@@ -1,88 +1,169 @@
 import asyncio
+import logging
 import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from db import database
+from db.async_database import (
+    create_payment, get_payment, get_pending_payments, set_payment_status, get_reusable_payment
+)
+from bot.paypalych_client import PaypalychClient, PaypalychError
 
 load_dotenv()
 
-# PAYPALYCH_API_KEY = os.getenv("PAYPALYCH_API_KEY")  # Закомментируем, т.к. не используется в заглушке
-PAYPALYCH_BASE_URL = "https://pally.info/api/v1"  # Не используется в заглушке
+logger = logging.getLogger(__name__)
 
-# Словарь для хранения симуляции платежей (в реальном приложении используйте БД)
-# Формат: {payment_id: {'status': 'pending|completed|failed|cancelled', 'user_id': int}}
-_mock_payments = {}
+PAYPALYCH_API_KEY = os.getenv("PAYPALYCH_API_KEY", "")  # Также используется для проверки подписи уведомлений
+PAYPALYCH_SHOP_ID = os.getenv("PAYPALYCH_SHOP_ID", "")
+PAYPALYCH_BASE_URL = os.getenv("PAYPALYCH_BASE_URL", "https://pally.info/api/v1")
+# Режим заглушки: платежи не отправляются в PayPalych
+PAYPALYCH_MOCK = os.getenv("PAYPALYCH_MOCK", "true").lower() == "true"
+# Адрес страницы оплаты в заглушке (например, http://127.0.0.1:8090/pay/{payment_id} для bot.fake_paypalych)
+PAYPALYCH_MOCK_PAY_URL = os.getenv("PAYPALYCH_MOCK_PAY_URL", "https://example.com/mock-payment/{payment_id}")
+# Неоплаченная ссылка моложе этого срока выдается повторно вместо нового счета (минуты, 0 - всегда новый)
+PAYMENT_LINK_REUSE_MINUTES = float(os.getenv("PAYMENT_LINK_REUSE_MINUTES", "30"))
+
+# Платежи хранятся в таблице payments (db/database.py), поэтому переживают перезапуск бота
+
+_client = None
+# Выполняющиеся запросы: одинаковые одновременные запросы ждут один результат
+_inflight = {}
+
+async def _coalesce(key, factory):
+    """
+    Выполняет factory() один раз для всех одновременных вызовов с ключом key
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(factory())
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: отмена одного ожидающего обработчика не отменяет запрос для остальных
+    return await asyncio.shield(task)
+
+def get_client() -> PaypalychClient:
+    """
+    Возвращает общий HTTP-клиент PayPalych
+    """
+    global _client
+    if _client is None:
+        _client = PaypalychClient(PAYPALYCH_BASE_URL, PAYPALYCH_API_KEY, PAYPALYCH_SHOP_ID)
+    return _client
+
+async def close_client():
+    """
+    Закрывает HTTP-сессию клиента PayPalych
+    """
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
 
 async def create_payment_link(amount: float, currency: str, description: str, user_id: int):
     """
-    Создает ссылку для оплаты через PayPalych (заглушка)
+    Создает ссылку для оплаты через PayPalych. Если у пользователя есть недавний
+    неоплаченный платеж на ту же сумму, возвращается его ссылка (reused=True).
     """
-    # Генерируем уникальный ID платежа
+    return await _coalesce(
+        ("link", user_id, amount, currency),
+        lambda: _create_payment_link(amount, currency, description, user_id)
+    )
+
+async def _create_payment_link(amount: float, currency: str, description: str, user_id: int):
+    if PAYMENT_LINK_REUSE_MINUTES > 0:
+        created_after = (datetime.now() - timedelta(minutes=PAYMENT_LINK_REUSE_MINUTES)).isoformat()
+        pending = await get_reusable_payment(user_id, amount, currency, created_after)
+        if pending:
+            return {"payment_id": pending['payment_id'], "payment_url": pending['payment_url'], "reused": True}
+
+    # Генерируем уникальный ID платежа (передается в PayPalych как order_id / InvId)
     import uuid
     payment_id = str(uuid.uuid4())
 
-    # Сохраняем симуляцию платежа
-    _mock_payments[payment_id] = {
-        'status': 'pending',
-        'user_id': user_id,
-        'amount': amount,
-        'currency': currency
-    }
-
-    # Возвращаем фиктивный URL для оплаты
-    # В реальном приложении здесь был бы реальный URL от PayPalych
-    fake_payment_url = f"https://example.com/mock-payment/{payment_id}"  # Замените на реальный URL, если нужно
+    if PAYPALYCH_MOCK:
+        # Возвращаем фиктивный URL для оплаты
+        payment_url = PAYPALYCH_MOCK_PAY_URL.format(payment_id=payment_id)
+        provider_id = None
+        logger.debug(f"Создан фиктивный платеж: ID={payment_id}, Пользователь={user_id}, Сумма={amount} {currency}")
+    else:
+        try:
+            bill = await get_client().create_bill(amount, payment_id, description, currency, custom=str(user_id))
+        except PaypalychError as e:
+            logger.error(f"Не удалось создать счет PayPalych для пользователя {user_id}: {e}")
+            return None
+        payment_url = bill['payment_url']
+        provider_id = bill['bill_id']
 
-    print(f"[DEBUG] Создан фиктивный платеж: ID={payment_id}, Пользователь={user_id}, Сумма={amount} {currency}")
+    # Сохраняем платеж в журнале
+    await create_payment(payment_id, user_id, amount, currency, description, payment_url, provider_id)
 
     return {
         "payment_id": payment_id,
-        "payment_url": fake_payment_url
+        "payment_url": payment_url,
+        "reused": False
     }
 
 async def check_payment_status(payment_id: str):
     """
-    Проверяет статус платежа через PayPalych (заглушка)
-    Возвращает: 'pending', 'completed', 'failed', 'cancelled'
+    Проверяет статус платежа через PayPalych
+    Возвращает: 'pending', 'completed', 'failed', 'cancelled', 'expired'.
+    Одновременные проверки одного платежа выполняются одним запросом.
     """
-    payment_info = _mock_payments.get(payment_id)
+    return await _coalesce(("status", payment_id), lambda: _check_payment_status(payment_id))
+
+async def _check_payment_status(payment_id: str):
+    payment_info = await get_payment(payment_id)
     if not payment_info:
-        print(f"[DEBUG] Платеж с ID {payment_id} не найден в симуляции.")
+        logger.debug(f"Платеж с ID {payment_id} не найден в журнале.")
         return "unknown"
 
-    # В реальном приложении здесь был бы вызов API PayPalych
-    # В заглушке мы можем "ручками" изменить статус платежа для тестирования
-    # или использовать какую-то логику (например, случайное завершение)
-    # Ниже пример с ручной установкой статуса через переменную окружения
+    current_status = payment_info['status']
+    # В заглушке статус меняется уведомлением от PayPalych (bot/payment_webhook.py)
+    # или вручную через set_mock_payment_status; завершенные платежи не перепроверяются,
+    # кроме истекших: провайдер еще может принять оплату по такому счету
+    if PAYPALYCH_MOCK or not payment_info['provider_id'] or (
+            current_status in database.PAYMENT_TERMINAL_STATUSES and current_status != 'expired'):
+        return current_status
 
-    # Проверим, установлен ли статус вручную для тестирования
-    # Это нестандартный способ, но позволяет управлять статусом извне
-    # Лучше использовать внешний файл или базу данных для этого в реальном приложении
-    # Для простоты в заглушке просто возвращаем сохраненный статус
-    # Или можно добавить логику: если прошло N времени - считаем оплаченным
+    try:
+        status = await get_client().bill_status(payment_info['provider_id'])
+    except PaypalychError as e:
+        logger.warning(f"Не удалось проверить статус платежа {payment_id}: {e}")
+        return current_status
 
-    current_status = payment_info['status']
-    print(f"[DEBUG] Проверка статуса платежа {payment_id}: {current_status}")
+    if current_status == 'expired' and status != 'completed':
+        return current_status
+    if status != current_status:
+        await set_payment_status(payment_id, status)
+    return status
 
-    return current_status
+async def refresh_pending_payments():
+    """
+    Обновляет статусы всех ожидающих платежей одним пакетным запросом.
+    Возвращает ID платежей, которые стали оплаченными.
+    """
+    if PAYPALYCH_MOCK:
+        return []
+    pending = [p for p in await get_pending_payments() if p['provider_id']]
+    if not pending:
+        return []
+
+    since = min(p['created_at'] for p in pending)
+    statuses = await get_client().bills_status([p['provider_id'] for p in pending], since)
+
+    completed = []
+    for payment in pending:
+        status = statuses.get(payment['provider_id'])
+        if status and status != 'pending' and await set_payment_status(payment['payment_id'], status):
+            if status == 'completed':
+                completed.append(payment['payment_id'])
+    return completed
 
 # Функция для ручной установки статуса платежа (для тестирования)
 def set_mock_payment_status(payment_id: str, status: str):
     """
     Устанавливает статус платежа вручную (только для тестирования с заглушкой)
     """
-    if payment_id in _mock_payments:
-        _mock_payments[payment_id]['status'] = status
-        print(f"[DEBUG] Статус платежа {payment_id} изменен на '{status}'")
+    if database.set_payment_status(payment_id, status):
+        logger.debug(f"Статус платежа {payment_id} изменен на '{status}'")
     else:
-        print(f"[DEBUG] Платеж {payment_id} не найден для изменения статуса")
-
-# Функция для периодической проверки статуса платежа
-async def poll_payment_status(payment_id: str, max_attempts: int = 10):
-    """
-    Периодически проверяет статус платежа до его завершения
-    """
-    for attempt in range(max_attempts):
-        status = await check_payment_status(payment_id)
-        if status in ['completed', 'failed', 'cancelled']:
-            return status
-        await asyncio.sleep(10)  # Ждем 10 секунд между проверками
-    return 'timeout'
+        logger.debug(f"Платеж {payment_id} не найден или уже завершен")
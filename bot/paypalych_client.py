@@ -0,0 +1,261 @@
+"""
+HTTP-клиент API PayPalych (pally.info).
+
+Одна общая aiohttp.ClientSession с пулом keep-alive соединений, таймауты,
+повторы с экспоненциальной задержкой и случайным разбросом, а также
+автоматический выключатель (circuit breaker), чтобы медленный провайдер
+не накапливал ожидающие корутины обработчиков.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+import aiohttp
+from dotenv import load_dotenv
+from db.metrics import counter, histogram
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PAYPALYCH_TIMEOUT = float(os.getenv("PAYPALYCH_TIMEOUT", "10"))
+PAYPALYCH_RETRIES = int(os.getenv("PAYPALYCH_RETRIES", "3"))
+PAYPALYCH_POOL_SIZE = int(os.getenv("PAYPALYCH_POOL_SIZE", "20"))
+# Выключатель: число ошибок подряд до размыкания и время до пробного запроса (секунды)
+PAYPALYCH_BREAKER_THRESHOLD = int(os.getenv("PAYPALYCH_BREAKER_THRESHOLD", "5"))
+PAYPALYCH_BREAKER_RESET = float(os.getenv("PAYPALYCH_BREAKER_RESET", "30"))
+
+PAYPALYCH_REQUEST_SECONDS = histogram(
+    "paypalych_request_seconds", "Время запроса к API PayPalych (с повторами)", ("endpoint",)
+)
+PAYPALYCH_ERRORS = counter("paypalych_errors_total", "Неудачные запросы к API PayPalych", ("endpoint",))
+
+# Статусы счетов PayPalych -> внутренние статусы платежа
+BILL_STATUS_MAP = {
+    "NEW": "pending",
+    "PROCESS": "pending",
+    "UNDERPAID": "pending",
+    "SUCCESS": "completed",
+    "OVERPAID": "completed",
+    "FAIL": "failed",
+}
+
+
+class PaypalychError(Exception):
+    """Ошибка API PayPalych"""
+
+
+class PaypalychUnavailable(PaypalychError):
+    """Провайдер недоступен (выключатель разомкнут)"""
+
+
+class CircuitBreaker:
+    """
+    Размыкается после threshold ошибок подряд; через reset_timeout пропускает
+    один пробный запрос и замыкается при его успехе
+    """
+
+    def __init__(self, threshold: int = PAYPALYCH_BREAKER_THRESHOLD,
+                 reset_timeout: float = PAYPALYCH_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half-open" and self._probe_in_flight):
+            raise PaypalychUnavailable("PayPalych временно недоступен")
+        if state == "half-open":
+            self._probe_in_flight = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                logger.warning("PayPalych: выключатель разомкнут после серии ошибок")
+            self.opened_at = time.monotonic()
+
+
+class _RetryableError(Exception):
+    pass
+
+
+def _parse_bill(data: dict) -> dict:
+    """
+    Ответ bill/create: {'bill_id', 'payment_url'}
+    """
+    bill_id = data["bill_id"]
+    payment_url = data.get("link_page_url") or data["link_url"]
+    if not bill_id or not isinstance(payment_url, str) or not payment_url:
+        raise ValueError("нет ID счета или ссылки на оплату")
+    return {"bill_id": str(bill_id), "payment_url": payment_url}
+
+
+def _parse_search_page(data: dict):
+    """
+    Страница bill/search: ([(bill_id, статус)], номер последней страницы или None)
+    """
+    bills = [
+        (bill["id"], BILL_STATUS_MAP.get(str(bill.get("status", "")).upper(), "pending"))
+        for bill in data.get("data") or []
+    ]
+    last_page = (data.get("meta") or {}).get("last_page")
+    return bills, None if last_page is None else int(last_page)
+
+
+class PaypalychClient:
+    """
+    Асинхронный клиент API PayPalych. Сессия создается при первом запросе.
+    """
+
+    def __init__(self, base_url: str, api_key: str, shop_id: str = None,
+                 timeout: float = PAYPALYCH_TIMEOUT, retries: int = PAYPALYCH_RETRIES,
+                 pool_size: int = PAYPALYCH_POOL_SIZE, breaker: CircuitBreaker = None):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.shop_id = shop_id
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, method: str, path: str, parse=None, **kwargs):
+        """
+        Выполняет запрос; parse(data) разбирает ответ, а ошибка разбора (нет нужного
+        поля, неверный тип) становится PaypalychError
+        """
+        started = time.perf_counter()
+        try:
+            data = await self._request_with_retries(method, path, **kwargs)
+            if parse is None:
+                return data
+            try:
+                return parse(data)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                raise PaypalychError(f"PayPalych {path}: некорректный ответ {data!r}: {e!r}") from e
+        except PaypalychError:
+            PAYPALYCH_ERRORS.labels(path).inc()
+            raise
+        finally:
+            PAYPALYCH_REQUEST_SECONDS.labels(path).observe(time.perf_counter() - started)
+
+    async def _request_with_retries(self, method: str, path: str, **kwargs) -> dict:
+        self.breaker.before_call()
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        last_error = None
+        # Провайдер ответил корректно; любой другой исход (в т.ч. отмена) считается ошибкой,
+        # чтобы пробный запрос в half-open всегда освобождал выключатель
+        available = False
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    # Экспоненциальная задержка с полным случайным разбросом
+                    await asyncio.sleep(random.uniform(0, min(5.0, 0.2 * 2 ** attempt)))
+                try:
+                    async with self._get_session().request(method, url, **kwargs) as response:
+                        if response.status >= 500 or response.status == 429:
+                            raise _RetryableError(f"HTTP {response.status}")
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError as e:
+                            raise PaypalychError(f"PayPalych {path}: некорректный JSON: {e}") from e
+                        if not isinstance(data, dict):
+                            raise PaypalychError(f"PayPalych {path}: неожиданный ответ {data!r}")
+                        available = True
+                        if response.status >= 400 or not data.get("success", True):
+                            # Ошибка запроса: повтор не поможет, провайдер при этом доступен
+                            raise PaypalychError(f"PayPalych {path}: HTTP {response.status} {data}")
+                        return data
+                except (_RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    last_error = e
+                    logger.warning(f"PayPalych {path}: попытка {attempt + 1} не удалась: {e!r}")
+            raise PaypalychError(f"PayPalych {path}: запрос не выполнен: {last_error!r}")
+        finally:
+            if available:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    async def create_bill(self, amount: float, order_id: str, description: str,
+                          currency: str = "RUB", custom: str = "") -> dict:
+        """
+        Создает счет. Возвращает {'bill_id': str, 'payment_url': str}
+        """
+        return await self._request("POST", "bill/create", parse=_parse_bill, data={
+            "amount": f"{amount:.2f}",
+            "order_id": order_id,
+            "description": description,
+            "type": "normal",
+            "shop_id": self.shop_id or "",
+            "currency_in": currency,
+            "custom": custom,
+        })
+
+    async def bill_status(self, bill_id: str) -> str:
+        """
+        Статус одного счета во внутренних обозначениях
+        """
+        data = await self._request("GET", "bill/status", params={"id": bill_id})
+        return BILL_STATUS_MAP.get(str(data.get("status", "")).upper(), "pending")
+
+    async def bills_status(self, bill_ids, since: str) -> dict:
+        """
+        Статусы многих счетов одним запросом поиска (с постраничной выборкой).
+        Счета, не найденные в выдаче, проверяются поштучно.
+        """
+        wanted = set(bill_ids)
+        statuses = {}
+        page = 1
+        while wanted - statuses.keys():
+            bills, last_page = await self._request("GET", "bill/search", parse=_parse_search_page, params={
+                "start_date": since[:19].replace("T", " "),
+                "shop_id": self.shop_id or "",
+                "per_page": 500,
+                "page": page,
+            })
+            for bill_id, status in bills:
+                if bill_id in wanted:
+                    statuses[bill_id] = status
+            if last_page is None or page >= last_page:
+                break
+            page += 1
+        missing = list(wanted - statuses.keys())
+        if missing:
+            results = await asyncio.gather(*(self.bill_status(bill_id) for bill_id in missing),
+                                           return_exceptions=True)
+            for bill_id, status in zip(missing, results):
+                if isinstance(status, str):
+                    statuses[bill_id] = status
+        return statuses
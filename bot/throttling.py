@@ -0,0 +1,152 @@
+"""
+Ограничение частоты сообщений от одного пользователя.
+
+Каждое сообщение и нажатие кнопки проходит через две корзины токенов: общую
+корзину пользователя и корзину команды (/buy, /renew и /config создают
+платежи или отправляют файлы, поэтому лимиты для них строже, сообщения без
+команды - это проверка оплаты в состоянии waiting_for_payment). Сообщения
+сверх лимита отбрасываются до обработчиков и не создают нагрузку на базу
+данных и PayPalych; о превышении пользователь получает одно предупреждение.
+
+Корзины хранятся в OrderedDict в порядке последнего использования: с начала
+удаляются заполненные (неотличимые от новых) корзины и корзины сверх
+THROTTLE_MAX_BUCKETS, поэтому память зависит от числа активных пользователей.
+"""
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from aiogram import BaseMiddleware, types
+from bot.notifier import TokenBucket
+from bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит на пользователя (сообщений в секунду) и допустимый всплеск
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5"))
+# Лимиты команд: "команда=сообщений_в_секунду:всплеск,..."; message - сообщения без команды
+THROTTLE_COMMAND_LIMITS = os.getenv(
+    "THROTTLE_COMMAND_LIMITS", "buy=0.1:2,renew=0.1:2,config=0.05:2,message=0.2:3"
+)
+# Максимальное число хранимых корзин
+THROTTLE_MAX_BUCKETS = int(os.getenv("THROTTLE_MAX_BUCKETS", "100000"))
+
+THROTTLED = metrics.counter("bot_throttled_total", "Сообщения, отброшенные ограничением частоты", ("bucket",))
+
+
+def parse_limits(value: str) -> dict:
+    """
+    "buy=0.1:2,renew=0.1:2" -> {'buy': (0.1, 2.0), 'renew': (0.1, 2.0)}
+    """
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, limit = item.partition("=")
+        rate, _, burst = limit.partition(":")
+        limits[name.strip().lower()] = (float(rate), float(burst or 1))
+    return limits
+
+
+def command_of(event) -> str:
+    """
+    Имя корзины для события: команда без / и @имени_бота, message или callback
+    """
+    if isinstance(event, types.CallbackQuery):
+        return "callback"
+    text = event.text or event.caption or ""
+    if text.startswith("/"):
+        return text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() if len(text) > 1 else "message"
+    return "message"
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware наблюдателей message и callback_query
+    """
+
+    def __init__(self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST,
+                 command_limits: dict = None, max_buckets: int = THROTTLE_MAX_BUCKETS,
+                 exempt=()):
+        self.rate = rate
+        self.burst = burst
+        self.command_limits = parse_limits(THROTTLE_COMMAND_LIMITS) if command_limits is None else command_limits
+        self.max_buckets = max_buckets
+        # Пользователи без ограничений (администратор)
+        self.exempt = set(exempt)
+        # {(user_id, имя корзины): TokenBucket}; имя None - общая корзина пользователя
+        self._buckets = OrderedDict()
+        # Пользователи, уже предупрежденные о превышении лимита
+        self._warned = set()
+        self.throttled = 0
+
+    @property
+    def size(self) -> int:
+        return len(self._buckets)
+
+    def _bucket(self, key, rate: float, burst: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_buckets and not bucket.full:
+                break
+            del self._buckets[key]
+            if key[1] is None:
+                self._warned.discard(key[0])
+
+    def check(self, user_id: int, command: str, now: float = None) -> float:
+        """
+        Расходует токены пользователя и команды. Возвращает 0, если событие
+        разрешено, иначе через сколько секунд можно повторить.
+        """
+        now = time.monotonic() if now is None else now
+        buckets = [self._bucket((user_id, None), self.rate, self.burst)]
+        limit = self.command_limits.get(command)
+        if limit is not None:
+            buckets.append(self._bucket((user_id, command), *limit))
+        wait = max(bucket.delay(now) for bucket in buckets)
+        if wait <= 0:
+            for bucket in buckets:
+                bucket.take()
+        self._evict()
+        return wait
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        command = command_of(event)
+        wait = self.check(user.id, command)
+        if wait <= 0:
+            self._warned.discard(user.id)
+            return await handler(event, data)
+
+        self.throttled += 1
+        THROTTLED.labels(command if command in self.command_limits else "user").inc()
+        if user.id not in self._warned:
+            # Предупреждаем один раз, дальнейшие сообщения отбрасываются молча
+            self._warned.add(user.id)
+            text = f"Слишком много запросов. Повторите через {math.ceil(wait)} с."
+            try:
+                # Для кнопки - всплывающее уведомление, для сообщения - ответ в чат
+                await event.answer(text)
+            except Exception as e:
+                logger.debug(f"Не удалось отправить предупреждение пользователю {user.id}: {e}")
+        return None
+
+
+def setup_throttling(dp, exempt=()) -> ThrottlingMiddleware:
+    middleware = ThrottlingMiddleware(exempt=exempt)
+    dp.message.outer_middleware(middleware)
+    dp.callback_query.outer_middleware(middleware)
+    return middleware
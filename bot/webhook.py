@@ -0,0 +1,175 @@
+"""
+Режим webhook: прием обновлений Telegram через aiohttp и их параллельная обработка.
+
+Обновления разных чатов обрабатываются одновременно (не более UPDATE_WORKERS сразу),
+обновления одного чата - строго по порядку поступления. При остановке сервер
+закрывает порт (новые запросы уходят другим процессам или повторяются Telegram)
+и дожидается обработки уже принятых обновлений.
+"""
+import asyncio
+import hmac
+import logging
+import os
+from collections import deque
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from dotenv import load_dotenv
+from bot import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес бота, например https://bot.example.com
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Максимальное число одновременно обрабатываемых обновлений
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))
+# Максимальное время ожидания обработки принятых обновлений при остановке (секунды)
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+
+def _chat_key(update: Update):
+    """
+    Ключ упорядочивания: чат (или пользователь) обновления
+    """
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        message = getattr(event, "message", None)
+        chat = getattr(message, "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+class ConcurrentUpdateProcessor:
+    """
+    Параллельная обработка обновлений с сохранением порядка внутри чата
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = UPDATE_WORKERS):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self._semaphore = asyncio.Semaphore(workers)
+        # Очереди обновлений по чатам; для каждой непустой очереди работает одна задача
+        self._queues = {}
+        self._tasks = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.accepting = True
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, update: Update) -> bool:
+        """
+        Ставит обновление в очередь его чата. Возвращает False, если прием остановлен.
+        """
+        if not self.accepting:
+            return False
+        key = _chat_key(update)
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return True
+        self._queues[key] = deque([update])
+        self._idle.clear()
+        task = asyncio.get_running_loop().create_task(self._drain_chat(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _drain_chat(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                update = queue[0]
+                async with self._semaphore:
+                    try:
+                        await self.dp.feed_update(self.bot, update)
+                        self.processed += 1
+                    except Exception as e:
+                        self.failed += 1
+                        logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}", exc_info=True)
+                queue.popleft()
+        finally:
+            del self._queues[key]
+            if not self._queues:
+                self._idle.set()
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """
+        Прекращает прием и дожидается обработки уже принятых обновлений
+        """
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Webhook: не дождались обработки {self.pending} обновлений")
+
+
+def setup_telegram_webhook(app: web.Application, processor: ConcurrentUpdateProcessor,
+                           path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET):
+    """
+    Регистрирует обработчик webhook Telegram в приложении aiohttp
+    """
+
+    async def handle_update(request: web.Request):
+        if secret and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret
+        ):
+            return web.Response(status=401)
+        if not processor.accepting:
+            # Telegram повторит доставку после перезапуска
+            return web.Response(status=503)
+        update = Update.model_validate(await request.json(), context={"bot": processor.bot})
+        processor.submit(update)
+        return web.Response()
+
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, app: web.Application, start_server,
+                      base_url: str = WEBHOOK_BASE_URL, path: str = WEBHOOK_PATH,
+                      secret: str = WEBHOOK_SECRET, workers: int = UPDATE_WORKERS,
+                      stop: asyncio.Event = None):
+    """
+    Запускает бота в режиме webhook и работает до отмены или до установки stop.
+    start_server(app) запускает HTTP-сервер и возвращает AppRunner.
+    """
+    processor = ConcurrentUpdateProcessor(dp, bot, workers)
+    metrics.gauge(
+        "bot_webhook_pending_updates", "Обновления в очередях чатов", lambda: processor.pending
+    )
+    setup_telegram_webhook(app, processor, path, secret)
+    runner = await start_server(app)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    await bot.set_webhook(
+        f"{base_url.rstrip('/')}{path}",
+        secret_token=secret or None,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"Webhook установлен: {base_url.rstrip('/')}{path}, обработчиков: {workers}")
+    try:
+        await (stop or asyncio.Event()).wait()
+    finally:
+        # Сначала прекращаем прием запросов, затем дожидаемся обработки принятых
+        processor.accepting = False
+        for site in list(runner.sites):
+            await site.stop()
+        await processor.drain()
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
@@ -0,0 +1,448 @@
+"""
+Асинхронный доступ к базе данных для обработчиков бота.
+
+Запросы выполняются в небольшом пуле выделенных потоков, у каждого из которых
+есть свое постоянное соединение SQLite, поэтому цикл событий не блокируется.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from db import database
+from db.metrics import counter, histogram
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+DB_QUERY_SECONDS = histogram("db_query_seconds", "Время выполнения функции базы данных", ("query",))
+DB_QUERY_ERRORS = counter("db_query_errors_total", "Ошибки функций базы данных", ("query",))
+DB_POOL_WAIT_SECONDS = histogram("db_pool_wait_seconds", "Ожидание свободного потока базы данных")
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+def _timed_call(submitted: float, func, args):
+    """
+    Вызов в потоке базы данных с учетом ожидания свободного потока и времени выполнения
+    """
+    started = time.perf_counter()
+    DB_POOL_WAIT_SECONDS.observe(started - submitted)
+    try:
+        return func(*args)
+    except Exception:
+        DB_QUERY_ERRORS.labels(func.__name__).inc()
+        raise
+    finally:
+        DB_QUERY_SECONDS.labels(func.__name__).observe(time.perf_counter() - started)
+
+async def run_in_db(func, *args):
+    """
+    Выполняет синхронную функцию работы с БД в пуле потоков базы данных
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _timed_call, time.perf_counter(), func, args)
+
+async def init_db():
+    """
+    Создает таблицы и применяет миграции схемы
+    """
+    return await run_in_db(database.init_db)
+
+async def get_user(user_id: int):
+    """
+    Получает информацию о пользователе по его ID
+    """
+    return await run_in_db(database.get_user, user_id)
+
+async def create_user(user_id: int, end_date):
+    """
+    Создает нового пользователя
+    """
+    return await run_in_db(database.create_user, user_id, end_date)
+
+async def update_subscription(user_id: int, new_end_date):
+    """
+    Обновляет дату окончания подписки пользователя
+    """
+    return await run_in_db(database.update_subscription, user_id, new_end_date)
+
+async def get_active_users():
+    """
+    Получает список всех активных пользователей
+    """
+    return await run_in_db(database.get_active_users)
+
+async def get_users_expiring_before(until):
+    """
+    Возвращает (user_id, end_ts) пользователей, чья подписка заканчивается не позже until
+    (ISO-дата или секунды Unix)
+    """
+    return await run_in_db(database.get_users_expiring_before, until)
+
+async def expire_users(user_ids, now=None):
+    """
+    Сбрасывает истекшие подписки одной транзакцией
+    """
+    return await run_in_db(database.expire_users, list(user_ids), now)
+
+async def save_user_v2ray_id(user_id: int, v2ray_id: str):
+    """
+    Сохраняет v2ray ID пользователя и возвращает прежний
+    """
+    return await run_in_db(database.save_user_v2ray_id, user_id, v2ray_id)
+
+async def get_users_with_v2ray_id():
+    """
+    Пользователи с выданным v2ray ID: [(user_id, v2ray_id, end_date, node_id)]
+    """
+    return await run_in_db(database.get_users_with_v2ray_id)
+
+async def get_telegram_file_id(artifact_key: str):
+    """
+    file_id Telegram для ранее загруженного файла
+    """
+    return await run_in_db(database.get_telegram_file_id, artifact_key)
+
+async def save_telegram_file_id(artifact_key: str, v2ray_id: str, file_id: str):
+    """
+    Запоминает (или удаляет при file_id=None) file_id Telegram для файла
+    """
+    return await run_in_db(database.save_telegram_file_id, artifact_key, v2ray_id, file_id)
+
+async def get_user_v2ray_id(user_id: int):
+    """
+    Получает v2ray ID пользователя
+    """
+    return await run_in_db(database.get_user_v2ray_id, user_id)
+
+async def create_payment(payment_id: str, user_id: int, amount: float, currency: str,
+                         description: str = None, payment_url: str = None, provider_id: str = None):
+    """
+    Сохраняет новый платеж в статусе pending
+    """
+    return await run_in_db(database.create_payment, payment_id, user_id, amount, currency,
+                           description, payment_url, provider_id)
+
+async def get_payment(payment_id: str):
+    """
+    Получает платеж по его ID
+    """
+    return await run_in_db(database.get_payment, payment_id)
+
+async def get_pending_payments(limit: int = 1000):
+    """
+    Неоплаченные платежи, ожидающие подтверждения от провайдера
+    """
+    return await run_in_db(database.get_pending_payments, limit)
+
+async def get_reusable_payment(user_id: int, amount: float, currency: str, created_after: str):
+    """
+    Неоплаченный платеж пользователя, ссылку которого можно выдать повторно
+    """
+    return await run_in_db(database.get_reusable_payment, user_id, amount, currency, created_after)
+
+async def set_payment_status(payment_id: str, status: str):
+    """
+    Переводит платеж из pending в новый статус
+    """
+    return await run_in_db(database.set_payment_status, payment_id, status)
+
+async def apply_payment(payment_id: str, days: int = 30):
+    """
+    Продлевает подписку по завершенному платежу ровно один раз
+    """
+    return await run_in_db(database.apply_payment, payment_id, days)
+
+async def mark_payment_provisioned(payment_id: str):
+    """
+    Отмечает, что доступ по платежу выдан
+    """
+    return await run_in_db(database.mark_payment_provisioned, payment_id)
+
+async def get_unprovisioned_payments():
+    """
+    Оплаченные платежи, по которым доступ еще не выдан
+    """
+    return await run_in_db(database.get_unprovisioned_payments)
+
+async def expire_pending_payments(older_than: str):
+    """
+    Переводит давно созданные неоплаченные платежи в статус expired
+    """
+    return await run_in_db(database.expire_pending_payments, older_than)
+
+async def prune_payments(older_than: str):
+    """
+    Удаляет старые завершенные записи платежей
+    """
+    return await run_in_db(database.prune_payments, older_than)
+
+async def enqueue_notifications(rows):
+    """
+    Ставит уведомления [(chat_id, text, kind)] в очередь отправки
+    """
+    return await run_in_db(database.enqueue_notifications, rows)
+
+async def fetch_due_notifications(now: float, limit: int = 100):
+    """
+    Уведомления, время отправки которых наступило
+    """
+    return await run_in_db(database.fetch_due_notifications, now, limit)
+
+async def get_next_notification_time():
+    """
+    Ближайшее время отправки среди ожидающих уведомлений
+    """
+    return await run_in_db(database.get_next_notification_time)
+
+async def save_notification_results(sent, retries, failures):
+    """
+    Сохраняет результаты отправки пакета уведомлений
+    """
+    return await run_in_db(database.save_notification_results, sent, retries, failures)
+
+async def get_outbox_stats():
+    """
+    Количество уведомлений по статусам
+    """
+    return await run_in_db(database.get_outbox_stats)
+
+async def prune_outbox(created_before: float):
+    """
+    Удаляет старые обработанные уведомления
+    """
+    return await run_in_db(database.prune_outbox, created_before)
+
+async def get_all_user_ids():
+    """
+    ID всех пользователей
+    """
+    return await run_in_db(database.get_all_user_ids)
+
+async def unblock_chat(chat_id: int):
+    """
+    Снимает отметку о блокировке бота пользователем
+    """
+    return await run_in_db(database.unblock_chat, chat_id)
+
+async def get_nodes():
+    """
+    Все узлы V2Ray
+    """
+    return await run_in_db(database.get_nodes)
+
+async def upsert_node(node_id: str, address: str, port: int, api_address: str = None,
+                      config_path: str = None, capacity: int = 1000, status: str = None):
+    """
+    Добавляет или обновляет узел V2Ray
+    """
+    return await run_in_db(database.upsert_node, node_id, address, port, api_address,
+                           config_path, capacity, status)
+
+async def set_node_status(node_id: str, status: str):
+    """
+    Меняет статус узла V2Ray
+    """
+    return await run_in_db(database.set_node_status, node_id, status)
+
+async def get_node_loads():
+    """
+    Количество активных пользователей по узлам
+    """
+    return await run_in_db(database.get_node_loads)
+
+async def assign_user_node(user_id: int, node_id: str):
+    """
+    Назначает пользователю узел V2Ray
+    """
+    return await run_in_db(database.assign_user_node, user_id, node_id)
+
+async def get_node_users(node_id: str, limit: int = None):
+    """
+    Пользователи с активной подпиской на узле
+    """
+    return await run_in_db(database.get_node_users, node_id, limit)
+
+async def record_traffic(rows):
+    """
+    Добавляет прирост трафика [(user_id, ts, uplink, downlink)] одной транзакцией
+    """
+    return await run_in_db(database.record_traffic, rows)
+
+async def rollup_traffic(now: float, minute_retention: float, hour_retention: float, day_retention: float):
+    """
+    Переносит старые записи трафика на более грубый уровень детализации
+    """
+    return await run_in_db(database.rollup_traffic, now, minute_retention, hour_retention, day_retention)
+
+async def get_user_traffic(user_id: int, since: float):
+    """
+    Трафик пользователя с момента since: (uplink, downlink)
+    """
+    return await run_in_db(database.get_user_traffic, user_id, since)
+
+async def get_top_traffic(since: float, limit: int = 10):
+    """
+    Пользователи с наибольшим трафиком с момента since
+    """
+    return await run_in_db(database.get_top_traffic, since, limit)
+
+async def get_all_users():
+    """
+    Все пользователи: [(user_id, v2ray_id, end_date, node_id)]
+    """
+    return await run_in_db(database.get_all_users)
+
+async def export_users(active_only: bool = False):
+    """
+    Пользователи для выгрузки
+    """
+    return await run_in_db(database.export_users, active_only)
+
+async def import_users(rows):
+    """
+    Добавляет или обновляет пользователей одной транзакцией
+    """
+    return await run_in_db(database.import_users, rows)
+
+async def extend_users(user_ids, days: int):
+    """
+    Продлевает подписку пользователям на days дней одной транзакцией
+    """
+    return await run_in_db(database.extend_users, user_ids, days)
+
+async def cancel_subscriptions(user_ids):
+    """
+    Досрочно завершает подписку пользователям одной транзакцией
+    """
+    return await run_in_db(database.cancel_subscriptions, user_ids)
+
+async def save_users_v2ray_ids(rows):
+    """
+    Сохраняет v2ray ID пользователей одной транзакцией
+    """
+    return await run_in_db(database.save_users_v2ray_ids, rows)
+
+async def assign_users_nodes(rows):
+    """
+    Назначает узлы пользователям одной транзакцией
+    """
+    return await run_in_db(database.assign_users_nodes, rows)
+
+async def enqueue_job(kind: str, job_key: str, payload: dict):
+    """
+    Ставит задачу в очередь (идемпотентно по job_key)
+    """
+    return await run_in_db(database.enqueue_job, kind, job_key, payload)
+
+async def claim_jobs(now: float, limit: int, lease: float):
+    """
+    Забирает задачи, готовые к выполнению
+    """
+    return await run_in_db(database.claim_jobs, now, limit, lease)
+
+async def finish_job(job_id: int, status: str, attempts: int, next_attempt_at: float = None, error: str = None):
+    """
+    Сохраняет результат выполнения задачи
+    """
+    return await run_in_db(database.finish_job, job_id, status, attempts, next_attempt_at, error)
+
+async def get_next_job_time():
+    """
+    Ближайшее время выполнения задачи или None
+    """
+    return await run_in_db(database.get_next_job_time)
+
+async def get_job_stats():
+    """
+    Количество задач по статусам
+    """
+    return await run_in_db(database.get_job_stats)
+
+async def get_dead_jobs(limit: int = 20):
+    """
+    Задачи, исчерпавшие попытки
+    """
+    return await run_in_db(database.get_dead_jobs, limit)
+
+async def retry_dead_job(job_id: int):
+    """
+    Возвращает неудачную задачу в очередь
+    """
+    return await run_in_db(database.retry_dead_job, job_id)
+
+async def prune_jobs(updated_before: float):
+    """
+    Удаляет старые выполненные задачи
+    """
+    return await run_in_db(database.prune_jobs, updated_before)
+
+async def acquire_lease(name: str, holder: str, ttl: float):
+    """
+    Захватывает или продлевает аренду; возвращает fencing token или None
+    """
+    return await run_in_db(database.acquire_lease, name, holder, ttl)
+
+async def release_lease(name: str, holder: str):
+    """
+    Освобождает аренду
+    """
+    return await run_in_db(database.release_lease, name, holder)
+
+async def get_lease(name: str):
+    """
+    Текущее состояние аренды
+    """
+    return await run_in_db(database.get_lease, name)
+
+async def get_stats(now: float, days: int = 7):
+    """
+    Статистика для администратора из счетчиков
+    """
+    return await run_in_db(database.get_stats, now, days)
+
+async def rebuild_stats():
+    """
+    Пересчитывает счетчики статистики
+    """
+    return await run_in_db(database.rebuild_stats)
+
+async def get_log_cursor(path: str):
+    """
+    Сохраненная позиция чтения журнала
+    """
+    return await run_in_db(database.get_log_cursor, path)
+
+async def save_log_cursor(path: str, inode: int, position: int):
+    """
+    Сохраняет позицию чтения журнала
+    """
+    return await run_in_db(database.save_log_cursor, path, inode, position)
+
+async def suspend_user(user_id: int, devices: int, until: float):
+    """
+    Временная блокировка за превышение числа устройств
+    """
+    return await run_in_db(database.suspend_user, user_id, devices, until)
+
+async def get_due_suspensions(now: float):
+    """
+    Пользователи, срок блокировки которых закончился
+    """
+    return await run_in_db(database.get_due_suspensions, now)
+
+async def get_suspension(user_id: int):
+    """
+    Время окончания блокировки пользователя или None
+    """
+    return await run_in_db(database.get_suspension, user_id)
+
+async def get_suspensions():
+    """
+    Действующие блокировки
+    """
+    return await run_in_db(database.get_suspensions)
+
+async def lift_suspension(user_id: int):
+    """
+    Снимает блокировку пользователя и ставит задачу restore
+    """
+    return await run_in_db(database.lift_suspension, user_id)
@@ -0,0 +1,94 @@
+"""
+Ограниченный LRU-кэш с TTL для записей пользователей
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением размера и временем жизни записей
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Счетчик инвалидаций: запись, прочитанная до инвалидации, не попадет в кэш
+        self.generation = 0
+
+    def get(self, key, default=_MISSING):
+        """
+        Возвращает значение из кэша или default (по умолчанию - маркер отсутствия)
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation: int = None):
+        with self._lock:
+            if self.maxsize <= 0 or (generation is not None and generation != self.generation):
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def disable(self):
+        """
+        Отключает кэш: базу изменяют несколько процессов, и записи одного процесса
+        не узнают об изменениях, сделанных другим
+        """
+        with self._lock:
+            self.maxsize = 0
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+    @staticmethod
+    def is_missing(value) -> bool:
+        return value is _MISSING
+
+
+# Кэш записей пользователей по user_id (None кэшируется для незарегистрированных)
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
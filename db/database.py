@@ -1,135 +1,1197 @@
+import json
 import sqlite3
 import os
+import threading
+import time
 from datetime import datetime
 from contextlib import contextmanager
+from dotenv import load_dotenv
+from db.cache import user_cache
+from db import migrations
 
-DATABASE_PATH = "vpn.db"
+load_dotenv()
+
+DATABASE_PATH = os.getenv("DATABASE_PATH", "vpn.db")
+
+# Размер кэша подготовленных выражений на одно соединение
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+def _configure_connection(conn: sqlite3.Connection):
+    """
+    Настраивает соединение: WAL, умеренная синхронизация и ожидание блокировок
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")
+    conn.execute("PRAGMA foreign_keys=ON")
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Возвращает долгоживущее соединение текущего потока.
+    Соединение создается один раз на поток и переиспользуется всеми запросами,
+    поэтому подготовленные выражения берутся из кэша sqlite3.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != DATABASE_PATH:
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(DATABASE_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+        _configure_connection(conn)
+        _local.conn = conn
+        _local.path = DATABASE_PATH
+    return conn
+
+def close_connection():
+    """
+    Закрывает соединение текущего потока
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
 
 @contextmanager
 def get_db_connection():
     """
-    Контекстный менеджер для подключения к базе данных
+    Контекстный менеджер для подключения к базе данных.
+    Выдает постоянное соединение потока; при ошибке откатывает незавершенную транзакцию.
     """
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     try:
         yield conn
-    finally:
-        conn.close()
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+# Столбцы users в порядке _row_to_user (сроки подписки - секунды Unix)
+USER_COLUMNS = "user_id, start_ts, end_ts, v2ray_id, created_at, node_id"
+
+def _to_ts(value):
+    """
+    Дата подписки (ISO-строка, datetime или секунды Unix) -> целые секунды Unix
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp())
+
+def _to_iso(ts):
+    """
+    Секунды Unix -> ISO-строка локального времени (формат дат в обработчиках)
+    """
+    return datetime.fromtimestamp(ts).isoformat() if ts is not None else None
+
+def _row_to_user(row):
+    return {
+        'user_id': row[0],
+        'start_date': _to_iso(row[1]),
+        'end_date': _to_iso(row[2]),
+        'v2ray_id': row[3],
+        'created_at': row[4],
+        'node_id': row[5]
+    }
+
+def _record_subscriptions(conn, rows):
+    """
+    Добавляет записи в историю подписок в текущей транзакции:
+    rows - [(user_id, kind, payment_id, start_ts, end_ts[, amount, currency])]
+    """
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO subscriptions (user_id, kind, payment_id, start_ts, end_ts, amount, currency, created_ts) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(row if len(row) == 7 else row + (None, None)) + (now,) for row in rows]
+    )
 
 def init_db():
     """
-    Инициализирует базу данных и создает таблицы
+    Создает таблицы и применяет миграции схемы (db/migrations.py).
+    Вызывается явно при запуске бота и служебных команд.
     """
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Создаем таблицу пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                start_date TEXT,
-                end_date TEXT,
-                v2ray_id TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
+        return migrations.migrate(conn)
 
 def get_user(user_id: int):
     """
-    Получает информацию о пользователе по его ID
+    Получает информацию о пользователе по его ID (через кэш)
     """
+    cached = user_cache.get(user_id)
+    if not user_cache.is_missing(cached):
+        return dict(cached) if cached else None
+    
+    generation = user_cache.generation
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,))
         row = cursor.fetchone()
         
-        if row:
-            return {
-                'user_id': row[0],
-                'start_date': row[1],
-                'end_date': row[2],
-                'v2ray_id': row[3],
-                'created_at': row[4]
-            }
-        return None
+    user = _row_to_user(row) if row else None
+    user_cache.set(user_id, user, generation)
+    return dict(user) if user else None
 
-def create_user(user_id: int, end_date: str):
+def get_user_cache_stats():
     """
-    Создает нового пользователя
+    Возвращает счетчики попаданий и промахов кэша пользователей
     """
-    start_date = datetime.now().isoformat()
-    
+    return user_cache.stats()
+
+# Новая подписка начинается сейчас, продление действующей сохраняет начало
+_UPSERT_USER_END = (
+    "INSERT INTO users (user_id, start_ts, end_ts) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET "
+    "start_ts = CASE WHEN users.end_ts IS NULL OR users.end_ts <= excluded.start_ts "
+    "THEN excluded.start_ts ELSE users.start_ts END, "
+    "end_ts = excluded.end_ts"
+)
+
+def create_user(user_id: int, end_date):
+    """
+    Создает пользователя или задает срок подписки существующему
+    (v2ray ID, узел и дата регистрации сохраняются)
+    """
+    now = int(time.time())
+    end_ts = _to_ts(end_date)
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT OR REPLACE INTO users (user_id, start_date, end_date) VALUES (?, ?, ?)",
-            (user_id, start_date, end_date)
-        )
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(_UPSERT_USER_END, (user_id, now, end_ts))
+        _record_subscriptions(conn, [(user_id, "manual", None, now, end_ts)])
         conn.commit()
+    user_cache.invalidate(user_id)
 
-def update_subscription(user_id: int, new_end_date: str):
+def update_subscription(user_id: int, new_end_date):
     """
     Обновляет дату окончания подписки пользователя
     """
+    end_ts = _to_ts(new_end_date)
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET end_date = ? WHERE user_id = ?",
-            (new_end_date, user_id)
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute(
+            "UPDATE users SET end_ts = ? WHERE user_id = ?",
+            (end_ts, user_id)
         )
+        if cursor.rowcount:
+            _record_subscriptions(conn, [(user_id, "manual", None, int(time.time()), end_ts)])
         conn.commit()
+    user_cache.invalidate(user_id)
 
 def get_active_users():
     """
     Получает список всех активных пользователей
     """
-    current_time = datetime.now().isoformat()
-    
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE end_ts > ?",
+            (int(time.time()),)
+        ).fetchall()
+        return [_row_to_user(row) for row in rows]
+
+def get_all_users():
+    """
+    Все пользователи: [(user_id, v2ray_id, end_date, node_id)]
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT user_id, v2ray_id, end_ts, node_id FROM users").fetchall()
+    return [(user_id, v2ray_id, _to_iso(end_ts), node_id) for user_id, v2ray_id, end_ts, node_id in rows]
+
+def export_users(active_only: bool = False):
+    """
+    Пользователи для выгрузки (словари в формате get_user)
+    """
+    query = f"SELECT {USER_COLUMNS} FROM users"
+    params = ()
+    if active_only:
+        query += " WHERE end_ts > ?"
+        params = (int(time.time()),)
+    with get_db_connection() as conn:
+        return [_row_to_user(row) for row in conn.execute(query + " ORDER BY user_id", params)]
+
+def import_users(rows):
+    """
+    Добавляет или обновляет пользователей одной транзакцией.
+    rows: [(user_id, end_date, v2ray_id, node_id)]; пустые значения не затирают
+    сохраненные.
+    """
+    now = int(time.time())
+    rows = [(user_id, _to_ts(end_date), v2ray_id, node_id) for user_id, end_date, v2ray_id, node_id in rows]
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO users (user_id, start_ts, end_ts, v2ray_id, node_id) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET end_ts = COALESCE(excluded.end_ts, users.end_ts), "
+            "v2ray_id = COALESCE(excluded.v2ray_id, users.v2ray_id), "
+            "node_id = COALESCE(excluded.node_id, users.node_id)",
+            [(user_id, now, end_ts, v2ray_id, node_id) for user_id, end_ts, v2ray_id, node_id in rows]
+        )
+        _record_subscriptions(conn, [
+            (user_id, "import", None, now, end_ts) for user_id, end_ts, _, _ in rows if end_ts is not None
+        ])
+        conn.commit()
+    user_cache.clear()
+    return len(rows)
+
+def extend_users(user_ids, days: int):
+    """
+    Продлевает подписку пользователям на days дней от текущей даты окончания
+    (или от текущего момента, если подписка истекла) одной транзакцией.
+    Отсутствующие пользователи создаются. Возвращает количество обновленных.
+    """
+    now = int(time.time())
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM users WHERE end_date IS NOT NULL AND end_date > ?",
-            (current_time,)
+        cursor.execute("BEGIN IMMEDIATE")
+        current = {}
+        for chunk_start in range(0, len(user_ids), 500):
+            chunk = user_ids[chunk_start:chunk_start + 500]
+            current.update(cursor.execute(
+                "SELECT user_id, end_ts FROM users WHERE user_id IN (%s)" % ",".join("?" * len(chunk)),
+                chunk
+            ).fetchall())
+        rows = []
+        for user_id in user_ids:
+            base = max(current.get(user_id) or now, now)
+            rows.append((user_id, now, base + days * 86400))
+        cursor.executemany(_UPSERT_USER_END, rows)
+        _record_subscriptions(conn, [
+            (user_id, "extend", None, max(current.get(user_id) or now, now), end_ts)
+            for user_id, _, end_ts in rows
+        ])
+        conn.commit()
+    user_cache.clear()
+    return len(rows)
+
+def cancel_subscriptions(user_ids):
+    """
+    Досрочно завершает подписку пользователям одной транзакцией
+    """
+    cancelled = []
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for user_id in user_ids:
+            row = conn.execute(
+                "SELECT start_ts, end_ts FROM users WHERE user_id = ? AND end_ts IS NOT NULL", (user_id,)
+            ).fetchone()
+            if row is not None:
+                cancelled.append((user_id, "cancel", None) + row)
+        # end_date очищается, чтобы незавершенный перенос дат (миграция 2) не восстановил срок
+        conn.executemany(
+            "UPDATE users SET end_ts = NULL, end_date = NULL WHERE user_id = ?",
+            [(row[0],) for row in cancelled]
         )
-        rows = cursor.fetchall()
-        
-        users = []
-        for row in rows:
-            users.append({
-                'user_id': row[0],
-                'start_date': row[1],
-                'end_date': row[2],
-                'v2ray_id': row[3],
-                'created_at': row[4]
-            })
-        return users
+        _record_subscriptions(conn, cancelled)
+        conn.commit()
+    user_cache.clear()
+    return len(cancelled)
+
+def save_users_v2ray_ids(rows):
+    """
+    Сохраняет v2ray ID пользователей одной транзакцией: rows - [(user_id, v2ray_id)]
+    """
+    with get_db_connection() as conn:
+        conn.executemany(
+            "UPDATE users SET v2ray_id = ? WHERE user_id = ?",
+            [(v2ray_id, user_id) for user_id, v2ray_id in rows]
+        )
+        conn.commit()
+    user_cache.clear()
+
+def assign_users_nodes(rows):
+    """
+    Назначает узлы пользователям одной транзакцией: rows - [(user_id, node_id)]
+    """
+    with get_db_connection() as conn:
+        conn.executemany(
+            "UPDATE users SET node_id = ? WHERE user_id = ?",
+            [(node_id, user_id) for user_id, node_id in rows]
+        )
+        conn.commit()
+    user_cache.clear()
+
+def get_users_with_v2ray_id():
+    """
+    Пользователи с выданным v2ray ID: [(user_id, v2ray_id, end_date, node_id)]
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT user_id, v2ray_id, end_ts, node_id FROM users WHERE v2ray_id IS NOT NULL"
+        ).fetchall()
+    return [(user_id, v2ray_id, _to_iso(end_ts), node_id) for user_id, v2ray_id, end_ts, node_id in rows]
+
+def get_users_expiring_before(until):
+    """
+    Возвращает (user_id, end_ts) пользователей, чья подписка заканчивается не позже until
+    (ISO-дата или секунды Unix). Выборка идет по индексу end_ts.
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT user_id, end_ts FROM users WHERE end_ts <= ? ORDER BY end_ts",
+            (_to_ts(until),)
+        ).fetchall()
+
+def expire_users(user_ids, now=None):
+    """
+    Сбрасывает подписку пользователям, у которых она действительно истекла к моменту now.
+    Выполняется одной транзакцией; возвращает список ID фактически отключенных пользователей.
+    """
+    now = _to_ts(now) if now is not None else int(time.time())
+    expired = []
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for user_id in user_ids:
+            row = conn.execute(
+                "SELECT start_ts, end_ts FROM users WHERE user_id = ? AND end_ts <= ?", (user_id, now)
+            ).fetchone()
+            if row is not None:
+                expired.append((user_id, "expire", None) + row)
+        conn.executemany(
+            "UPDATE users SET end_ts = NULL, end_date = NULL WHERE user_id = ?",
+            [(row[0],) for row in expired]
+        )
+        _record_subscriptions(conn, expired)
+        conn.commit()
+    expired = [row[0] for row in expired]
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+    return expired
 
 def save_user_v2ray_id(user_id: int, v2ray_id: str):
     """
-    Сохраняет v2ray ID пользователя
+    Сохраняет v2ray ID пользователя и возвращает прежний.
+    При смене ID удаляются file_id файлов, выданных для прежнего.
     """
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        row = cursor.execute("SELECT v2ray_id FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        previous = row[0] if row else None
         cursor.execute(
             "UPDATE users SET v2ray_id = ? WHERE user_id = ?",
             (v2ray_id, user_id)
         )
+        if previous and previous != v2ray_id:
+            cursor.execute("DELETE FROM telegram_files WHERE v2ray_id = ?", (previous,))
         conn.commit()
+    user_cache.invalidate(user_id)
+    return previous
 
 def get_user_v2ray_id(user_id: int):
     """
     Получает v2ray ID пользователя
     """
+    user = get_user(user_id)
+    return user['v2ray_id'] if user else None
+
+def _row_to_node(row):
+    return {
+        'node_id': row[0],
+        'address': row[1],
+        'port': row[2],
+        'api_address': row[3],
+        'config_path': row[4],
+        'capacity': row[5],
+        'status': row[6],
+        'created_at': row[7]
+    }
+
+def upsert_node(node_id: str, address: str, port: int, api_address: str = None,
+                config_path: str = None, capacity: int = 1000, status: str = None):
+    """
+    Добавляет узел V2Ray или обновляет его параметры (статус меняется, только если передан)
+    """
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT v2ray_id FROM users WHERE user_id = ?",
-            (user_id,)
+        conn.execute(
+            "INSERT INTO nodes (node_id, address, port, api_address, config_path, capacity, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, 'active'), ?) "
+            "ON CONFLICT(node_id) DO UPDATE SET address = excluded.address, port = excluded.port, "
+            "api_address = excluded.api_address, config_path = excluded.config_path, "
+            "capacity = excluded.capacity, status = COALESCE(?, nodes.status)",
+            (node_id, address, port, api_address, config_path, capacity, status,
+             datetime.now().isoformat(), status)
         )
-        row = cursor.fetchone()
+        conn.commit()
+
+def get_nodes():
+    """
+    Все узлы V2Ray
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT * FROM nodes ORDER BY created_at, node_id").fetchall()
+        return [_row_to_node(row) for row in rows]
+
+def set_node_status(node_id: str, status: str) -> bool:
+    """
+    Меняет статус узла: active, draining (новые пользователи не назначаются,
+    текущие переносятся) или disabled
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute("UPDATE nodes SET status = ? WHERE node_id = ?", (status, node_id))
+        conn.commit()
+        return cursor.rowcount > 0
+
+def get_node_loads():
+    """
+    Количество пользователей с активной подпиской на каждом узле: {node_id: count}
+    (из счетчиков stats_nodes)
+    """
+    with get_db_connection() as conn:
+        return dict(conn.execute(
+            "SELECT node_id, active FROM stats_nodes WHERE active > 0"
+        ).fetchall())
+
+def assign_user_node(user_id: int, node_id: str):
+    """
+    Назначает пользователю узел V2Ray
+    """
+    with get_db_connection() as conn:
+        conn.execute("UPDATE users SET node_id = ? WHERE user_id = ?", (node_id, user_id))
+        conn.commit()
+    user_cache.invalidate(user_id)
+
+def get_node_users(node_id: str, limit: int = None):
+    """
+    Пользователи с активной подпиской на узле: [(user_id, v2ray_id)]
+    (кроме временно заблокированных за превышение числа устройств)
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT user_id, v2ray_id FROM users "
+            "WHERE node_id = ? AND end_ts IS NOT NULL "
+            "AND user_id NOT IN (SELECT user_id FROM device_suspensions) ORDER BY user_id LIMIT ?",
+            (node_id, -1 if limit is None else limit)
+        ).fetchall()
+
+def get_telegram_file_id(artifact_key: str):
+    """
+    file_id Telegram для ранее загруженного файла или None
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT file_id FROM telegram_files WHERE artifact_key = ?", (artifact_key,)
+        ).fetchone()
         return row[0] if row else None
 
-# Инициализируем базу данных при импорте модуля
-init_db()
+def save_telegram_file_id(artifact_key: str, v2ray_id: str, file_id: str):
+    """
+    Запоминает file_id Telegram для файла (file_id=None - удаляет запись)
+    """
+    with get_db_connection() as conn:
+        if file_id is None:
+            conn.execute("DELETE FROM telegram_files WHERE artifact_key = ?", (artifact_key,))
+        else:
+            conn.execute(
+                "INSERT INTO telegram_files (artifact_key, v2ray_id, file_id, created_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(artifact_key) DO UPDATE SET file_id = excluded.file_id, created_at = excluded.created_at",
+                (artifact_key, v2ray_id, file_id, time.time())
+            )
+        conn.commit()
+
+# Конечные статусы платежа, после которых он больше не меняется у провайдера
+PAYMENT_TERMINAL_STATUSES = ('completed', 'failed', 'cancelled', 'expired')
+
+def _row_to_payment(row):
+    return {
+        'payment_id': row[0],
+        'user_id': row[1],
+        'amount': row[2],
+        'currency': row[3],
+        'description': row[4],
+        'payment_url': row[5],
+        'status': row[6],
+        'created_at': row[7],
+        'updated_at': row[8],
+        'applied_at': row[9],
+        'provisioned_at': row[10],
+        'provider_id': row[11]
+    }
+
+def create_payment(payment_id: str, user_id: int, amount: float, currency: str,
+                   description: str = None, payment_url: str = None, provider_id: str = None):
+    """
+    Сохраняет новый платеж в статусе pending
+    """
+    now = datetime.now().isoformat()
+    with get_db_connection() as conn:
+        conn.execute(
+            "INSERT INTO payments (payment_id, user_id, amount, currency, description, "
+            "payment_url, provider_id, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?)",
+            (payment_id, user_id, amount, currency, description, payment_url, provider_id, now, now)
+        )
+        conn.commit()
+
+def get_payment(payment_id: str):
+    """
+    Получает платеж по его ID
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM payments WHERE payment_id = ?", (payment_id,)
+        ).fetchone()
+        return _row_to_payment(row) if row else None
+
+def get_user_payments(user_id: int, limit: int = 20):
+    """
+    Последние платежи пользователя
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM payments WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        return [_row_to_payment(row) for row in rows]
+
+def get_pending_payments(limit: int = 1000):
+    """
+    Неоплаченные платежи, ожидающие подтверждения от провайдера
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM payments WHERE status = 'pending' ORDER BY updated_at LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [_row_to_payment(row) for row in rows]
+
+def get_reusable_payment(user_id: int, amount: float, currency: str, created_after: str):
+    """
+    Последний неоплаченный платеж пользователя на ту же сумму, созданный после
+    created_after (его ссылку можно выдать повторно вместо создания нового счета)
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM payments WHERE user_id = ? AND created_at > ? AND status = 'pending' "
+            "AND amount = ? AND currency = ? AND payment_url IS NOT NULL "
+            "ORDER BY created_at DESC LIMIT 1",
+            (user_id, created_after, amount, currency)
+        ).fetchone()
+        return _row_to_payment(row) if row else None
+
+def set_payment_status(payment_id: str, status: str) -> bool:
+    """
+    Переводит платеж из pending в новый статус.
+    Истекший счет провайдер еще может оплатить, поэтому expired -> completed тоже допускается.
+    Остальные конечные статусы не меняются; возвращает True, если переход выполнен.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "UPDATE payments SET status = ?, updated_at = ? WHERE payment_id = ? "
+            "AND (status = 'pending' OR (status = 'expired' AND ? = 'completed'))",
+            (status, datetime.now().isoformat(), payment_id, status)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+
+def apply_payment(payment_id: str, days: int = 30):
+    """
+    Продлевает подписку по завершенному платежу ровно один раз.
+    Отметка о применении платежа, продление и постановка задачи на выдачу
+    доступа (provision) выполняются в одной транзакции.
+    Возвращает (user_id, new_end_date) или None, если платеж уже применен или не оплачен.
+    """
+    now = datetime.now()
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute(
+            "UPDATE payments SET applied_at = ?, updated_at = ? "
+            "WHERE payment_id = ? AND status = 'completed' AND applied_at IS NULL",
+            (now.isoformat(), now.isoformat(), payment_id)
+        )
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return None
+
+        user_id, amount, currency = conn.execute(
+            "SELECT user_id, amount, currency FROM payments WHERE payment_id = ?", (payment_id,)
+        ).fetchone()
+        row = conn.execute(
+            "SELECT end_ts FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+        now_ts = int(now.timestamp())
+        period_start = max(row[0] or now_ts, now_ts) if row else now_ts
+        new_end = period_start + days * 86400
+        conn.execute(_UPSERT_USER_END, (user_id, now_ts, new_end))
+        _record_subscriptions(conn, [(user_id, "payment", payment_id, period_start, new_end, amount, currency)])
+        _insert_job(conn, "provision", f"provision:{payment_id}", {"payment_id": payment_id}, time.time())
+        conn.commit()
+    user_cache.invalidate(user_id)
+    return user_id, _to_iso(new_end)
+
+def mark_payment_provisioned(payment_id: str):
+    """
+    Отмечает, что доступ по платежу выдан
+    """
+    now = datetime.now().isoformat()
+    with get_db_connection() as conn:
+        conn.execute(
+            "UPDATE payments SET provisioned_at = ?, updated_at = ? WHERE payment_id = ?",
+            (now, now, payment_id)
+        )
+        conn.commit()
+
+def get_unprovisioned_payments():
+    """
+    Оплаченные платежи, по которым доступ еще не выдан (например, из-за перезапуска)
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM payments WHERE status = 'completed' AND provisioned_at IS NULL"
+        ).fetchall()
+        return [_row_to_payment(row) for row in rows]
+
+def expire_pending_payments(older_than: str) -> int:
+    """
+    Переводит давно созданные неоплаченные платежи в статус expired
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "UPDATE payments SET status = 'expired', updated_at = ? "
+            "WHERE status = 'pending' AND updated_at < ?",
+            (datetime.now().isoformat(), older_than)
+        )
+        conn.commit()
+        return cursor.rowcount
+
+def prune_payments(older_than: str) -> int:
+    """
+    Удаляет завершенные записи платежей старше older_than.
+    Оплаченные платежи удаляются только после выдачи доступа.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "DELETE FROM payments WHERE status IN ('failed', 'cancelled', 'expired') AND updated_at < ?",
+            (older_than,)
+        )
+        deleted = cursor.rowcount
+        cursor = conn.execute(
+            "DELETE FROM payments WHERE status = 'completed' AND provisioned_at IS NOT NULL "
+            "AND updated_at < ?",
+            (older_than,)
+        )
+        deleted += cursor.rowcount
+        conn.commit()
+        return deleted
+
+def fsm_load(storage_key: str):
+    """
+    Загружает состояние FSM: (state, data_json) или None
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT state, data FROM fsm_states WHERE storage_key = ?", (storage_key,)
+        ).fetchone()
+
+def fsm_save_many(rows):
+    """
+    Сохраняет пакет состояний FSM одной транзакцией.
+    rows: [(storage_key, state, data_json, updated_at)]; пустые состояния удаляются.
+    """
+    upserts = [row for row in rows if row[1] is not None or row[2] != '{}']
+    deletes = [(row[0],) for row in rows if row[1] is None and row[2] == '{}']
+    with get_db_connection() as conn:
+        if upserts:
+            conn.executemany(
+                "INSERT INTO fsm_states (storage_key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(storage_key) DO UPDATE SET state = excluded.state, "
+                "data = excluded.data, updated_at = excluded.updated_at",
+                upserts
+            )
+        if deletes:
+            conn.executemany("DELETE FROM fsm_states WHERE storage_key = ?", deletes)
+        conn.commit()
+
+def fsm_delete_stale(updated_before: float):
+    """
+    Удаляет состояния FSM, не менявшиеся с момента updated_before (unix time).
+    Возвращает ключи удаленных записей.
+    """
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        keys = [row[0] for row in conn.execute(
+            "SELECT storage_key FROM fsm_states WHERE updated_at < ?", (updated_before,)
+        )]
+        conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (updated_before,))
+        conn.commit()
+        return keys
+
+# Таблицы учета трафика по уровням детализации и размер интервала каждой (секунды)
+TRAFFIC_TABLES = (("traffic_minute", 60), ("traffic_hour", 3600), ("traffic_day", 86400))
+
+def record_traffic(rows):
+    """
+    Добавляет прирост трафика одной транзакцией.
+    rows: [(user_id, ts, uplink, downlink)], ts - начало минуты (unix time)
+    """
+    with get_db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO traffic_minute (user_id, ts, up, down) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id, ts) DO UPDATE SET up = up + excluded.up, down = down + excluded.down",
+            rows
+        )
+        conn.commit()
+    return len(rows)
+
+def rollup_traffic(now: float, minute_retention: float, hour_retention: float, day_retention: float):
+    """
+    Прореживает старые записи: минутные старше minute_retention переносятся в часовые,
+    часовые старше hour_retention - в дневные, дневные старше day_retention удаляются.
+    Возвращает количество обработанных записей по таблицам.
+    """
+    result = {}
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        for (source, _), (target, size), retention in zip(
+                TRAFFIC_TABLES, TRAFFIC_TABLES[1:], (minute_retention, hour_retention)):
+            cutoff = int(now - retention)
+            cursor.execute(
+                f"INSERT INTO {target} (user_id, ts, up, down) "
+                f"SELECT user_id, ts / {size} * {size} AS bucket, SUM(up), SUM(down) FROM {source} "
+                f"WHERE ts < ? GROUP BY user_id, bucket "
+                f"ON CONFLICT(user_id, ts) DO UPDATE SET up = up + excluded.up, down = down + excluded.down",
+                (cutoff,)
+            )
+            cursor.execute(f"DELETE FROM {source} WHERE ts < ?", (cutoff,))
+            result[source] = cursor.rowcount
+        cursor.execute("DELETE FROM traffic_day WHERE ts < ?", (int(now - day_retention),))
+        result['traffic_day'] = cursor.rowcount
+        conn.commit()
+    return result
+
+def get_user_traffic(user_id: int, since: float):
+    """
+    Трафик пользователя с момента since: (uplink, downlink)
+    """
+    query = " UNION ALL ".join(
+        f"SELECT up, down FROM {table} WHERE user_id = ? AND ts >= ?" for table, _ in TRAFFIC_TABLES
+    )
+    params = []
+    for _ in TRAFFIC_TABLES:
+        params += [user_id, int(since)]
+    with get_db_connection() as conn:
+        row = conn.execute(
+            f"SELECT COALESCE(SUM(up), 0), COALESCE(SUM(down), 0) FROM ({query})", params
+        ).fetchone()
+        return row[0], row[1]
+
+def get_top_traffic(since: float, limit: int = 10):
+    """
+    Пользователи с наибольшим трафиком с момента since: [(user_id, uplink, downlink)]
+    """
+    query = " UNION ALL ".join(
+        f"SELECT user_id, up, down FROM {table} WHERE ts >= ?" for table, _ in TRAFFIC_TABLES
+    )
+    with get_db_connection() as conn:
+        return conn.execute(
+            f"SELECT user_id, SUM(up) AS up, SUM(down) AS down FROM ({query}) "
+            f"GROUP BY user_id ORDER BY SUM(up) + SUM(down) DESC LIMIT ?",
+            [int(since)] * len(TRAFFIC_TABLES) + [limit]
+        ).fetchall()
+
+def enqueue_notifications(rows):
+    """
+    Ставит уведомления в очередь отправки одной транзакцией.
+    rows: [(chat_id, text, kind)]; возвращает количество добавленных записей.
+    Чаты, заблокировавшие бота, пропускаются.
+    """
+    now = time.time()
+    with get_db_connection() as conn:
+        before = conn.total_changes
+        # Чаты, заблокировавшие бота, пропускаем
+        conn.executemany(
+            "INSERT INTO outbox (chat_id, text, kind, status, attempts, next_attempt_at, created_at) "
+            "SELECT ?, ?, ?, 'pending', 0, ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM blocked_chats WHERE chat_id = ?)",
+            [(chat_id, text, kind, now, now, chat_id) for chat_id, text, kind in rows]
+        )
+        conn.commit()
+        return conn.total_changes - before
+
+def fetch_due_notifications(now: float, limit: int = 100):
+    """
+    Уведомления, время отправки которых наступило: [(id, chat_id, text, attempts)]
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT id, chat_id, text, attempts FROM outbox "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+            (now, limit)
+        ).fetchall()
+
+def get_next_notification_time():
+    """
+    Ближайшее время отправки среди ожидающих уведомлений или None
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+        ).fetchone()
+        return row[0]
+
+def save_notification_results(sent, retries, failures):
+    """
+    Сохраняет результаты отправки пакета одной транзакцией.
+    sent: [id]; retries: [(next_attempt_at, attempts, error, id)];
+    failures: [(status, error, id)] со статусом failed или blocked.
+    """
+    now = time.time()
+    with get_db_connection() as conn:
+        if sent:
+            conn.executemany(
+                "UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1 WHERE id = ?",
+                [(now, notification_id) for notification_id in sent]
+            )
+        if retries:
+            conn.executemany(
+                "UPDATE outbox SET next_attempt_at = ?, attempts = ?, error = ? WHERE id = ?",
+                retries
+            )
+        if failures:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, error = ?, attempts = attempts + 1 WHERE id = ?",
+                failures
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO blocked_chats (chat_id, blocked_at) "
+                "SELECT DISTINCT chat_id, ? FROM outbox WHERE status = 'blocked' "
+                "AND id IN (%s)" % ",".join("?" * len(failures)),
+                [now] + [notification_id for _, _, notification_id in failures]
+            )
+        conn.commit()
+
+def unblock_chat(chat_id: int):
+    """
+    Снимает отметку о блокировке бота (пользователь снова написал боту)
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute("DELETE FROM blocked_chats WHERE chat_id = ?", (chat_id,))
+        conn.commit()
+        return cursor.rowcount > 0
+
+def get_outbox_stats():
+    """
+    Количество уведомлений по статусам
+    """
+    with get_db_connection() as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+def prune_outbox(created_before: float) -> int:
+    """
+    Удаляет обработанные уведомления, созданные раньше created_before
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "DELETE FROM outbox WHERE status != 'pending' AND created_at < ?", (created_before,)
+        )
+        conn.commit()
+        return cursor.rowcount
+
+def get_all_user_ids():
+    """
+    ID всех пользователей (для рассылок)
+    """
+    with get_db_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT user_id FROM users")]
+
+JOB_STATUSES = ("pending", "running", "done", "dead")
+
+def _insert_job(conn, kind: str, job_key: str, payload: dict, now: float) -> bool:
+    cursor = conn.execute(
+        "INSERT INTO jobs (kind, job_key, payload, status, attempts, next_attempt_at, created_at, updated_at) "
+        "VALUES (?, ?, ?, 'pending', 0, ?, ?, ?) ON CONFLICT(job_key) DO NOTHING",
+        (kind, job_key, json.dumps(payload), now, now, now)
+    )
+    return cursor.rowcount == 1
+
+def enqueue_job(kind: str, job_key: str, payload: dict) -> bool:
+    """
+    Ставит задачу в очередь. job_key делает постановку идемпотентной: повторная
+    задача с тем же ключом не добавляется. Возвращает True, если задача добавлена.
+    """
+    with get_db_connection() as conn:
+        created = _insert_job(conn, kind, job_key, payload, time.time())
+        conn.commit()
+        return created
+
+def claim_jobs(now: float, limit: int, lease: float):
+    """
+    Забирает задачи, время выполнения которых наступило, и отмечает их как
+    выполняемые до now + lease. Задачи, аренда которых истекла (процесс упал
+    во время выполнения), выдаются снова. Попытка засчитывается при выдаче.
+    Возвращает [(id, kind, payload, attempts)].
+    """
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT id, kind, payload, attempts FROM jobs "
+            "WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'running' AND locked_until <= ?) "
+            "ORDER BY next_attempt_at LIMIT ?",
+            (now, now, limit)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = ? "
+            "WHERE id = ?",
+            [(now + lease, now, row[0]) for row in rows]
+        )
+        conn.commit()
+    return [(job_id, kind, json.loads(payload), attempts + 1) for job_id, kind, payload, attempts in rows]
+
+def finish_job(job_id: int, status: str, attempts: int, next_attempt_at: float = None, error: str = None):
+    """
+    Сохраняет результат выполнения задачи: done, dead или pending (повтор в next_attempt_at)
+    """
+    now = time.time()
+    with get_db_connection() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, attempts = ?, next_attempt_at = COALESCE(?, next_attempt_at), "
+            "locked_until = NULL, error = ?, updated_at = ? WHERE id = ?",
+            (status, attempts, next_attempt_at, error, now, job_id)
+        )
+        conn.commit()
+
+def get_next_job_time():
+    """
+    Ближайшее время выполнения среди ожидающих и выполняемых задач или None
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT MIN(CASE WHEN status = 'running' THEN locked_until ELSE next_attempt_at END) "
+            "FROM jobs WHERE status IN ('pending', 'running')"
+        ).fetchone()
+        return row[0]
+
+def get_job_stats():
+    """
+    Количество задач по статусам
+    """
+    with get_db_connection() as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+def get_dead_jobs(limit: int = 20):
+    """
+    Задачи, исчерпавшие попытки: [(id, kind, job_key, attempts, updated_at, error)]
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT id, kind, job_key, attempts, updated_at, error FROM jobs "
+            "WHERE status = 'dead' ORDER BY updated_at DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+
+def retry_dead_job(job_id: int) -> bool:
+    """
+    Возвращает задачу из списка неудачных в очередь с обнулением попыток
+    """
+    now = time.time()
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'dead'",
+            (now, now, job_id)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+
+def prune_jobs(updated_before: float) -> int:
+    """
+    Удаляет выполненные задачи, завершенные раньше updated_before
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "DELETE FROM jobs WHERE status = 'done' AND updated_at < ?", (updated_before,)
+        )
+        conn.commit()
+        return cursor.rowcount
+
+def acquire_lease(name: str, holder: str, ttl: float):
+    """
+    Захватывает или продлевает аренду name для holder на ttl секунд.
+    Возвращает fencing token (растет при каждой смене владельца) или None,
+    если аренда принадлежит другому владельцу и еще не истекла.
+    """
+    now = time.time()
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT holder, token, expires_at FROM leases WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            token = 1
+            conn.execute(
+                "INSERT INTO leases (name, holder, token, expires_at, acquired_at, heartbeat_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (name, holder, token, now + ttl, now, now)
+            )
+        elif row[0] == holder and row[2] > now:
+            token = row[1]
+            conn.execute(
+                "UPDATE leases SET expires_at = ?, heartbeat_at = ? WHERE name = ?",
+                (now + ttl, now, name)
+            )
+        elif row[2] <= now:
+            token = row[1] + 1
+            conn.execute(
+                "UPDATE leases SET holder = ?, token = ?, expires_at = ?, acquired_at = ?, heartbeat_at = ? "
+                "WHERE name = ?",
+                (holder, token, now + ttl, now, now, name)
+            )
+        else:
+            conn.rollback()
+            return None
+        conn.commit()
+        return token
+
+def release_lease(name: str, holder: str) -> bool:
+    """
+    Освобождает аренду (при штатной остановке), чтобы ее сразу мог захватить другой процесс
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?", (name, holder)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+
+def check_lease(name: str, holder: str, token: int) -> bool:
+    """
+    Проверка fencing token: аренда по-прежнему принадлежит holder с тем же token и не истекла
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM leases WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?",
+            (name, holder, token, time.time())
+        ).fetchone()
+        return row is not None
+
+def get_lease(name: str):
+    """
+    Текущее состояние аренды: {'holder', 'token', 'expires_at', 'acquired_at', 'heartbeat_at'} или None
+    """
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT holder, token, expires_at, acquired_at, heartbeat_at FROM leases WHERE name = ?", (name,)
+        ).fetchone()
+    if row is None:
+        return None
+    return dict(zip(('holder', 'token', 'expires_at', 'acquired_at', 'heartbeat_at'), row))
+
+def get_stats(now: float, days: int = 7):
+    """
+    Статистика для администратора из счетчиков: {'users', 'active', 'expiring_24h',
+    'expiring_7d', 'nodes': {node_id: count}, 'daily': {day: {metric: value}}}
+    за последние days дней. Окончания подписок считаются по диапазону индекса end_ts.
+    """
+    now = int(now)
+    first_day = datetime.fromtimestamp(now - (days - 1) * 86400).date().isoformat()
+    with get_db_connection() as conn:
+        stats = dict(conn.execute("SELECT name, value FROM stats_counters").fetchall())
+        stats['expiring_24h'], stats['expiring_7d'] = conn.execute(
+            "SELECT COUNT(*) FILTER (WHERE end_ts <= ?), COUNT(*) FROM users WHERE end_ts > ? AND end_ts <= ?",
+            (now + 86400, now, now + 7 * 86400)
+        ).fetchone()
+        stats['nodes'] = dict(conn.execute(
+            "SELECT node_id, active FROM stats_nodes WHERE active > 0 ORDER BY node_id"
+        ).fetchall())
+        daily = {}
+        for day, metric, value in conn.execute(
+            "SELECT day, metric, value FROM stats_daily WHERE day >= ? ORDER BY day", (first_day,)
+        ):
+            daily.setdefault(day, {})[metric] = value
+        stats['daily'] = daily
+    return stats
+
+def rebuild_stats():
+    """
+    Пересчитывает счетчики статистики по таблицам users и subscriptions одной транзакцией
+    """
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        migrations.rebuild_stats(conn)
+        conn.commit()
+        return dict(conn.execute("SELECT name, value FROM stats_counters").fetchall())
+
+def get_log_cursor(path: str):
+    """
+    Сохраненная позиция чтения журнала: (inode, position) или None
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT inode, position FROM log_cursors WHERE path = ?", (path,)
+        ).fetchone()
+
+def save_log_cursor(path: str, inode: int, position: int):
+    """
+    Сохраняет позицию чтения журнала (после полностью обработанных строк)
+    """
+    with get_db_connection() as conn:
+        conn.execute(
+            "INSERT INTO log_cursors (path, inode, position, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET inode = excluded.inode, position = excluded.position, "
+            "updated_at = excluded.updated_at",
+            (path, inode, position, time.time())
+        )
+        conn.commit()
+
+def suspend_user(user_id: int, devices: int, until: float) -> bool:
+    """
+    Отмечает временную блокировку пользователя за превышение числа устройств.
+    Возвращает False, если пользователь уже заблокирован.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO device_suspensions (user_id, devices, suspended_at, until) VALUES (?, ?, ?, ?)",
+            (user_id, devices, time.time(), until)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+
+def get_due_suspensions(now: float):
+    """
+    ID пользователей, срок блокировки которых закончился
+    """
+    with get_db_connection() as conn:
+        return [row[0] for row in conn.execute(
+            "SELECT user_id FROM device_suspensions WHERE until <= ? ORDER BY until", (now,)
+        )]
+
+def get_suspension(user_id: int):
+    """
+    Время окончания блокировки пользователя или None
+    """
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT until FROM device_suspensions WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def get_suspensions():
+    """
+    Действующие блокировки: [(user_id, devices, suspended_at, until)]
+    """
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT user_id, devices, suspended_at, until FROM device_suspensions ORDER BY until"
+        ).fetchall()
+
+def lift_suspension(user_id: int) -> bool:
+    """
+    Снимает блокировку пользователя и в той же транзакции ставит задачу restore
+    (возврат клиента V2Ray выполняет ведущий процесс). Возвращает False, если
+    пользователь не заблокирован.
+    """
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT suspended_at FROM device_suspensions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            conn.rollback()
+            return False
+        conn.execute("DELETE FROM device_suspensions WHERE user_id = ?", (user_id,))
+        _insert_job(conn, "restore", f"restore:{user_id}:{row[0]}", {"user_id": user_id}, time.time())
+        conn.commit()
+        return True
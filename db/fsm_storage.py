@@ -0,0 +1,193 @@
+"""
+Хранилище состояний FSM aiogram в SQLite.
+
+Состояния читаются через ограниченный кэш в памяти, изменения накапливаются
+и записываются пакетом одной транзакцией. Если базу используют несколько
+процессов бота (shared), кэш не используется и изменения записываются сразу. Давно не менявшиеся состояния
+(например, брошенные оплаты в waiting_for_payment) удаляются по TTL.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from db import database
+from db.async_database import run_in_db
+
+logger = logging.getLogger(__name__)
+
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Интервал пакетной записи изменений (секунды)
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+# Время жизни неизменяемого состояния (секунды), по умолчанию двое суток
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(48 * 3600)))
+FSM_CLEANUP_INTERVAL = float(os.getenv("FSM_CLEANUP_INTERVAL", "600"))
+
+
+class _Entry:
+    __slots__ = ("state", "data", "updated_at", "dirty")
+
+    def __init__(self, state, data, updated_at, dirty=False):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+        self.dirty = dirty
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Реализация BaseStorage поверх таблицы fsm_states.
+    shared=True - состояние читается из базы при каждом обращении и записывается
+    сразу, чтобы другой процесс не работал с устаревшей копией.
+    """
+
+    def __init__(self, cache_size: int = FSM_CACHE_SIZE, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 state_ttl: float = FSM_STATE_TTL, cleanup_interval: float = FSM_CLEANUP_INTERVAL,
+                 shared: bool = False):
+        self.shared = shared
+        self.cache_size = 0 if shared else cache_size
+        self.flush_interval = flush_interval
+        self.state_ttl = state_ttl
+        self.cleanup_interval = cleanup_interval
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    @staticmethod
+    def _make_key(key: StorageKey) -> str:
+        thread_id = key.thread_id if key.thread_id is not None else ""
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{thread_id}:{key.destiny}"
+
+    def _ensure_background(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._background())
+
+    async def _get_entry(self, key: StorageKey) -> _Entry:
+        self._ensure_background()
+        storage_key = self._make_key(key)
+        entry = self._cache.get(storage_key)
+        if entry is not None and (not self.shared or storage_key in self._dirty):
+            self._cache.move_to_end(storage_key)
+            return entry
+        if entry is not None:
+            # Копия могла устареть: состояние мог изменить другой процесс
+            del self._cache[storage_key]
+
+        row = await run_in_db(database.fsm_load, storage_key)
+        # Пока шел запрос, запись могла появиться в кэше
+        entry = self._cache.get(storage_key)
+        if entry is None:
+            if row:
+                entry = _Entry(row[0], json.loads(row[1]), time.time())
+            else:
+                entry = _Entry(None, {}, time.time())
+            self._cache[storage_key] = entry
+            self._evict(keep=storage_key)
+        return entry
+
+    def _evict(self, keep: str = None):
+        """
+        Вытесняет давно не использованные записи; несохраненные изменения и запись keep
+        (только что прочитанная) не вытесняются
+        """
+        excess = len(self._cache) - self.cache_size
+        if excess <= 0:
+            return
+        victims = []
+        for storage_key in self._cache:
+            if storage_key not in self._dirty and storage_key != keep:
+                victims.append(storage_key)
+                if len(victims) >= excess:
+                    break
+        for storage_key in victims:
+            del self._cache[storage_key]
+
+    def _mark_dirty(self, key: StorageKey, entry: _Entry):
+        entry.updated_at = time.time()
+        entry.dirty = True
+        self._dirty.add(self._make_key(key))
+        self._ensure_background()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._get_entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, entry)
+        if self.shared:
+            await self.flush()
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = await self._get_entry(key)
+        entry.data = data.copy()
+        self._mark_dirty(key, entry)
+        if self.shared:
+            await self.flush()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get_entry(key)).data.copy()
+
+    async def flush(self):
+        """
+        Записывает накопленные изменения одной транзакцией
+        """
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            rows = []
+            for storage_key in self._dirty:
+                entry = self._cache[storage_key]
+                entry.dirty = False
+                rows.append((storage_key, entry.state, json.dumps(entry.data), entry.updated_at))
+            self._dirty = set()
+            try:
+                await run_in_db(database.fsm_save_many, rows)
+            except Exception:
+                # Возвращаем изменения в очередь, чтобы не потерять их
+                for storage_key, *_ in rows:
+                    if storage_key in self._cache:
+                        self._cache[storage_key].dirty = True
+                        self._dirty.add(storage_key)
+                raise
+            self._evict()
+
+    async def cleanup(self):
+        """
+        Удаляет устаревшие состояния из базы и кэша
+        """
+        await self.flush()
+        stale = await run_in_db(database.fsm_delete_stale, time.time() - self.state_ttl)
+        for storage_key in stale:
+            entry = self._cache.get(storage_key)
+            if entry is not None and not entry.dirty:
+                del self._cache[storage_key]
+        if stale:
+            logger.info(f"FSM: удалено устаревших состояний: {len(stale)}")
+
+    async def _background(self):
+        last_cleanup = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_cleanup >= self.cleanup_interval:
+                    last_cleanup = time.monotonic()
+                    await self.cleanup()
+            except Exception as e:
+                logger.error(f"FSM: ошибка при записи состояний: {e}", exc_info=True)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
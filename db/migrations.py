@@ -0,0 +1,534 @@
+"""
+Версионные миграции схемы базы данных.
+
+Номер последней примененной миграции хранится в PRAGMA user_version. Каждая
+миграция идемпотентна и выполняется короткими транзакциями: изменения схемы
+(CREATE, ALTER TABLE ADD COLUMN) не переписывают таблицы, а перенос данных идет
+пакетами по MIGRATION_BATCH_SIZE строк, поэтому миграции применяются к рабочей
+базе без остановки бота. Если миграция прервалась, она повторяется с начала при
+следующем запуске; несколько процессов могут выполнять ее одновременно.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Количество строк в одной транзакции переноса данных
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+
+
+def _ensure_column(cursor, table: str, column: str, definition: str):
+    """
+    Добавляет столбец в существующую таблицу, если его еще нет
+    """
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _iso_to_ts(value):
+    """
+    ISO-дата (локальное время) -> секунды Unix; некорректные значения - None
+    """
+    if not value:
+        return None
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        logger.warning(f"Некорректная дата {value!r} пропущена при переносе")
+        return None
+
+
+def _batches(conn, query: str, batch_size: int, start=-2 ** 63):
+    """
+    Выборка пакетами по возрастанию первого столбца (ключа): query содержит
+    условие "> ?" для последнего ключа и LIMIT ?
+    """
+    last = start
+    while True:
+        rows = conn.execute(query, (last, batch_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def _baseline(conn, batch_size: int):
+    """
+    Схема до введения миграций (база, созданная прежним init_db, не меняется)
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    # Создаем таблицу пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            start_date TEXT,
+            end_date TEXT,
+            v2ray_id TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Индекс для выборки ближайших окончаний подписки
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_end_date ON users(end_date)"
+    )
+
+    # Узел V2Ray, на котором размещен пользователь
+    _ensure_column(cursor, "users", "node_id", "TEXT")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_node ON users(node_id, end_date)"
+    )
+
+    # Узлы V2Ray
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS nodes (
+            node_id TEXT PRIMARY KEY,
+            address TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            api_address TEXT,
+            config_path TEXT,
+            capacity INTEGER NOT NULL DEFAULT 1000,
+            status TEXT NOT NULL DEFAULT 'active',
+            created_at TEXT
+        )
+    ''')
+
+    # Журнал платежей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT NOT NULL,
+            description TEXT,
+            payment_url TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            applied_at TEXT,
+            provisioned_at TEXT,
+            provider_id TEXT
+        )
+    ''')
+    _ensure_column(cursor, "payments", "provider_id", "TEXT")
+
+    # Состояния FSM aiogram (незавершенные покупки переживают перезапуск)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)"
+    )
+
+    # file_id Telegram для загруженных файлов подключения (vpn/artifacts.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            artifact_key TEXT PRIMARY KEY,
+            v2ray_id TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_telegram_files_v2ray_id ON telegram_files(v2ray_id)"
+    )
+
+    # Учет трафика: минутные, часовые и дневные интервалы (ts - начало интервала)
+    for table in ("traffic_minute", "traffic_hour", "traffic_day"):
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                user_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                up INTEGER NOT NULL DEFAULT 0,
+                down INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, ts)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table}(ts)")
+
+    # Очередь исходящих уведомлений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            kind TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            error TEXT
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)"
+    )
+
+    # Чаты, в которых бот заблокирован пользователем
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blocked_chats (
+            chat_id INTEGER PRIMARY KEY,
+            blocked_at REAL NOT NULL
+        )
+    ''')
+
+    # Аренды для выбора ведущего процесса (несколько процессов бота на одной базе)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            token INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            acquired_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL
+        )
+    ''')
+
+    # Очередь фоновых задач (выдача доступа после оплаты и т.п.)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            job_key TEXT NOT NULL UNIQUE,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            locked_until REAL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            error TEXT
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs(status, next_attempt_at)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status, updated_at)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id, created_at)"
+    )
+
+    conn.commit()
+
+
+def _users_epoch(conn, batch_size: int):
+    """
+    Сроки подписки в секундах Unix (start_ts, end_ts) с индексами вместо
+    текстовых start_date/end_date. Прежние столбцы остаются в таблице (их
+    удаление переписало бы таблицу целиком), но больше не используются.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    _ensure_column(cursor, "users", "start_ts", "INTEGER")
+    _ensure_column(cursor, "users", "end_ts", "INTEGER")
+    conn.commit()
+
+    for rows in _batches(
+        conn,
+        "SELECT user_id, start_date, end_date FROM users "
+        "WHERE user_id > ? AND end_ts IS NULL AND end_date IS NOT NULL ORDER BY user_id LIMIT ?",
+        batch_size
+    ):
+        cursor.execute("BEGIN IMMEDIATE")
+        # end_ts IS NULL: строку могли обновить после выборки
+        cursor.executemany(
+            "UPDATE users SET start_ts = COALESCE(start_ts, ?), end_ts = ? "
+            "WHERE user_id = ? AND end_ts IS NULL AND end_date = ?",
+            [(_iso_to_ts(start_date), _iso_to_ts(end_date), user_id, end_date)
+             for user_id, start_date, end_date in rows]
+        )
+        conn.commit()
+
+    for rows in _batches(
+        conn,
+        "SELECT user_id, start_date FROM users "
+        "WHERE user_id > ? AND start_ts IS NULL AND start_date IS NOT NULL ORDER BY user_id LIMIT ?",
+        batch_size
+    ):
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany(
+            "UPDATE users SET start_ts = ? WHERE user_id = ? AND start_ts IS NULL",
+            [(_iso_to_ts(start_date), user_id) for user_id, start_date in rows]
+        )
+        conn.commit()
+
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_end_ts ON users(end_ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_node_end_ts ON users(node_id, end_ts)")
+    cursor.execute("DROP INDEX IF EXISTS idx_users_end_date")
+    cursor.execute("DROP INDEX IF EXISTS idx_users_node")
+    conn.commit()
+
+
+def _subscriptions(conn, batch_size: int):
+    """
+    История подписок: каждое продление, отмена и окончание - отдельная строка;
+    продление по оплате ссылается на платеж. Переносятся примененные платежи и
+    текущие сроки подписки (kind = 'migrated').
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payment_id TEXT UNIQUE REFERENCES payments(payment_id) ON DELETE SET NULL,
+            start_ts INTEGER,
+            end_ts INTEGER,
+            created_ts INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id, created_ts)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_created ON subscriptions(created_ts)"
+    )
+    conn.commit()
+
+    # Сроки, на которые продлевали прежние платежи, не сохранились - только момент применения
+    for rows in _batches(
+        conn,
+        "SELECT payment_id, user_id, applied_at FROM payments "
+        "WHERE payment_id > ? AND applied_at IS NOT NULL ORDER BY payment_id LIMIT ?",
+        batch_size, start=""
+    ):
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO subscriptions (user_id, kind, payment_id, created_ts) "
+            "VALUES (?, 'payment', ?, ?)",
+            [(user_id, payment_id, _iso_to_ts(applied_at) or int(time.time()))
+             for payment_id, user_id, applied_at in rows]
+        )
+        conn.commit()
+
+    now = int(time.time())
+    for rows in _batches(
+        conn,
+        "SELECT user_id, start_ts, end_ts FROM users "
+        "WHERE user_id > ? AND end_ts IS NOT NULL ORDER BY user_id LIMIT ?",
+        batch_size
+    ):
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany(
+            "INSERT INTO subscriptions (user_id, kind, start_ts, end_ts, created_ts) "
+            "SELECT ?, 'migrated', ?, ?, ? WHERE NOT EXISTS "
+            "(SELECT 1 FROM subscriptions WHERE user_id = ? AND kind = 'migrated')",
+            [(user_id, start_ts, end_ts, now, user_id) for user_id, start_ts, end_ts in rows]
+        )
+        conn.commit()
+
+
+# Пересчет статистики по данным (миграция 4 и vpnctl stats-rebuild): полный
+# просмотр users и subscriptions, поэтому выполняется только по команде
+STATS_REBUILD = (
+    "DELETE FROM stats_counters",
+    "DELETE FROM stats_nodes",
+    "DELETE FROM stats_daily",
+    "INSERT INTO stats_counters (name, value) "
+    "SELECT 'users', COUNT(*) FROM users UNION ALL "
+    "SELECT 'active', COUNT(*) FROM users WHERE end_ts IS NOT NULL",
+    "INSERT INTO stats_nodes (node_id, active) "
+    "SELECT node_id, COUNT(*) FROM users WHERE node_id IS NOT NULL AND end_ts IS NOT NULL GROUP BY node_id",
+    # created_at - CURRENT_TIMESTAMP (UTC)
+    "INSERT INTO stats_daily (day, metric, value) "
+    "SELECT date(COALESCE(created_at, 'now'), 'localtime') AS day, 'signups', COUNT(*) FROM users GROUP BY day",
+    "INSERT INTO stats_daily (day, metric, value) "
+    "SELECT date(created_ts, 'unixepoch', 'localtime') AS day, 'subscriptions:' || kind, COUNT(*) "
+    "FROM subscriptions GROUP BY day, kind",
+    "INSERT INTO stats_daily (day, metric, value) "
+    "SELECT date(created_ts, 'unixepoch', 'localtime') AS day, 'revenue:' || currency, SUM(amount) "
+    "FROM subscriptions WHERE kind = 'payment' AND amount IS NOT NULL GROUP BY day, currency",
+)
+
+# Триггеры обновляют счетчики в той же транзакции, что и изменение подписки или
+# платежа, при любом способе записи (бот, vpnctl, ручной SQL)
+STATS_TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users
+    BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'active' AND NEW.end_ts IS NOT NULL;
+        INSERT INTO stats_nodes (node_id, active)
+            SELECT NEW.node_id, 1 WHERE NEW.node_id IS NOT NULL AND NEW.end_ts IS NOT NULL
+            ON CONFLICT(node_id) DO UPDATE SET active = active + 1;
+        INSERT INTO stats_daily (day, metric, value) VALUES (date('now', 'localtime'), 'signups', 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_users_update AFTER UPDATE OF end_ts, node_id ON users
+    WHEN (OLD.end_ts IS NULL) != (NEW.end_ts IS NULL) OR OLD.node_id IS NOT NEW.node_id
+    BEGIN
+        UPDATE stats_counters SET value = value + (NEW.end_ts IS NOT NULL) - (OLD.end_ts IS NOT NULL)
+            WHERE name = 'active';
+        UPDATE stats_nodes SET active = active - 1 WHERE node_id = OLD.node_id AND OLD.end_ts IS NOT NULL;
+        INSERT INTO stats_nodes (node_id, active)
+            SELECT NEW.node_id, 1 WHERE NEW.node_id IS NOT NULL AND NEW.end_ts IS NOT NULL
+            ON CONFLICT(node_id) DO UPDATE SET active = active + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'active' AND OLD.end_ts IS NOT NULL;
+        UPDATE stats_nodes SET active = active - 1 WHERE node_id = OLD.node_id AND OLD.end_ts IS NOT NULL;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_subscriptions_insert AFTER INSERT ON subscriptions
+    BEGIN
+        INSERT INTO stats_daily (day, metric, value)
+            VALUES (date(NEW.created_ts, 'unixepoch', 'localtime'), 'subscriptions:' || NEW.kind, 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        INSERT INTO stats_daily (day, metric, value)
+            SELECT date(NEW.created_ts, 'unixepoch', 'localtime'), 'revenue:' || NEW.currency, NEW.amount
+            WHERE NEW.kind = 'payment' AND NEW.amount IS NOT NULL
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+)
+
+
+def rebuild_stats(conn):
+    """
+    Пересчитывает счетчики и дневную статистику в текущей транзакции
+    """
+    for statement in STATS_REBUILD:
+        conn.execute(statement)
+
+
+def _stats(conn, batch_size: int):
+    """
+    Счетчики для команд администратора: всего и активных пользователей
+    (stats_counters), активных пользователей на узлах (stats_nodes) и дневная
+    статистика (stats_daily: новые пользователи, записи истории подписок по видам,
+    выручка по валютам). Сумма платежа сохраняется в истории подписок, чтобы
+    выручка не терялась при удалении старых платежей.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    _ensure_column(cursor, "subscriptions", "amount", "REAL")
+    _ensure_column(cursor, "subscriptions", "currency", "TEXT")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_nodes (
+            node_id TEXT PRIMARY KEY,
+            active INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+    ''')
+    conn.commit()
+
+    for rows in _batches(
+        conn,
+        "SELECT s.id, p.amount, p.currency FROM subscriptions s JOIN payments p ON p.payment_id = s.payment_id "
+        "WHERE s.id > ? AND s.amount IS NULL ORDER BY s.id LIMIT ?",
+        batch_size
+    ):
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany(
+            "UPDATE subscriptions SET amount = ?, currency = ? WHERE id = ?",
+            [(amount, currency, row_id) for row_id, amount, currency in rows]
+        )
+        conn.commit()
+
+    # Триггеры и начальный пересчет в одной транзакции: изменения между ними не теряются
+    cursor.execute("BEGIN IMMEDIATE")
+    for statement in STATS_TRIGGERS:
+        cursor.execute(statement)
+    rebuild_stats(conn)
+    conn.commit()
+
+
+def _access_log(conn, batch_size: int):
+    """
+    Позиция чтения журналов доступа V2Ray (vpn/access_log.py) и временные
+    блокировки пользователей за превышение числа устройств
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS log_cursors (
+            path TEXT PRIMARY KEY,
+            inode INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS device_suspensions (
+            user_id INTEGER PRIMARY KEY,
+            devices INTEGER NOT NULL,
+            suspended_at REAL NOT NULL,
+            until REAL NOT NULL
+        )
+    ''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_device_suspensions_until ON device_suspensions(until)"
+    )
+    conn.commit()
+
+
+# (версия, название, функция); новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, "baseline", _baseline),
+    (2, "users_epoch", _users_epoch),
+    (3, "subscriptions", _subscriptions),
+    (4, "stats", _stats),
+    (5, "access_log", _access_log),
+]
+
+
+def get_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, target: int = None, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """
+    Применяет миграции новее текущей версии базы (до target включительно).
+    Возвращает итоговую версию.
+    """
+    current = get_version(conn)
+    for version, name, step in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        started = time.perf_counter()
+        step(conn, batch_size)
+        conn.execute("BEGIN IMMEDIATE")
+        # Миграцию мог одновременно завершить другой процесс
+        if get_version(conn) < version:
+            conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+        current = version
+        logger.info(f"Миграция {version} ({name}) применена за {time.perf_counter() - started:.2f} с")
+    return current
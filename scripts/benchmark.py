@@ -0,0 +1,457 @@
+"""
+Сквозной нагрузочный тест бота на локальных заглушках.
+
+Через настоящий диспетчер bot.bot.dp прогоняются N синтетических пользователей:
+/start, /buy, оплата (mock-режим PayPalych), сообщение с проверкой оплаты,
+выдача доступа очередью задач, /status и окончание подписки планировщиком.
+Telegram заменяется заглушкой bot.fake_telegram, gRPC API V2Ray - заглушкой
+vpn.fake_v2ray_api, база данных и конфигурация V2Ray создаются во временном
+каталоге, перезапуск сервиса V2Ray только подсчитывается.
+
+Для каждого размера отдельный процесс (модули читают настройки при импорте)
+измеряет: задержку обработки обновлений (p50/p95/p99), обновлений в секунду,
+число SQL-выражений в секунду, объем записи конфигурации V2Ray и блокировки
+цикла событий. Результаты пишутся в JSON для сравнения между ревизиями.
+
+Примеры:
+    python scripts/benchmark.py --users 1000 10000 100000 -o bench.json
+    python scripts/benchmark.py --users 1000 --compare bench.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# ID синтетических пользователей начинаются с этого значения
+USER_ID_BASE = 10_000_000
+
+
+def percentiles(values) -> dict:
+    """
+    p50/p95/p99 и максимум в миллисекундах
+    """
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": pick(1.0)}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Counter:
+    """
+    Потокобезопасный счетчик (SQL-выражения выполняются в потоках базы данных)
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, *args):
+        with self._lock:
+            self.value += 1
+
+
+class LoopMonitor:
+    """
+    Измеряет блокировки цикла событий: насколько позже заданного просыпается
+    задача, засыпающая на interval секунд
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def report(self) -> dict:
+        result = percentiles(self.lags)
+        return {
+            "samples": len(self.lags),
+            "lag_p99_ms": result["p99_ms"],
+            "lag_max_ms": result["max_ms"],
+            # Суммарное время, на которое цикл был занят дольше 10 мс подряд
+            "blocked_ms": round(sum(lag for lag in self.lags if lag > 0.01) * 1000, 1)
+        }
+
+
+class Phase:
+    """
+    Результаты одного этапа: задержки обработки и счетчики на его границах
+    """
+
+    def __init__(self, name: str, stats):
+        self.name = name
+        self.stats = stats
+        self.latencies = []
+        self._started = None
+        self._start_counters = None
+
+    def __enter__(self):
+        self._start_counters = self.stats.counters()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._started
+        end = self.stats.counters()
+        self.delta = {key: end[key] - self._start_counters[key] for key in end}
+
+    def report(self, items: int) -> dict:
+        result = {
+            "items": items,
+            "seconds": round(self.seconds, 3),
+            "per_s": round(items / self.seconds, 1) if self.seconds else None,
+            "sql_statements": self.delta["sql"],
+            "sql_per_s": round(self.delta["sql"] / self.seconds, 1) if self.seconds else None,
+            "telegram_calls": self.delta["telegram"],
+            "config_writes": self.delta["config_writes"],
+            "config_bytes": self.delta["config_bytes"],
+            "v2ray_api_calls": self.delta["api_calls"],
+            "v2ray_restarts": self.delta["restarts"]
+        }
+        if self.latencies:
+            result.update(percentiles(self.latencies))
+        return result
+
+
+async def run_size(users: int, args) -> dict:
+    """
+    Один прогон на users пользователей (выполняется в отдельном процессе)
+    """
+    workdir = tempfile.mkdtemp(prefix="vpnbot-bench-")
+    telegram_port, v2ray_port = free_port(), free_port()
+
+    # Настройки читаются модулями при импорте, поэтому задаются до него
+    os.environ.update({
+        "BOT_TOKEN": "123:abc",
+        "ADMIN_ID": "1",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "DATABASE_PATH": os.path.join(workdir, "bench.db"),
+        "PAYPALYCH_MOCK": "true",
+        "MOCK_V2RAY": "false",
+        "V2RAY_USE_API": "true",
+        "V2RAY_API_ADDRESS": f"127.0.0.1:{v2ray_port}",
+        "V2RAY_CONFIG_PATH": os.path.join(workdir, "v2ray", "config.json"),
+        "V2RAY_CONFIG_LAYOUT": args.layout,
+        "V2RAY_NODE_CAPACITY": str(users * 2),
+        "JOB_WORKERS": str(args.job_workers),
+        "LEADER_ELECTION": "false",
+    })
+    if args.layout == "sharded":
+        # Фрагменты поддерживает только v2fly
+        os.environ["V2RAY_API_FLAVOR"] = "v2ray"
+    from bot.fake_telegram import FakeTelegram, make_message_update
+    from vpn.fake_v2ray_api import FakeV2RayApiServer
+
+    telegram = await FakeTelegram(port=telegram_port, latency=args.telegram_latency).start()
+    v2ray_api = await FakeV2RayApiServer(port=v2ray_port).start()
+    from db import database
+    database.init_db()
+
+    # Подсчет SQL-выражений на всех соединениях потоков базы данных
+    sql_counter = Counter()
+    configure_connection = database._configure_connection
+
+    def counting_configure(conn):
+        configure_connection(conn)
+        conn.set_trace_callback(sql_counter.increment)
+
+    database._configure_connection = counting_configure
+    database.close_connection()
+
+    from aiogram.types import Update
+    from bot import bot as app
+    from bot.jobs import job_queue
+    from db.cache import user_cache
+    from vpn import vpn_manager
+
+    logging.getLogger().setLevel(args.log_level)
+
+    restarts = Counter()
+
+    async def fake_restart():
+        restarts.increment()
+
+    pool = vpn_manager.get_node_pool()
+    pool.restart = fake_restart
+    os.makedirs(os.path.dirname(vpn_manager.V2RAY_CONFIG_PATH), exist_ok=True)
+    with open(vpn_manager.V2RAY_CONFIG_PATH, "w") as f:
+        json.dump(vpn_manager.V2RAY_CONFIG_TEMPLATE, f, indent=2)
+    await pool.load()
+
+    class Stats:
+        def counters(self):
+            mutators = list(pool._mutators.values())
+            return {
+                "sql": sql_counter.value,
+                "telegram": len(telegram.calls),
+                "config_writes": sum(m.writes for m in mutators),
+                "config_bytes": sum(m.bytes_written for m in mutators),
+                "api_calls": v2ray_api.calls,
+                "restarts": restarts.value
+            }
+
+    stats = Stats()
+    user_ids = [USER_ID_BASE + i for i in range(users)]
+    update_ids = itertools.count(1)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(phase: Phase, user_id: int, text: str):
+        update = Update.model_validate(
+            make_message_update(next(update_ids), user_id, text), context={"bot": app.bot}
+        )
+        async with semaphore:
+            started = time.perf_counter()
+            await app.dp.feed_update(app.bot, update)
+            phase.latencies.append(time.perf_counter() - started)
+
+    async def updates_phase(name: str, text: str) -> Phase:
+        phase = Phase(name, stats)
+        with phase:
+            await asyncio.gather(*(feed(phase, user_id, text) for user_id in user_ids))
+        return phase
+
+    async def wait_jobs(timeout: float):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job_stats = await asyncio.to_thread(database.get_job_stats)
+            if not job_stats.get("pending") and not job_stats.get("running"):
+                return job_stats
+            await asyncio.sleep(0.05)
+        raise TimeoutError(f"Очередь задач не опустела за {timeout} с: {job_stats}")
+
+    def complete_payments():
+        with database.get_db_connection() as conn:
+            payment_ids = [row[0] for row in conn.execute(
+                "SELECT payment_id FROM payments WHERE status = 'pending'"
+            ).fetchall()]
+        for payment_id in payment_ids:
+            database.set_payment_status(payment_id, "completed")
+        return len(payment_ids)
+
+    def backdate_subscriptions():
+        past = int(time.time()) - 60
+        with database.get_db_connection() as conn:
+            conn.execute("UPDATE users SET end_ts = ? WHERE end_ts IS NOT NULL", (past,))
+            conn.commit()
+        user_cache.clear()
+
+    job_queue.register("provision", app.provision_job)
+    job_queue.start()
+    monitor = LoopMonitor()
+    monitor.start()
+    phases = {}
+    try:
+        for name, text in (("start", "/start"), ("buy", "/buy")):
+            phases[name] = (await updates_phase(name, text)).report(users)
+
+        phase = Phase("payment_webhook", stats)
+        with phase:
+            paid = await asyncio.to_thread(complete_payments)
+        phases["payment_webhook"] = phase.report(paid)
+
+        phases["payment_check"] = (await updates_phase("payment_check", "Оплатил")).report(users)
+
+        phase = Phase("provision", stats)
+        with phase:
+            job_stats = await wait_jobs(args.timeout)
+        phases["provision"] = phase.report(job_stats.get("done", 0))
+        phases["provision"]["dead"] = job_stats.get("dead", 0)
+
+        phases["status"] = (await updates_phase("status", "/status")).report(users)
+
+        await asyncio.to_thread(backdate_subscriptions)
+        expired = []
+        phase = Phase("expiry", stats)
+        on_expire = app.expiry_scheduler.on_expire
+
+        async def timed_expire(batch):
+            started = time.perf_counter()
+            await on_expire(batch)
+            phase.latencies.append(time.perf_counter() - started)
+            expired.extend(batch)
+
+        app.expiry_scheduler.on_expire = timed_expire
+        with phase:
+            app.expiry_scheduler.start()
+            deadline = time.monotonic() + args.timeout
+            while len(expired) < users and time.monotonic() < deadline:
+                await asyncio.sleep(0.02)
+        await app.expiry_scheduler.stop()
+        # Задержки этапа expiry - время обработки одного пакета
+        phases["expiry"] = phase.report(len(expired))
+    finally:
+        total = stats.counters()
+        await monitor.stop()
+        await job_queue.stop()
+        await pool.close()
+        await app.storage.close()
+        await app.bot.session.close()
+        await v2ray_api.stop()
+        await telegram.stop()
+
+    db_size = os.path.getsize(os.environ["DATABASE_PATH"])
+    return {
+        "users": users,
+        "phases": phases,
+        "loop": monitor.report(),
+        "totals": {
+            "sql_statements": total["sql"],
+            "telegram_calls": total["telegram"],
+            "config_writes": total["config_writes"],
+            "config_bytes": total["config_bytes"],
+            "v2ray_restarts": total["restarts"],
+            "database_bytes": db_size
+        }
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_worker(users: int, args) -> dict:
+    """
+    Запускает прогон одного размера в отдельном процессе и возвращает его результат
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker", str(users), "--worker-output", result_path,
+        "--concurrency", str(args.concurrency), "--job-workers", str(args.job_workers),
+        "--layout", args.layout, "--telegram-latency", str(args.telegram_latency),
+        "--timeout", str(args.timeout), "--log-level", args.log_level
+    ]
+    try:
+        # stdout процесса - отладочный вывод mock-режима PayPalych, логи остаются в stderr
+        subprocess.run(command, check=True, cwd=ROOT, stdout=subprocess.DEVNULL)
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def print_result(result: dict, baseline: dict = None):
+    print(f"\n=== {result['users']} пользователей ===")
+    print(f"{'этап':<16}{'шт/с':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'SQL/с':>11}{'запись конф.':>14}")
+    for name, phase in result["phases"].items():
+        line = (
+            f"{name:<16}{phase['per_s'] or 0:>10.1f}{phase.get('p50_ms') or 0:>10.2f}"
+            f"{phase.get('p95_ms') or 0:>10.2f}{phase.get('p99_ms') or 0:>10.2f}"
+            f"{phase['sql_per_s'] or 0:>11.1f}{phase['config_bytes']:>14}"
+        )
+        old = (baseline or {}).get("phases", {}).get(name)
+        if old and old.get("per_s") and phase["per_s"]:
+            line += f"   {(phase['per_s'] / old['per_s'] - 1) * 100:+.1f}% шт/с"
+        print(line)
+    loop = result["loop"]
+    print(
+        f"Цикл событий: p99 задержки {loop['lag_p99_ms']} мс, максимум {loop['lag_max_ms']} мс, "
+        f"заблокирован {loop['blocked_ms']} мс"
+    )
+    totals = result["totals"]
+    print(
+        f"Всего: SQL {totals['sql_statements']}, вызовов Telegram {totals['telegram_calls']}, "
+        f"записей конфигурации {totals['config_writes']} ({totals['config_bytes']} байт), "
+        f"перезапусков V2Ray {totals['v2ray_restarts']}"
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота на локальных заглушках")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000],
+                        help="размеры прогонов (число пользователей)")
+    parser.add_argument("-o", "--output", help="файл для результатов в JSON")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно обрабатываемых обновлений")
+    parser.add_argument("--job-workers", type=int, default=32, help="исполнителей очереди задач")
+    parser.add_argument("--layout", choices=("file", "sharded"), default="file",
+                        help="хранение конфигурации V2Ray")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка ответа заглушки Telegram (с)")
+    parser.add_argument("--timeout", type=float, default=3600, help="предельное время этапов в фоне (с)")
+    parser.add_argument("--log-level", default="WARNING", help="уровень логирования бота")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    sys.path.insert(0, ROOT)
+
+    if args.worker:
+        result = asyncio.run(run_size(args.worker, args))
+        with open(args.worker_output, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result["users"]: result for result in json.load(f)["results"]}
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "concurrency": args.concurrency, "job_workers": args.job_workers,
+            "layout": args.layout, "telegram_latency": args.telegram_latency
+        },
+        "results": []
+    }
+    for users in args.users:
+        result = run_worker(users, args)
+        report["results"].append(result)
+        print_result(result, baseline.get(users))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nРезультаты записаны в {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
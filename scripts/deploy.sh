@@ -36,10 +36,8 @@ source venv/bin/activate
 # Устанавливаем зависимости Python
 pip install -r requirements.txt
 
-# Создаем директории для конфигов и логов
+# Создаем директорию для логов (файлы конфигураций клиентов формируются в памяти)
 mkdir -p /var/log/v2ray
-mkdir -p configs
-mkdir -p qrcodes
 
 # Копируем пример .env файла, если он не существует
 if [ ! -f .env ]; then
@@ -49,9 +47,7 @@ fi
 
 # Создаем базу данных
 python3 -c "
-import sys
-sys.path.append('db')
-from database import init_db
+from db.database import init_db
 init_db()
 print('База данных инициализирована')
 "
@@ -8,6 +8,12 @@ setup(
         "aiogram==3.4.1",
         "aiohttp==3.9.5",
         "python-dotenv==1.0.1",
-        "qrcode[pil]==7.4.2"
+        "qrcode[pil]==7.4.2",
+        "grpcio==1.62.1"
     ],
+    entry_points={
+        "console_scripts": [
+            "vpnctl=vpn.cli:main",
+        ],
+    },
 )
@@ -0,0 +1,30 @@
+"""
+Общие настройки тестов: модули читают окружение при импорте, поэтому
+переменные задаются до импорта bot, db и vpn (значения из .env не используются).
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_TMP = tempfile.mkdtemp(prefix="vpn-tests-")
+os.environ["BOT_TOKEN"] = "123456:test"
+os.environ["ADMIN_ID"] = "1"
+os.environ["DATABASE_PATH"] = os.path.join(_TMP, "vpn.db")
+os.environ["MOCK_V2RAY"] = "true"
+os.environ["LEADER_ELECTION"] = "false"
+os.environ["ACCESS_LOG_ENABLED"] = "false"
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Отдельная база для теста (get_connection переоткрывает соединение при смене пути)"""
+    from db import database
+
+    monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "vpn.db"))
+    database.init_db()
+    yield database
+    database.close_connection()
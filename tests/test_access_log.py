@@ -0,0 +1,178 @@
+"""
+Ограничение числа устройств: разбор журнала доступа V2Ray, блокировка
+пользователя и возврат доступа через задачу restore.
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from vpn.access_log import AccessLogMonitor
+from vpn.client_registry import CLIENT_EMAIL_DOMAIN
+
+
+def _line(user_id: int, ip: str, now: float) -> str:
+    stamp = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(now))
+    return (f"{stamp} from {ip}:{40000 + user_id} accepted tcp:example.com:443 "
+            f"[vmess-in -> direct] email: user_{user_id}@{CLIENT_EMAIL_DOMAIN}\n")
+
+
+def _append(path, lines):
+    with open(path, "a") as f:
+        f.writelines(lines)
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, user_id, addresses):
+        self.calls.append((user_id, sorted(addresses)))
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    path = tmp_path / "access.log"
+    path.write_text("")
+    return str(path)
+
+
+def test_monitor_flags_users_over_limit(db, log_path):
+    async def scenario():
+        now = time.time()
+        on_violation = Recorder()
+        monitor = AccessLogMonitor(on_violation, path=log_path, limit=2, window=600, cooldown=3600)
+        # Записи до первого запуска не разбираются
+        _append(log_path, [_line(5, f"10.0.0.{i}", now) for i in range(5)])
+        assert await monitor.check_once(now) == []
+
+        _append(log_path, [_line(5, f"10.0.0.{i}", now) for i in range(3)])
+        _append(log_path, [_line(6, "10.0.1.1", now), _line(6, "10.0.1.2", now)])
+        assert await monitor.check_once(now) == [5]
+        assert on_violation.calls == [(5, ["10.0.0.0", "10.0.0.1", "10.0.0.2"])]
+
+        # Повторное превышение в пределах cooldown не обрабатывается
+        _append(log_path, [_line(5, f"10.0.2.{i}", now) for i in range(4)])
+        assert await monitor.check_once(now) == []
+        assert len(on_violation.calls) == 1
+        await monitor.stop()
+
+        # Новый монитор продолжает с сохраненной позиции
+        again = AccessLogMonitor(on_violation, path=log_path, limit=2, window=600, cooldown=3600)
+        _append(log_path, [_line(7, f"10.0.3.{i}", now) for i in range(3)])
+        assert await again.check_once(now) == [7]
+        await again.stop()
+
+    asyncio.run(scenario())
+
+
+def test_monitor_follows_rotation(db, log_path):
+    async def scenario():
+        now = time.time()
+        monitor = AccessLogMonitor(Recorder(), path=log_path, limit=1, window=600, cooldown=0)
+        await monitor.check_once(now)
+        _append(log_path, [_line(8, "10.0.0.1", now)])
+        await monitor.check_once(now)
+
+        os.rename(log_path, log_path + ".1")
+        _append(log_path, [_line(8, "10.0.0.2", now)])
+        # Новый файл читается с начала: второй адрес превышает лимит
+        assert await monitor.check_once(now) == [8]
+        await monitor.stop()
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def v2ray_calls():
+    return []
+
+
+@pytest.fixture
+def bot_module(db, monkeypatch, v2ray_calls):
+    """bot.bot в режиме блокировки; клиенты V2Ray записываются вместо изменения конфигурации"""
+    from bot import bot as bot_module
+
+    async def create_v2ray_user(user_id):
+        v2ray_calls.append(("create", user_id))
+
+    async def remove_v2ray_user(user_id):
+        v2ray_calls.append(("remove", user_id))
+
+    monkeypatch.setattr(bot_module, "DEVICE_LIMIT_ACTION", "suspend")
+    monkeypatch.setattr(bot_module, "create_v2ray_user", create_v2ray_user)
+    monkeypatch.setattr(bot_module, "remove_v2ray_user", remove_v2ray_user)
+    return bot_module
+
+
+def _jobs(db, kind):
+    with db.get_db_connection() as conn:
+        return [json.loads(row[0]) for row in conn.execute("SELECT payload FROM jobs WHERE kind = ?", (kind,))]
+
+
+def _outbox(db, chat_id):
+    with db.get_db_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT kind FROM outbox WHERE chat_id = ?", (chat_id,))]
+
+
+def test_suspend_and_restore(bot_module, db, v2ray_calls):
+    user_id = 100
+    db.create_user(user_id, datetime.now() + timedelta(days=10))
+
+    async def scenario():
+        addresses = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"]
+        await bot_module.handle_device_violation(user_id, addresses)
+        until = db.get_suspension(user_id)
+        assert until is not None and until > time.time()
+        assert v2ray_calls == [("remove", user_id)]
+        assert _outbox(db, user_id) == ["device_limit"]
+        assert _outbox(db, bot_module.ADMIN_ID) == ["admin"]
+
+        # Повторное превышение во время блокировки не удаляет клиента еще раз
+        await bot_module.handle_device_violation(user_id, addresses)
+        assert v2ray_calls == [("remove", user_id)]
+
+        # Срок блокировки истек: снятие ставит задачу restore в той же транзакции
+        assert db.get_due_suspensions(until - 1) == []
+        assert db.get_due_suspensions(until) == [user_id]
+        assert db.lift_suspension(user_id)
+        assert not db.lift_suspension(user_id)
+        assert db.get_suspension(user_id) is None
+        jobs = _jobs(db, "restore")
+        assert jobs == [{"user_id": user_id}]
+
+        await bot_module.restore_job(jobs[0])
+        assert v2ray_calls == [("remove", user_id), ("create", user_id)]
+        assert _outbox(db, user_id) == ["device_limit", "device_limit"]
+
+    asyncio.run(scenario())
+
+
+def test_restore_skipped_when_suspended_again(bot_module, db, v2ray_calls):
+    user_id = 101
+    db.create_user(user_id, datetime.now() + timedelta(days=10))
+
+    async def scenario():
+        db.suspend_user(user_id, 4, time.time())
+        assert db.lift_suspension(user_id)
+        # Пользователь снова заблокирован до выполнения задачи restore
+        db.suspend_user(user_id, 5, time.time() + 600)
+        await bot_module.restore_job(_jobs(db, "restore")[0])
+        assert v2ray_calls == []
+
+    asyncio.run(scenario())
+
+
+def test_violation_ignored_for_expired_subscription(bot_module, db, v2ray_calls):
+    user_id = 102
+    db.create_user(user_id, datetime.now() - timedelta(days=1))
+
+    async def scenario():
+        await bot_module.handle_device_violation(user_id, ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"])
+        assert db.get_suspension(user_id) is None
+        assert v2ray_calls == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,43 @@
+"""
+Короткий прогон scripts/benchmark.py: весь сценарий проходит через диспетчер
+на заглушках Telegram, PayPalych и gRPC API V2Ray.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS = 30
+PHASES = ["start", "buy", "payment_webhook", "payment_check", "provision", "status", "expiry"]
+
+
+@pytest.mark.parametrize("layout", ["file", "sharded"])
+def test_benchmark_small_run(tmp_path, layout):
+    output = tmp_path / "bench.json"
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, "scripts", "benchmark.py"), "--users", str(USERS),
+         "--layout", layout, "--timeout", "60", "-o", str(output)],
+        check=True, cwd=ROOT, stdout=subprocess.DEVNULL, timeout=180
+    )
+    with open(output) as f:
+        report = json.load(f)
+    assert report["settings"]["layout"] == layout
+    result, = report["results"]
+    assert result["users"] == USERS
+    assert list(result["phases"]) == PHASES
+    for name, phase in result["phases"].items():
+        assert phase["items"] == USERS, name
+
+    phases = result["phases"]
+    # Клиенты добавляются и удаляются через API, конфигурация пишется пакетами без перезапуска
+    assert phases["provision"]["v2ray_api_calls"] == USERS
+    assert phases["expiry"]["v2ray_api_calls"] == USERS
+    assert 0 < result["totals"]["config_writes"] < USERS
+    assert result["totals"]["v2ray_restarts"] == 0
+    for name in ("start", "buy", "payment_check", "status"):
+        assert phases[name]["telegram_calls"] == USERS, name
+    for name in ("start", "buy", "status"):
+        assert phases[name]["p50_ms"] <= phases[name]["p99_ms"], name
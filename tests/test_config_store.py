@@ -0,0 +1,136 @@
+"""
+Каталог фрагментов конфигурации V2Ray (V2RAY_CONFIG_LAYOUT=sharded):
+перенос, сборка основного файла и сверка с ним.
+"""
+import json
+import os
+
+import pytest
+
+from vpn.client_registry import ClientRegistry
+from vpn.config_mutator import check_layout
+from vpn.config_store import ShardedStore, export_shards, migrate_to_shards, verify_shards
+
+SHARDS = 4
+
+
+def _config(count: int) -> dict:
+    clients = [{"id": f"uuid-{i}", "email": f"user_{i}@vpn.local", "level": 0} for i in range(count)]
+    return {
+        "log": {"loglevel": "warning"},
+        "inbounds": [{"tag": "vmess-in", "port": 443, "protocol": "vmess", "settings": {"clients": clients}}],
+        "outbounds": [{"protocol": "freedom"}],
+    }
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    config_path = str(tmp_path / "config.json")
+    directory = str(tmp_path / "config.d")
+    with open(config_path, "w") as f:
+        json.dump(_config(50), f)
+    assert migrate_to_shards(config_path, directory, SHARDS) == 50
+    return config_path, directory
+
+
+def _clean(report: dict) -> bool:
+    return not any(report[key] for key in ("missing", "extra", "uuid_mismatch", "misplaced", "static"))
+
+
+def test_migrate_matches_single_file(sharded):
+    config_path, directory = sharded
+    assert _clean(verify_shards(config_path, directory, SHARDS))
+
+    # Клиенты разложены по своим сегментам, базовый файл без клиентов
+    store = ShardedStore(directory, SHARDS, config_path)
+    config, clients = store.load()
+    assert config["inbounds"][0]["settings"]["clients"] == []
+    assert sorted(client["email"] for client in clients) == sorted(f"user_{i}@vpn.local" for i in range(50))
+    assert len(os.listdir(directory)) == SHARDS + 1
+
+
+def test_export_rebuilds_single_file(sharded):
+    config_path, directory = sharded
+    os.remove(config_path)
+    assert export_shards(config_path, directory, SHARDS) == 50
+    assert _clean(verify_shards(config_path, directory, SHARDS))
+    with open(config_path) as f:
+        exported = json.load(f)
+    expected = _config(50)
+    key = lambda client: client["email"]
+    assert sorted(exported["inbounds"][0]["settings"]["clients"], key=key) == \
+        sorted(expected["inbounds"][0]["settings"]["clients"], key=key)
+    exported["inbounds"][0]["settings"]["clients"] = expected["inbounds"][0]["settings"]["clients"] = []
+    assert exported == expected
+
+
+def test_verify_detects_divergence(sharded):
+    config_path, directory = sharded
+    with open(config_path) as f:
+        config = json.load(f)
+    clients = config["inbounds"][0]["settings"]["clients"]
+    clients[0]["id"] = "changed"
+    removed = clients.pop()
+    clients.append({"id": "uuid-new", "email": "user_999@vpn.local", "level": 0})
+    config["log"]["loglevel"] = "debug"
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    report = verify_shards(config_path, directory, SHARDS)
+    assert report["uuid_mismatch"] == ["user_0@vpn.local"]
+    assert report["missing"] == [removed["email"]]
+    assert report["extra"] == ["user_999@vpn.local"]
+    assert report["static"] is True
+
+
+def test_verify_detects_misplaced_client(sharded):
+    config_path, directory = sharded
+    store = ShardedStore(directory, SHARDS, config_path)
+    email = "user_0@vpn.local"
+    own = store.shard_of(email)
+    other = (own + 1) % SHARDS
+    for shard in (own, other):
+        with open(store.shard_path(shard)) as f:
+            fragment = json.load(f)
+        clients = fragment["inbounds"][0]["settings"]["clients"]
+        if shard == own:
+            client = next(c for c in clients if c["email"] == email)
+            clients.remove(client)
+        else:
+            clients.append(client)
+        with open(store.shard_path(shard), "w") as f:
+            json.dump(fragment, f)
+
+    report = verify_shards(config_path, directory, SHARDS)
+    assert report["misplaced"] == [email]
+    assert not report["missing"] and not report["extra"]
+
+
+def test_save_rewrites_only_dirty_shard(sharded):
+    config_path, directory = sharded
+    store = ShardedStore(directory, SHARDS, config_path)
+    config, clients = store.load()
+    registry = ClientRegistry(clients)
+    email = "user_7@vpn.local"
+    # Нулевое время изменения: перезаписанный сегмент получит текущее
+    for shard in range(SHARDS):
+        os.utime(store.shard_path(shard), (0, 0))
+
+    registry.remove(email)
+    assert store.save(config, registry, [email]) > 0
+
+    for shard in range(SHARDS):
+        changed = os.path.getmtime(store.shard_path(shard)) > 0
+        assert changed == (shard == store.shard_of(email))
+    os.remove(config_path)
+    export_shards(config_path, directory, SHARDS)
+    with open(config_path) as f:
+        emails = {client["email"] for client in json.load(f)["inbounds"][0]["settings"]["clients"]}
+    assert email not in emails and len(emails) == 49
+
+
+def test_sharded_requires_v2fly():
+    check_layout("sharded", "v2ray")
+    check_layout("single", "xray")
+    with pytest.raises(ValueError):
+        check_layout("sharded", "xray")
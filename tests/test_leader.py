@@ -0,0 +1,116 @@
+"""
+Выбор ведущего (bot/leader.py): один ведущий на аренду, переход роли и fencing token.
+"""
+import asyncio
+import time
+
+from bot.leader import LeaderElector
+
+TTL = 0.6
+HEARTBEAT = 0.1
+
+
+def _elector(holder: str) -> LeaderElector:
+    return LeaderElector(name="test-leader", ttl=TTL, heartbeat=HEARTBEAT, holder=holder)
+
+
+async def _wait(condition, timeout: float = 3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "условие не выполнено"
+        await asyncio.sleep(0.02)
+
+
+def test_single_leader_and_takeover_on_stop(db):
+    async def scenario():
+        first, second = _elector("first"), _elector("second")
+        first.start()
+        await _wait(lambda: first.is_leader)
+        second.start()
+        await asyncio.sleep(TTL * 2)
+        assert first.is_leader and not second.is_leader
+        assert first.token == 1 and first.fence()
+        assert not second.fence()
+
+        # Штатная остановка освобождает аренду: второй занимает ее без ожидания TTL
+        await first.stop()
+        await _wait(lambda: second.is_leader, timeout=TTL)
+        assert second.token == 2 and second.fence()
+        assert not db.check_lease("test-leader", "first", 1)
+        await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stale_leader_is_fenced(db):
+    async def scenario():
+        first, second = _elector("first"), _elector("second")
+        first.start()
+        await _wait(lambda: first.is_leader)
+        second.start()
+
+        # Ведущий "завис": аренда не продлевается и не освобождается
+        first._task.cancel()
+        await asyncio.gather(first._task, return_exceptions=True)
+        stale_token = first.token
+        await _wait(lambda: second.is_leader)
+        assert second.token == stale_token + 1
+        # Бывший ведущий еще считает токен своим, но проверка в базе его отклоняет
+        assert first.token == stale_token
+        assert not first.is_leader and not first.fence()
+        assert second.fence()
+        await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_slow_duties_keep_lease(db):
+    async def scenario():
+        started, finished = asyncio.Event(), asyncio.Event()
+
+        async def slow_start():
+            started.set()
+            await asyncio.sleep(TTL * 4)
+            finished.set()
+
+        first, second = _elector("first"), _elector("second")
+        first.on_elected(slow_start)
+        first.start()
+        await asyncio.wait_for(started.wait(), 3)
+        second.start()
+        # Аренда продлевается, пока выполняется долгий запуск задач ведущего
+        await asyncio.wait_for(finished.wait(), TTL * 6)
+        assert first.is_leader and first.fence()
+        assert not second.is_leader
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_demotion_cancels_duties(db):
+    async def scenario():
+        events = []
+
+        async def never_ready():
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                events.append("cancelled")
+                raise
+
+        async def demoted():
+            events.append("demoted")
+
+        elector = _elector("first")
+        elector.on_elected(never_ready)
+        elector.on_demoted(demoted)
+        elector.start()
+        await _wait(lambda: elector.is_leader)
+        await asyncio.sleep(0.05)
+        await elector.stop()
+        # Незавершенный запуск прерывается до обработчиков потери роли
+        assert events == ["cancelled", "demoted"]
+        assert db.get_lease("test-leader")["expires_at"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,329 @@
+"""
+Анализ журнала доступа V2Ray: ограничение числа устройств на пользователя.
+
+Журнал (V2RAY_ACCESS_LOG) читается с места, где чтение остановилось: позиция
+после последней обработанной строки и inode файла сохраняются в таблице
+log_cursors, поэтому после перезапуска старые записи не читаются повторно.
+Смена inode означает ротацию: остаток прежнего файла дочитывается через уже
+открытый дескриптор, затем чтение идет с начала нового файла; уменьшение
+размера (copytruncate) - чтение с начала. При первом запуске чтение начинается
+с конца файла.
+
+Данные читаются блоками ACCESS_LOG_CHUNK_SIZE в потоке, строки разбираются
+одним регулярным выражением по всему блоку, и для каждой пары (пользователь,
+IP-адрес) остается только время последнего подключения. По этим данным в
+скользящем окне DEVICE_WINDOW_SECONDS считается число различных IP-адресов
+пользователя; при превышении DEVICE_LIMIT вызывается on_violation.
+Журнал читает только ведущий процесс на узле, где он записывается.
+"""
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from db.async_database import get_log_cursor, save_log_cursor
+from vpn.client_registry import CLIENT_EMAIL_DOMAIN
+from db import metrics
+
+logger = logging.getLogger(__name__)
+
+ACCESS_LOG_ENABLED = os.getenv("ACCESS_LOG_ENABLED", "false").lower() == "true"
+V2RAY_ACCESS_LOG = os.getenv("V2RAY_ACCESS_LOG", "/var/log/v2ray/access.log")
+# Интервал проверки новых записей (секунды)
+ACCESS_LOG_INTERVAL = float(os.getenv("ACCESS_LOG_INTERVAL", "5"))
+# Размер блока чтения и максимальный объем чтения за один цикл (байты)
+ACCESS_LOG_CHUNK_SIZE = int(os.getenv("ACCESS_LOG_CHUNK_SIZE", str(1024 * 1024)))
+ACCESS_LOG_MAX_READ = int(os.getenv("ACCESS_LOG_MAX_READ", str(64 * 1024 * 1024)))
+# Допустимое число различных IP-адресов пользователя за окно (секунды)
+DEVICE_LIMIT = int(os.getenv("DEVICE_LIMIT", "3"))
+DEVICE_WINDOW_SECONDS = float(os.getenv("DEVICE_WINDOW_SECONDS", "600"))
+# Повторное срабатывание для того же пользователя не раньше чем через (секунды)
+DEVICE_LIMIT_COOLDOWN = float(os.getenv("DEVICE_LIMIT_COOLDOWN", "3600"))
+# Действие при превышении: flag - уведомить администратора, suspend - также
+# временно отключить пользователя; после блокировки выдается новый UUID
+DEVICE_LIMIT_ACTION = os.getenv("DEVICE_LIMIT_ACTION", "flag").lower()
+DEVICE_SUSPEND_MINUTES = float(os.getenv("DEVICE_SUSPEND_MINUTES", "30"))
+
+ACCESS_LOG_BYTES = metrics.counter("access_log_bytes_total", "Прочитано байт журнала доступа V2Ray")
+ACCESS_LOG_CONNECTIONS = metrics.counter(
+    "access_log_connections_total", "Подключения пользователей бота в журнале доступа V2Ray"
+)
+DEVICE_LIMIT_VIOLATIONS = metrics.counter("device_limit_violations_total", "Превышения числа устройств")
+
+# Строка журнала v2fly/Xray:
+# 2024/01/02 15:04:05 [from ]1.2.3.4:5678 accepted tcp:example.com:443 [in -> out] email: user_1@domain
+_LINE_RE = re.compile(
+    rb"^(\d{4}/\d\d/\d\d \d\d:\d\d:\d\d)\S* (?:from )?(?:tcp:|udp:)?(\S+):\d+ accepted [^\n]*? email: user_(\d+)@"
+    + re.escape(CLIENT_EMAIL_DOMAIN.encode()),
+    re.MULTILINE
+)
+
+
+def parse_chunk(data: bytes, connections: dict) -> int:
+    """
+    Разбирает блок целых строк журнала и обновляет connections:
+    {user_id: {ip: время последнего подключения}}. Возвращает число подключений.
+    """
+    times = {}
+    count = 0
+    for match in _LINE_RE.finditer(data):
+        stamp, ip, user_id = match.groups()
+        seen = times.get(stamp)
+        if seen is None:
+            # Время в журнале локальное; в блоке обычно немного различных секунд
+            seen = times[stamp] = time.mktime(time.strptime(stamp.decode(), "%Y/%m/%d %H:%M:%S"))
+        user = connections.get(user_id)
+        if user is None:
+            user = connections[user_id] = {}
+        user[ip] = seen
+        count += 1
+    return count
+
+
+class LogTailer:
+    """
+    Последовательное чтение растущего файла с учетом ротации.
+    position - конец последней целой строки, прочитанной из файла с inode.
+    """
+
+    def __init__(self, path: str, chunk_size: int = ACCESS_LOG_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.inode = None
+        self.position = 0
+        self._file = None
+        self._partial = b""
+
+    def restore(self, inode: int, position: int):
+        self.inode = inode
+        self.position = position
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._partial = b""
+
+    def _open(self) -> bool:
+        try:
+            self._file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(self._file.fileno())
+        if self.inode is None:
+            # Первый запуск: прежние записи не разбираются
+            self.position = stat.st_size
+        elif stat.st_ino != self.inode or stat.st_size < self.position:
+            self.position = 0
+        self.inode = stat.st_ino
+        self._file.seek(self.position)
+        return True
+
+    def _drain(self, handle, limit: int) -> int:
+        """
+        Читает открытый файл блоками до конца или limit байт; целые строки передает в handle
+        """
+        total = 0
+        while total < limit:
+            data = self._file.read(self.chunk_size)
+            if not data:
+                break
+            total += len(data)
+            cut = data.rfind(b"\n")
+            if cut < 0:
+                self._partial += data
+                continue
+            block = self._partial + data[:cut + 1]
+            self._partial = data[cut + 1:]
+            self.position = self._file.tell() - len(self._partial)
+            handle(block)
+        return total
+
+    def read(self, handle, limit: int = ACCESS_LOG_MAX_READ) -> int:
+        """
+        Передает в handle(bytes) новые целые строки (не более limit байт за вызов).
+        Возвращает число прочитанных байт.
+        """
+        if self._file is None and not self._open():
+            return 0
+        total = self._drain(handle, limit)
+        if total >= limit:
+            return total
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Файл переименован, новый еще не создан: продолжаем читать прежний
+            return total
+        if stat.st_ino != self.inode:
+            # Ротация: прежний файл дочитан до конца, незавершенная строка тоже обрабатывается
+            if self._partial:
+                handle(self._partial + b"\n")
+            logger.info(f"Журнал {self.path} сменился (ротация), чтение с начала нового файла")
+            self.close()
+            if self._open():
+                total += self._drain(handle, limit - total)
+        elif stat.st_size < self.position:
+            logger.info(f"Журнал {self.path} усечен, чтение с начала")
+            self._file.seek(0)
+            self._partial = b""
+            self.position = 0
+            total += self._drain(handle, limit - total)
+        return total
+
+
+class DeviceWindow:
+    """
+    Различные IP-адреса каждого пользователя за последние window секунд.
+    Адреса пользователя хранятся в порядке последнего подключения, поэтому
+    устаревшие удаляются с начала.
+    """
+
+    def __init__(self, window: float = DEVICE_WINDOW_SECONDS):
+        self.window = window
+        self._users = {}
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def add(self, user_id: int, ip: bytes, seen: float):
+        addresses = self._users.get(user_id)
+        if addresses is None:
+            addresses = self._users[user_id] = OrderedDict()
+        if seen >= addresses.get(ip, seen):
+            addresses[ip] = seen
+            addresses.move_to_end(ip)
+
+    def _expire(self, user_id: int, addresses: OrderedDict, cutoff: float):
+        while addresses:
+            ip, seen = next(iter(addresses.items()))
+            if seen >= cutoff:
+                break
+            del addresses[ip]
+        if not addresses:
+            del self._users[user_id]
+
+    def count(self, user_id: int, now: float) -> int:
+        addresses = self._users.get(user_id)
+        if addresses is None:
+            return 0
+        self._expire(user_id, addresses, now - self.window)
+        return len(addresses)
+
+    def addresses(self, user_id: int) -> list:
+        return [ip.decode() for ip in self._users.get(user_id, ())]
+
+    def forget(self, user_id: int):
+        self._users.pop(user_id, None)
+
+    def prune(self, now: float):
+        cutoff = now - self.window
+        for user_id, addresses in list(self._users.items()):
+            self._expire(user_id, addresses, cutoff)
+
+
+class AccessLogMonitor:
+    """
+    Периодическое чтение журнала доступа. on_violation(user_id, addresses) -
+    асинхронный обработчик превышения числа устройств.
+    """
+
+    def __init__(self, on_violation, path: str = V2RAY_ACCESS_LOG, limit: int = DEVICE_LIMIT,
+                 window: float = DEVICE_WINDOW_SECONDS, interval: float = ACCESS_LOG_INTERVAL,
+                 cooldown: float = DEVICE_LIMIT_COOLDOWN):
+        self.on_violation = on_violation
+        self.path = os.path.abspath(path)
+        self.limit = limit
+        self.interval = interval
+        self.cooldown = cooldown
+        self.tailer = LogTailer(self.path)
+        self.devices = DeviceWindow(window)
+        # Время последнего срабатывания по пользователям
+        self._flagged = {}
+        self._restored = False
+        self._task = None
+        self.violations = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.tailer.close()
+        self._restored = False
+
+    def _read(self):
+        connections = {}
+        counted = [0]
+
+        def handle(block: bytes):
+            counted[0] += parse_chunk(block, connections)
+
+        size = self.tailer.read(handle)
+        return connections, counted[0], size
+
+    async def check_once(self, now: float = None) -> list:
+        """
+        Один цикл: чтение новых записей и проверка пользователей, подключавшихся
+        в них. Возвращает ID пользователей, превысивших лимит.
+        """
+        if not self._restored:
+            cursor = await get_log_cursor(self.path)
+            if cursor is not None:
+                self.tailer.restore(*cursor)
+            self._restored = True
+
+        inode, position = self.tailer.inode, self.tailer.position
+        connections, count, size = await asyncio.to_thread(self._read)
+        ACCESS_LOG_BYTES.inc(size)
+        ACCESS_LOG_CONNECTIONS.inc(count)
+        if (self.tailer.inode, self.tailer.position) != (inode, position):
+            await save_log_cursor(self.path, self.tailer.inode, self.tailer.position)
+
+        now = time.time() if now is None else now
+        violators = []
+        for raw_user_id, addresses in connections.items():
+            user_id = int(raw_user_id)
+            for ip, seen in addresses.items():
+                self.devices.add(user_id, ip.strip(b"[]"), seen)
+            devices = self.devices.count(user_id, now)
+            if devices > self.limit and now - self._flagged.get(user_id, float("-inf")) >= self.cooldown:
+                self._flagged[user_id] = now
+                violators.append((user_id, self.devices.addresses(user_id)))
+                self.devices.forget(user_id)
+
+        for user_id, addresses in violators:
+            self.violations += 1
+            DEVICE_LIMIT_VIOLATIONS.inc()
+            logger.warning(f"Пользователь {user_id}: {len(addresses)} устройств (лимит {self.limit}): {addresses}")
+            try:
+                await self.on_violation(user_id, addresses)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке превышения лимита устройств {user_id}: {e}", exc_info=True)
+        return [user_id for user_id, _ in violators]
+
+    def prune(self, now: float):
+        self.devices.prune(now)
+        self._flagged = {
+            user_id: flagged for user_id, flagged in self._flagged.items() if now - flagged < self.cooldown
+        }
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            try:
+                await self.check_once()
+                if time.monotonic() - last_prune >= self.devices.window:
+                    last_prune = time.monotonic()
+                    self.prune(time.time())
+            except Exception as e:
+                logger.error(f"Ошибка при чтении журнала доступа {self.path}: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
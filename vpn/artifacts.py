@@ -0,0 +1,96 @@
+"""
+Клиентские файлы подключения (конфигурация и QR-код), формируемые в памяти.
+
+Содержимое полностью определяется UUID клиента, адресом и портом сервера, поэтому
+готовые файлы кэшируются по ключу (uuid, server, port). Для каждого ключа также
+запоминается file_id Telegram после первой загрузки, чтобы повторно отправлять
+файл без загрузки. При смене UUID пользователя старые записи удаляются.
+"""
+import json
+import os
+from io import BytesIO
+from db.cache import LRUCache
+
+ARTIFACT_CACHE_SIZE = int(os.getenv("ARTIFACT_CACHE_SIZE", "2000"))
+
+ARTIFACT_KINDS = ("config", "qr")
+
+# Готовые файлы: {key: {'key', 'kind', 'uuid', 'filename', 'data'}}
+artifact_cache = LRUCache(ARTIFACT_CACHE_SIZE, float("inf"))
+# file_id Telegram для уже загруженных файлов: {key: file_id}
+file_id_cache = LRUCache(ARTIFACT_CACHE_SIZE * len(ARTIFACT_KINDS), float("inf"))
+
+
+def artifact_key(kind: str, user_uuid: str, server: str, port) -> str:
+    return f"{kind}:{user_uuid}:{server}:{port}"
+
+
+def client_config(user_id: int, user_uuid: str, server: str, port) -> dict:
+    """
+    Конфигурация клиента для импорта в v2ray
+    """
+    return {
+        "remarks": f"VPN Config for User {user_id}",
+        "v": "2",
+        "ps": f"VPN for User {user_id}",
+        "add": server,
+        "port": str(port),
+        "id": user_uuid,
+        "aid": "0",
+        "net": "tcp",
+        "type": "none",
+        "host": "",
+        "path": "",
+        "tls": "tls"
+    }
+
+
+def vless_url(user_id: int, user_uuid: str, server: str, port) -> str:
+    return f"vless://{user_uuid}@{server}:{port}?security=tls&type=tcp#VPN-User-{user_id}"
+
+
+def render_qr_png(data: str) -> bytes:
+    """
+    Формирует PNG с QR-кодом для строки data
+    """
+    import qrcode
+
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = BytesIO()
+    qr.make_image(fill='black', back_color='white').save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def get_artifact(kind: str, user_id: int, user_uuid: str, server: str, port) -> dict:
+    """
+    Возвращает файл вида kind ('config' или 'qr') из кэша или формирует его
+    """
+    key = artifact_key(kind, user_uuid, server, port)
+    artifact = artifact_cache.get(key)
+    if not LRUCache.is_missing(artifact):
+        return artifact
+
+    if kind == "config":
+        data = json.dumps(client_config(user_id, user_uuid, server, port), indent=2).encode()
+        filename = f"user_{user_id}_config.json"
+    elif kind == "qr":
+        data = render_qr_png(vless_url(user_id, user_uuid, server, port))
+        filename = f"user_{user_id}_qr.png"
+    else:
+        raise ValueError(f"Неизвестный тип файла: {kind}")
+
+    artifact = {'key': key, 'kind': kind, 'uuid': user_uuid, 'filename': filename, 'data': data}
+    artifact_cache.set(key, artifact)
+    return artifact
+
+
+def evict_uuid(user_uuid: str, server: str, port):
+    """
+    Удаляет из кэша файлы и file_id, сформированные для прежнего UUID
+    """
+    for kind in ARTIFACT_KINDS:
+        key = artifact_key(kind, user_uuid, server, port)
+        artifact_cache.invalidate(key)
+        file_id_cache.invalidate(key)
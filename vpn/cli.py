@@ -0,0 +1,355 @@
+"""
+Командная строка для массового управления пользователями VPN.
+
+Заменяет скрипты create_user.sh и remove_user.sh: изменения в базе данных
+выполняются одной транзакцией на всю операцию, а клиенты V2Ray приводятся в
+соответствие с базой одной сверкой (одна запись конфигурации и одна перезагрузка
+на узел), а не перезапуском сервиса для каждого пользователя.
+
+Примеры:
+    vpnctl import users.csv --days 30
+    vpnctl export --format jsonl --active -o users.jsonl
+    vpnctl extend 1001 1002 --days 30
+    vpnctl expire --file expired.txt
+    vpnctl reconcile --dry-run
+    vpnctl config-migrate --shards 64
+    vpnctl config-verify
+    vpnctl config-export
+    vpnctl db-migrate --status
+    vpnctl stats-rebuild
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import sys
+from datetime import datetime, timedelta
+from vpn.config_mutator import CONFIG_SHARDS
+
+EXPORT_FIELDS = ("user_id", "start_date", "end_date", "v2ray_id", "node_id")
+
+
+def _detect_format(path: str, fmt: str) -> str:
+    if fmt:
+        return fmt
+    return "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+
+
+def _open_input(path: str):
+    return sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+
+
+def read_records(path: str, fmt: str = None):
+    """
+    Читает записи пользователей из CSV (с заголовком) или JSONL: словари с ключами
+    user_id, end_date, v2ray_id, node_id (кроме user_id все необязательны)
+    """
+    fmt = _detect_format(path, fmt)
+    with _open_input(path) as f:
+        if fmt == "csv":
+            return list(csv.DictReader(f))
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_records(records, days: int = None):
+    """
+    Проверяет записи и преобразует их в строки для import_users.
+    days - срок подписки для записей без end_date.
+    """
+    default_end = (datetime.now() + timedelta(days=days)).isoformat() if days else None
+    rows = []
+    for number, record in enumerate(records, 1):
+        try:
+            user_id = int(record['user_id'])
+            end_date = record.get('end_date') or default_end
+            if end_date:
+                end_date = datetime.fromisoformat(end_date).isoformat()
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Запись {number}: некорректные данные ({e})") from e
+        rows.append((user_id, end_date, record.get('v2ray_id') or None, record.get('node_id') or None))
+    return rows
+
+
+def read_ids(ids, path: str = None):
+    """
+    ID пользователей из аргументов и файла (по одному в строке; берется первое
+    поле строки CSV, строки без числа, например заголовок, пропускаются)
+    """
+    result = [int(user_id) for user_id in ids]
+    if path:
+        with _open_input(path) as f:
+            for line in f:
+                value = line.split(",", 1)[0].strip()
+                if value.isdigit():
+                    result.append(int(value))
+    return list(dict.fromkeys(result))
+
+
+def write_records(users, output, fmt: str):
+    if fmt == "csv":
+        writer = csv.DictWriter(output, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(users)
+    else:
+        for user in users:
+            output.write(json.dumps({field: user[field] for field in EXPORT_FIELDS}, ensure_ascii=False) + "\n")
+
+
+def print_reconcile_report(report: dict, dry_run: bool):
+    prefix = "Будет" if dry_run else "Выполнено"
+    print(f"{prefix}: выдано UUID {report['uuids']}, назначено узлов {report['placed']}")
+    for node_id, node_report in report['nodes'].items():
+        if 'error' in node_report and 'missing' not in node_report:
+            print(f"  {node_id}: ошибка: {node_report['error']}")
+            continue
+        line = (
+            f"  {node_id}: нет клиента {node_report['missing']}, другой UUID {node_report['uuid_mismatch']}, "
+            f"лишних {node_report['orphaned']}"
+        )
+        if 'added' in node_report:
+            line += f"; добавлено {node_report['added']}, удалено {node_report['removed']}"
+        if 'error' in node_report:
+            line += f"; ошибка: {node_report['error']}"
+        print(line)
+
+
+async def _reconcile(dry_run: bool = False):
+    from vpn.vpn_manager import reconcile_clients, get_node_pool
+
+    try:
+        report = await reconcile_clients(dry_run)
+    finally:
+        await get_node_pool().close()
+    print_reconcile_report(report, dry_run)
+    return 1 if any('error' in node_report for node_report in report['nodes'].values()) else 0
+
+
+async def cmd_import(args):
+    from db.async_database import import_users
+
+    rows = parse_records(read_records(args.file, args.format), args.days)
+    count = await import_users(rows)
+    print(f"Импортировано пользователей: {count}")
+    return 0 if args.no_reconcile else await _reconcile()
+
+
+async def cmd_export(args):
+    from db.async_database import export_users
+
+    users = await export_users(args.active)
+    fmt = args.format or (_detect_format(args.output, None) if args.output else "csv")
+    if args.output:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            write_records(users, f, fmt)
+        print(f"Выгружено пользователей: {len(users)}", file=sys.stderr)
+    else:
+        write_records(users, sys.stdout, fmt)
+    return 0
+
+
+async def cmd_extend(args):
+    from db.async_database import extend_users
+
+    user_ids = read_ids(args.ids, args.file)
+    if not user_ids:
+        print("Не указаны пользователи", file=sys.stderr)
+        return 1
+    count = await extend_users(user_ids, args.days)
+    print(f"Подписка продлена на {args.days} дн. пользователям: {count}")
+    return 0 if args.no_reconcile else await _reconcile()
+
+
+async def cmd_expire(args):
+    from db.async_database import cancel_subscriptions
+
+    user_ids = read_ids(args.ids, args.file)
+    if not user_ids:
+        print("Не указаны пользователи", file=sys.stderr)
+        return 1
+    count = await cancel_subscriptions(user_ids)
+    print(f"Подписка завершена пользователям: {count}")
+    return 0 if args.no_reconcile else await _reconcile()
+
+
+async def cmd_reconcile(args):
+    return await _reconcile(args.dry_run)
+
+
+async def cmd_nodes(args):
+    from vpn.vpn_manager import get_node_pool
+
+    pool = get_node_pool()
+    await pool.load()
+    for node_id, node in pool.nodes.items():
+        print(
+            f"{node_id}\t{node['status']}\t{pool.loads.get(node_id, 0)}/{node['capacity']}\t"
+            f"{node['address']}:{node['port']}"
+        )
+    return 0
+
+
+async def cmd_config_migrate(args):
+    from vpn.config_mutator import check_layout, shards_dir
+    from vpn.config_store import migrate_to_shards, verify_shards
+    from vpn.vpn_manager import V2RAY_CONFIG_PATH
+
+    try:
+        check_layout("sharded")
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    directory = args.dir or shards_dir(V2RAY_CONFIG_PATH)
+    count = await asyncio.to_thread(migrate_to_shards, V2RAY_CONFIG_PATH, directory, args.shards)
+    print(f"Перенесено клиентов: {count} в {directory} ({args.shards} сегментов)")
+    report = await asyncio.to_thread(verify_shards, V2RAY_CONFIG_PATH, directory, args.shards)
+    return print_verify_report(report)
+
+
+async def cmd_config_verify(args):
+    from vpn.config_mutator import shards_dir
+    from vpn.config_store import verify_shards
+    from vpn.vpn_manager import V2RAY_CONFIG_PATH
+
+    directory = args.dir or shards_dir(V2RAY_CONFIG_PATH)
+    report = await asyncio.to_thread(verify_shards, V2RAY_CONFIG_PATH, directory, args.shards)
+    return print_verify_report(report)
+
+
+async def cmd_config_export(args):
+    from vpn.config_mutator import shards_dir
+    from vpn.config_store import export_shards
+    from vpn.vpn_manager import V2RAY_CONFIG_PATH
+
+    directory = args.dir or shards_dir(V2RAY_CONFIG_PATH)
+    count = await asyncio.to_thread(export_shards, V2RAY_CONFIG_PATH, directory, args.shards)
+    print(f"Конфигурация собрана в {V2RAY_CONFIG_PATH}: клиентов {count}")
+    return 0
+
+
+async def cmd_db_migrate(args):
+    from db import database, migrations
+
+    def run():
+        with database.get_db_connection() as conn:
+            current = migrations.get_version(conn)
+            if args.status:
+                return current, current
+            return current, migrations.migrate(conn, args.target)
+
+    before, after = await asyncio.to_thread(run)
+    latest = migrations.MIGRATIONS[-1][0]
+    if args.status or before == after:
+        print(f"Версия схемы: {after} (последняя миграция: {latest})")
+    else:
+        print(f"Схема обновлена: {before} -> {after} (последняя миграция: {latest})")
+    return 0
+
+
+async def cmd_stats_rebuild(args):
+    from db.async_database import rebuild_stats
+
+    counters = await rebuild_stats()
+    print(
+        f"Статистика пересчитана: пользователей {counters.get('users', 0)}, "
+        f"активных подписок {counters.get('active', 0)}"
+    )
+    return 0
+
+
+def print_verify_report(report: dict) -> int:
+    problems = {key: value for key, value in report.items() if value}
+    if not problems:
+        print("Фрагменты совпадают с основным файлом конфигурации")
+        return 0
+    print(
+        f"Расхождения: нет в файле {len(report['missing'])}, нет во фрагментах {len(report['extra'])}, "
+        f"другой UUID {len(report['uuid_mismatch'])}, не в своем сегменте {len(report['misplaced'])}, "
+        f"статические разделы {'различаются' if report['static'] else 'совпадают'}"
+    )
+    return 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="vpnctl", description="Массовое управление пользователями VPN")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог")
+    # Команды, работающие с базой, сначала применяют миграции схемы
+    parser.set_defaults(database=True)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import", help="импорт пользователей из CSV или JSONL")
+    command.add_argument("file", help="файл (- для stdin)")
+    command.add_argument("--format", choices=("csv", "jsonl"), help="формат (по умолчанию - по расширению)")
+    command.add_argument("--days", type=int, help="срок подписки для записей без end_date")
+    command.add_argument("--no-reconcile", action="store_true", help="не применять изменения к V2Ray")
+    command.set_defaults(handler=cmd_import)
+
+    command = commands.add_parser("export", help="выгрузка пользователей в CSV или JSONL")
+    command.add_argument("-o", "--output", help="файл (по умолчанию - stdout)")
+    command.add_argument("--format", choices=("csv", "jsonl"), help="формат (по умолчанию - csv)")
+    command.add_argument("--active", action="store_true", help="только с активной подпиской")
+    command.set_defaults(handler=cmd_export)
+
+    command = commands.add_parser("extend", help="продление подписки")
+    command.add_argument("ids", nargs="*", help="ID пользователей")
+    command.add_argument("--file", help="файл со списком ID")
+    command.add_argument("--days", type=int, required=True, help="на сколько дней продлить")
+    command.add_argument("--no-reconcile", action="store_true", help="не применять изменения к V2Ray")
+    command.set_defaults(handler=cmd_extend)
+
+    command = commands.add_parser("expire", help="досрочное завершение подписки")
+    command.add_argument("ids", nargs="*", help="ID пользователей")
+    command.add_argument("--file", help="файл со списком ID")
+    command.add_argument("--no-reconcile", action="store_true", help="не применять изменения к V2Ray")
+    command.set_defaults(handler=cmd_expire)
+
+    command = commands.add_parser("reconcile", help="сверка клиентов V2Ray с базой данных")
+    command.add_argument("--dry-run", action="store_true", help="только показать расхождения")
+    command.set_defaults(handler=cmd_reconcile)
+
+    command = commands.add_parser("nodes", help="список узлов V2Ray и их загрузка")
+    command.set_defaults(handler=cmd_nodes)
+
+    command = commands.add_parser("config-migrate", help="перенос конфигурации V2Ray во фрагменты")
+    command.add_argument("--shards", type=int, default=CONFIG_SHARDS, help="число сегментов клиентов")
+    command.add_argument("--dir", help="каталог фрагментов (по умолчанию <config>.d)")
+    command.set_defaults(handler=cmd_config_migrate, database=False)
+
+    command = commands.add_parser("config-verify", help="сверка фрагментов с основным файлом конфигурации")
+    command.add_argument("--shards", type=int, default=CONFIG_SHARDS, help="число сегментов клиентов")
+    command.add_argument("--dir", help="каталог фрагментов (по умолчанию <config>.d)")
+    command.set_defaults(handler=cmd_config_verify, database=False)
+
+    command = commands.add_parser("config-export", help="сборка фрагментов в основной файл конфигурации")
+    command.add_argument("--shards", type=int, default=CONFIG_SHARDS, help="число сегментов клиентов")
+    command.add_argument("--dir", help="каталог фрагментов (по умолчанию <config>.d)")
+    command.set_defaults(handler=cmd_config_export, database=False)
+
+    command = commands.add_parser("db-migrate", help="применение миграций схемы базы данных")
+    command.add_argument("--target", type=int, help="применить миграции до этой версии включительно")
+    command.add_argument("--status", action="store_true", help="только показать текущую версию")
+    command.set_defaults(handler=cmd_db_migrate, database=False)
+
+    command = commands.add_parser("stats-rebuild", help="пересчет счетчиков статистики администратора")
+    command.set_defaults(handler=cmd_stats_rebuild)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    try:
+        if args.database:
+            from db.database import init_db
+            init_db()
+        return asyncio.run(args.handler(args))
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
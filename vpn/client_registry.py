@@ -0,0 +1,148 @@
+"""
+Реестр клиентов входящего подключения V2Ray в памяти.
+
+Загружается из конфигурации один раз и дальше меняется вместе с ней, поэтому
+поиск, добавление и удаление клиента выполняются за O(1) по uuid, email или
+user_id, а список для записи конфигурации берется из реестра без повторного
+разбора файла. Также умеет сравнивать себя с файлом и таблицей users.
+"""
+import re
+from datetime import datetime
+
+CLIENT_EMAIL_DOMAIN = "vpn.example.com"
+CLIENT_FLOW = "xtls-rprx-vision"
+
+_EMAIL_RE = re.compile(r"^user_(\d+)@")
+
+
+def client_email(user_id: int) -> str:
+    return f"user_{user_id}@{CLIENT_EMAIL_DOMAIN}"
+
+
+def make_client(user_id: int, user_uuid: str) -> dict:
+    """
+    Запись клиента VLESS для пользователя бота
+    """
+    return {
+        "id": user_uuid,
+        "flow": CLIENT_FLOW,
+        "level": 0,
+        "email": client_email(user_id)
+    }
+
+
+def user_id_from_email(email: str):
+    """
+    user_id клиента по его email или None для клиентов, добавленных не ботом
+    """
+    match = _EMAIL_RE.match(email or "")
+    return int(match.group(1)) if match else None
+
+
+class ClientRegistry:
+    """
+    Клиенты с индексами по email, uuid и user_id.
+    Порядок клиентов (порядок добавления) сохраняется при записи конфигурации.
+    """
+
+    def __init__(self, clients=()):
+        self._by_email = {}
+        self._by_uuid = {}
+        self._by_user = {}
+        for client in clients:
+            self.add(client)
+
+    def __len__(self) -> int:
+        return len(self._by_email)
+
+    def __contains__(self, email: str) -> bool:
+        return email in self._by_email
+
+    def get_by_email(self, email: str):
+        return self._by_email.get(email)
+
+    def get_by_uuid(self, user_uuid: str):
+        return self._by_uuid.get(user_uuid)
+
+    def get_by_user(self, user_id: int):
+        return self._by_user.get(user_id)
+
+    def add(self, client: dict):
+        """
+        Добавляет клиента. Возвращает (запись, добавлен ли новый клиент):
+        если клиент с таким email уже есть, возвращается существующая запись.
+        """
+        email = client.get('email')
+        existing = self._by_email.get(email)
+        if existing is not None:
+            return existing, False
+        owner = self._by_uuid.get(client['id'])
+        if owner is not None:
+            raise ValueError(f"UUID {client['id']} уже используется клиентом {owner.get('email')}")
+
+        client = dict(client)
+        self._by_email[email] = client
+        self._by_uuid[client['id']] = client
+        user_id = user_id_from_email(email)
+        if user_id is not None:
+            self._by_user[user_id] = client
+        return client, True
+
+    def remove(self, email: str):
+        """
+        Удаляет клиента по email и возвращает его запись (или None)
+        """
+        client = self._by_email.pop(email, None)
+        if client is None:
+            return None
+        self._by_uuid.pop(client['id'], None)
+        user_id = user_id_from_email(email)
+        if user_id is not None and self._by_user.get(user_id) is client:
+            del self._by_user[user_id]
+        return client
+
+    def clients(self) -> list:
+        """
+        Список клиентов для записи в конфигурацию
+        """
+        return list(self._by_email.values())
+
+    def diff_clients(self, clients) -> dict:
+        """
+        Расхождения с другим списком клиентов (например, прочитанным из файла)
+        """
+        other = {client.get('email'): client for client in clients}
+        return {
+            'missing': sorted(email for email in self._by_email if email not in other),
+            'extra': sorted(email for email in other if email not in self._by_email),
+            'uuid_mismatch': sorted(
+                email for email, client in other.items()
+                if email in self._by_email and self._by_email[email]['id'] != client.get('id')
+            ),
+        }
+
+    def diff_users(self, users, now: datetime = None) -> dict:
+        """
+        Расхождения с таблицей users: users - строки (user_id, v2ray_id, end_date).
+        Активный пользователь должен быть в реестре с тем же uuid, а клиенты бота
+        без активной подписки в реестре лишние.
+        """
+        now = now or datetime.now()
+        active = {}
+        for user_id, v2ray_id, end_date in users:
+            if end_date and datetime.fromisoformat(end_date) > now:
+                active[user_id] = v2ray_id
+
+        missing, uuid_mismatch = [], []
+        for user_id, v2ray_id in active.items():
+            client = self._by_user.get(user_id)
+            if client is None:
+                missing.append(user_id)
+            elif client['id'] != v2ray_id:
+                uuid_mismatch.append(user_id)
+        orphaned = [user_id for user_id in self._by_user if user_id not in active]
+        return {
+            'missing': sorted(missing),
+            'uuid_mismatch': sorted(uuid_mismatch),
+            'orphaned': sorted(orphaned),
+        }
@@ -0,0 +1,419 @@
+"""
+Последовательное применение изменений конфигурации V2Ray.
+
+Все добавления и удаления клиентов проходят через одну очередь и один обработчик:
+изменения, пришедшие за короткое окно, объединяются в пакет, применяются к
+конфигурации в памяти, записываются на диск одной атомарной записью и
+применяются к работающему V2Ray одним обращением к API или одним перезапуском.
+Клиенты хранятся в индексированном реестре (vpn/client_registry.py), поэтому
+изменение не требует ни разбора файла, ни поиска по списку клиентов.
+"""
+import asyncio
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from db.metrics import counter, histogram
+from vpn.client_registry import ClientRegistry
+from vpn.config_store import SingleFileStore, ShardedStore
+from vpn.v2ray_api import V2RAY_API_FLAVOR
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Окно ожидания для объединения изменений в пакет (секунды)
+CONFIG_DEBOUNCE = float(os.getenv("V2RAY_CONFIG_DEBOUNCE", "0.05"))
+# Максимальное количество изменений в одном пакете
+CONFIG_MAX_BATCH = int(os.getenv("V2RAY_CONFIG_MAX_BATCH", "1000"))
+# Если изменений больше, они применяются одним перезапуском вместо вызовов API
+CONFIG_API_MAX_OPS = int(os.getenv("V2RAY_CONFIG_API_MAX_OPS", "500"))
+# Хранение конфигурации: file - один файл, sharded - каталог фрагментов
+# <config>.d с клиентами по CONFIG_SHARDS сегментам (vpn/config_store.py).
+# Только для v2fly: Xray при -confdir заменяет входящее подключение с тем же tag
+# целиком, а не объединяет списки клиентов
+CONFIG_LAYOUT = os.getenv("V2RAY_CONFIG_LAYOUT", "file").lower()
+CONFIG_SHARDS = int(os.getenv("V2RAY_CONFIG_SHARDS", "64"))
+
+V2RAY_BATCH_SECONDS = histogram("v2ray_batch_seconds", "Время применения пакета изменений V2Ray", ("node",))
+V2RAY_BATCH_SIZE = histogram(
+    "v2ray_batch_size", "Количество изменений в пакете V2Ray", ("node",),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+V2RAY_CONFIG_WRITE_SECONDS = histogram("v2ray_config_write_seconds", "Время записи конфигурации V2Ray", ("node",))
+V2RAY_CONFIG_WRITE_BYTES = counter("v2ray_config_write_bytes_total", "Объем записи конфигурации V2Ray", ("node",))
+V2RAY_API_SECONDS = histogram("v2ray_api_apply_seconds", "Применение пакета через API V2Ray", ("node",))
+V2RAY_RESTART_SECONDS = histogram("v2ray_restart_seconds", "Перезапуск сервиса V2Ray", ("node",))
+
+
+def shards_dir(config_path: str) -> str:
+    """
+    Каталог фрагментов для файла конфигурации: /etc/v2ray/config.json -> /etc/v2ray/config.d
+    """
+    return os.path.splitext(config_path)[0] + ".d"
+
+
+def check_layout(layout: str = CONFIG_LAYOUT, flavor: str = V2RAY_API_FLAVOR):
+    """
+    Проверяет, что сервер умеет собирать конфигурацию из фрагментов
+    """
+    if layout == "sharded" and flavor != "v2ray":
+        raise ValueError(
+            "V2RAY_CONFIG_LAYOUT=sharded поддерживается только для v2fly (V2RAY_API_FLAVOR=v2ray): "
+            "Xray не объединяет клиентов входящих подключений с одинаковым tag"
+        )
+
+
+def make_store(config_path: str, layout: str = CONFIG_LAYOUT, shards: int = CONFIG_SHARDS):
+    """
+    Хранилище конфигурации для файла config_path (None - конфигурация только в памяти)
+    """
+    if config_path is None:
+        return None
+    if layout == "sharded":
+        check_layout(layout)
+        return ShardedStore(shards_dir(config_path), shards, config_path)
+    return SingleFileStore(config_path)
+
+
+class FencingError(RuntimeError):
+    """
+    Процесс больше не ведущий: изменения конфигурации запрещены
+    """
+
+
+class _Mutation:
+    __slots__ = ("action", "client", "future")
+
+    def __init__(self, action: str, client: dict, future: asyncio.Future):
+        self.action = action
+        self.client = client
+        self.future = future
+
+
+class ConfigMutator:
+    """
+    Единственный «владелец» файла конфигурации V2Ray в процессе.
+
+    add_client/remove_client возвращают управление, когда изменение записано
+    на диск и применено к работающему серверу. Без config_path (удаленный узел)
+    изменения применяются только через API, а реестр хранится в памяти.
+    """
+
+    def __init__(self, config_path: str, api_client=None, restart=None,
+                 debounce: float = CONFIG_DEBOUNCE, max_batch: int = CONFIG_MAX_BATCH,
+                 layout: str = CONFIG_LAYOUT, fence=None, node_id: str = None):
+        self.config_path = config_path
+        # Узел в метках метрик
+        self.node_id = node_id or "main"
+        self.store = make_store(config_path, layout)
+        self.api_client = api_client
+        self.restart = restart
+        # Проверка fencing token ведущего процесса (bot/leader.py) перед каждым пакетом
+        self.fence = fence
+        self.debounce = debounce
+        self.max_batch = max_batch
+        self._queue = None
+        self._worker = None
+        self._config = None
+        self.registry = None
+        # Статистика для диагностики
+        self.batches = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.restarts = 0
+        self._batch_seconds = V2RAY_BATCH_SECONDS.labels(self.node_id)
+        self._batch_size = V2RAY_BATCH_SIZE.labels(self.node_id)
+        self._write_seconds = V2RAY_CONFIG_WRITE_SECONDS.labels(self.node_id)
+        self._write_bytes = V2RAY_CONFIG_WRITE_BYTES.labels(self.node_id)
+        self._api_seconds = V2RAY_API_SECONDS.labels(self.node_id)
+        self._restart_seconds = V2RAY_RESTART_SECONDS.labels(self.node_id)
+
+    # --- Публичный интерфейс ---
+
+    @property
+    def pending(self) -> int:
+        """
+        Изменения, ожидающие применения
+        """
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def add_client(self, client: dict) -> dict:
+        """
+        Добавляет клиента (по email). Если клиент уже есть, возвращает существующую запись.
+        """
+        return await self._submit("add", client)
+
+    async def remove_client(self, email: str) -> bool:
+        """
+        Удаляет клиента по email. Возвращает True, если клиент был в конфигурации.
+        """
+        return await self._submit("remove", {"email": email})
+
+    async def apply_bulk(self, adds=(), removes=()) -> dict:
+        """
+        Применяет набор изменений одним пакетом: сначала удаление клиентов
+        по email из removes, затем добавление клиентов из adds.
+        Возвращает {'added': N, 'removed': N}.
+        """
+        return await self._submit("bulk", {"email": None, "adds": list(adds), "removes": list(removes)})
+
+    async def load(self) -> ClientRegistry:
+        """
+        Загружает конфигурацию и реестр клиентов (если еще не загружены)
+        """
+        await asyncio.to_thread(self._load_config)
+        return self.registry
+
+    async def check_drift(self, users) -> dict:
+        """
+        Сравнивает реестр с файлом конфигурации и с таблицей users
+        (строки (user_id, v2ray_id, end_date)). Возвращает найденные расхождения.
+        """
+        if self.registry is None:
+            await self.load()
+        file_clients = await asyncio.to_thread(self._read_file_clients)
+        return {
+            'file': self.registry.diff_clients(file_clients),
+            'users': self.registry.diff_users(users),
+        }
+
+    async def export_config(self):
+        """
+        Записывает полную конфигурацию в основной файл, если клиенты хранятся во
+        фрагментах (только по явному запросу: запись занимает O(число клиентов))
+        """
+        if self.store is None:
+            return
+        await asyncio.to_thread(self._load_config)
+        await asyncio.to_thread(self.store.export, self._config, self.registry)
+
+    async def close(self):
+        """
+        Дожидается применения всех изменений и останавливает обработчик
+        """
+        if self._worker is None:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._queue = None
+
+    # --- Внутренняя логика ---
+
+    async def _submit(self, action: str, client: dict):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put(_Mutation(action, client, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Собираем изменения, пришедшие в течение окна ожидания
+            deadline = asyncio.get_running_loop().time() + self.debounce
+            while len(batch) < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            started = time.perf_counter()
+            try:
+                await self._process(batch)
+            except Exception as e:
+                logger.error(f"Ошибка при применении пакета изменений V2Ray: {e}", exc_info=True)
+                for mutation in batch:
+                    if not mutation.future.done():
+                        mutation.future.set_exception(e)
+            finally:
+                self._batch_seconds.observe(time.perf_counter() - started)
+                self._batch_size.observe(len(batch))
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _load_config(self) -> dict:
+        """
+        Читает конфигурацию с диска только при первом обращении или если файлы
+        были изменены извне (например, вручную)
+        """
+        if self.store is None:
+            if self._config is None:
+                self._config = {"inbounds": [{"settings": {"clients": []}}]}
+                self.registry = ClientRegistry()
+            return self._config
+        if self._config is None or self.store.changed():
+            if self._config is not None:
+                logger.warning(f"Конфигурация V2Ray изменена извне, перечитываем {self.config_path}")
+            config, clients = self.store.load()
+            self.registry = ClientRegistry(clients)
+            self._config = config
+        return self._config
+
+    def _read_file_clients(self) -> list:
+        if self.store is None:
+            return self.registry.clients()
+        return self.store.read_clients()
+
+    def _write_config(self, emails):
+        if self.store is None:
+            return
+        started = time.perf_counter()
+        size = self.store.save(self._config, self.registry, emails)
+        self._write_seconds.observe(time.perf_counter() - started)
+        self._write_bytes.inc(size)
+        self.bytes_written += size
+        self.writes += 1
+
+    async def _process(self, batch):
+        if self.fence is not None and not await asyncio.to_thread(self.fence):
+            raise FencingError("Процесс не является ведущим, изменение конфигурации V2Ray отклонено")
+        self.batches += 1
+        await asyncio.to_thread(self._load_config)
+        registry = self.registry
+
+        results = []
+        live_ops = []
+        # email клиентов, которые действительно изменились (для записи на диск)
+        changed = []
+        # Обратные операции для отката реестра, если пакет не удалось применить к серверу
+        undo = []
+        for mutation in batch:
+            email = mutation.client['email']
+            if mutation.action == "bulk":
+                counts = {'added': 0, 'removed': 0}
+                for removed_email in mutation.client['removes']:
+                    removed = registry.remove(removed_email)
+                    if removed is not None:
+                        undo.append(("add", removed))
+                        counts['removed'] += 1
+                        changed.append(removed_email)
+                        live_ops.append(("remove", {"email": removed_email}))
+                for client in mutation.client['adds']:
+                    try:
+                        client, added = registry.add(client)
+                    except ValueError as e:
+                        logger.warning(f"V2Ray: клиент {client.get('email')} пропущен: {e}")
+                        continue
+                    if added:
+                        undo.append(("remove", client))
+                        counts['added'] += 1
+                        changed.append(client['email'])
+                        live_ops.append(("add", client))
+                results.append(counts)
+            elif mutation.action == "add":
+                try:
+                    client, added = registry.add(mutation.client)
+                except ValueError as e:
+                    results.append(e)
+                    continue
+                # Уже существующий клиент повторно добавляется в работающий сервер (идемпотентно)
+                if added:
+                    undo.append(("remove", client))
+                    changed.append(client['email'])
+                live_ops.append(("add", client))
+                results.append(client)
+            else:
+                removed = registry.remove(email)
+                existed = removed is not None
+                if existed:
+                    undo.append(("add", removed))
+                    changed.append(email)
+                live_ops.append(("remove", {"email": email}))
+                results.append(existed)
+
+        if changed:
+            try:
+                await asyncio.to_thread(self._write_config, list(dict.fromkeys(changed)))
+            except Exception:
+                # Реестр изменен, а файл нет: при следующем пакете перечитываем файл
+                self._config = None
+                raise
+
+        if live_ops:
+            try:
+                await self._apply_live(live_ops)
+            except Exception:
+                await self._rollback(undo, changed)
+                raise
+
+        for mutation, result in zip(batch, results):
+            if mutation.future.done():
+                continue
+            if isinstance(result, Exception):
+                mutation.future.set_exception(result)
+            else:
+                mutation.future.set_result(result)
+
+        logger.info(
+            f"V2Ray: применен пакет из {len(batch)} изменений "
+            f"(запись конфигурации: {'да' if changed else 'нет'})"
+        )
+
+    async def _rollback(self, undo, changed):
+        """
+        Возвращает реестр (и файл конфигурации) к состоянию до пакета, чтобы
+        повтор задания снова применил изменения к серверу
+        """
+        for action, client in reversed(undo):
+            if action == "add":
+                self.registry.add(client)
+            else:
+                self.registry.remove(client['email'])
+        if changed:
+            try:
+                await asyncio.to_thread(self._write_config, list(dict.fromkeys(changed)))
+            except Exception as e:
+                logger.error(f"V2Ray: не удалось откатить конфигурацию: {e}")
+                self._config = None
+
+    async def _apply_live(self, live_ops):
+        """
+        Применяет пакет к работающему V2Ray через API; крупный пакет или ошибка API -
+        один перезапуск. Без перезапуска (удаленный узел) ошибка API пробрасывается.
+        """
+        if self.api_client is not None and (
+                self.restart is None or len(live_ops) <= CONFIG_API_MAX_OPS):
+            try:
+                # Последняя операция по каждому email определяет итоговое состояние
+                final = {}
+                # Клиенты, удаленные и снова добавленные (смена UUID): на сервере
+                # сначала удаляем прежнюю запись, иначе добавление будет проигнорировано
+                replaced = set()
+                for action, client in live_ops:
+                    previous = final.get(client['email'])
+                    if action == "add" and previous is not None and previous[0] == "remove":
+                        replaced.add(client['email'])
+                    final[client['email']] = (action, client)
+                replaced = [email for email in replaced if final[email][0] == "add"]
+                started = time.perf_counter()
+                if replaced:
+                    await asyncio.gather(*(self.api_client.remove_user(email) for email in replaced))
+                await asyncio.gather(*(
+                    self.api_client.add_user(
+                        client['id'], client['email'], client.get('flow', ''), client.get('level', 0)
+                    ) if action == "add" else self.api_client.remove_user(client['email'])
+                    for action, client in final.values()
+                ))
+                self._api_seconds.observe(time.perf_counter() - started)
+                return
+            except Exception as e:
+                if self.restart is None:
+                    logger.warning(f"V2Ray API недоступен: {e}. Пакет будет применен повторно")
+                    raise
+                logger.warning(f"V2Ray API недоступен: {e}. Перезапускаем сервис")
+        if self.restart is not None:
+            self.restarts += 1
+            started = time.perf_counter()
+            # Конфигурация уже на диске: в режиме sharded сервис читает фрагменты (-confdir)
+            await self.restart()
+            self._restart_seconds.observe(time.perf_counter() - started)
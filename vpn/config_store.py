@@ -0,0 +1,286 @@
+"""
+Хранение конфигурации V2Ray на диске.
+
+SingleFileStore - вся конфигурация в одном файле (по умолчанию): любое изменение
+клиентов перезаписывает файл целиком.
+
+ShardedStore - каталог фрагментов: статические разделы (log, api, TLS, routing)
+лежат в 00_base.json, а клиенты входящего подключения распределены по хэшу email
+по фрагментам 10_clients_XX.json. Изменение клиента перезаписывает только один
+небольшой фрагмент, поэтому объем записи не зависит от числа пользователей.
+Фрагменты имеют формат confdir v2fly (слияние inbounds по tag; Xray так не
+умеет): сервис запускается с -confdir (scripts/v2ray-confdir.conf) и всегда
+читает актуальных клиентов. Основной файл сервисом не читается и собирается
+только по запросу (export_shards) для возврата к хранению в одном файле.
+"""
+import glob
+import json
+import logging
+import os
+import tempfile
+import zlib
+
+logger = logging.getLogger(__name__)
+
+BASE_FILENAME = "00_base.json"
+SHARD_FILENAME = "10_clients_{:02x}.json"
+SHARD_PATTERN = "10_clients_*.json"
+
+
+def atomic_write_json(path: str, data, indent=2):
+    """
+    Атомарно записывает JSON: временный файл + fsync + rename.
+    indent=None - компактная запись без пробелов.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            if indent is None:
+                json.dump(data, f, separators=(",", ":"))
+            else:
+                json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+
+def _inbound(config: dict) -> dict:
+    return config['inbounds'][0]
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class SingleFileStore:
+    """
+    Конфигурация в одном файле
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime = None
+
+    def changed(self) -> bool:
+        """
+        Изменен ли файл после последнего чтения или записи (например, вручную)
+        """
+        return self._mtime is None or _mtime(self.path) != self._mtime
+
+    def load(self):
+        """
+        Читает конфигурацию: (config, список клиентов)
+        """
+        mtime = _mtime(self.path)
+        with open(self.path, 'r') as f:
+            config = json.load(f)
+        self._mtime = mtime
+        return config, _inbound(config)['settings']['clients']
+
+    def read_clients(self) -> list:
+        with open(self.path, 'r') as f:
+            return _inbound(json.load(f))['settings']['clients']
+
+    def save(self, config: dict, registry, emails) -> int:
+        """
+        Записывает конфигурацию с клиентами из реестра. Возвращает размер записи.
+        """
+        _inbound(config)['settings']['clients'] = registry.clients()
+        size = atomic_write_json(self.path, config)
+        self._mtime = _mtime(self.path)
+        return size
+
+    def export(self, config: dict, registry) -> int:
+        # Файл и так содержит полную конфигурацию
+        return 0
+
+
+class ShardedStore:
+    """
+    Каталог фрагментов: базовая конфигурация и клиенты по хэш-сегментам
+    """
+
+    def __init__(self, directory: str, shards: int, merged_path: str):
+        self.directory = directory
+        self.shards = shards
+        self.merged_path = merged_path
+        self._shards = None
+        self._mtimes = None
+
+    @property
+    def base_path(self) -> str:
+        return os.path.join(self.directory, BASE_FILENAME)
+
+    def shard_path(self, shard: int) -> str:
+        return os.path.join(self.directory, SHARD_FILENAME.format(shard))
+
+    def shard_of(self, email: str) -> int:
+        # Стабильный хэш (hash() для строк различается между запусками)
+        return zlib.crc32(email.encode()) % self.shards
+
+    def _shard_files(self) -> list:
+        # Все фрагменты в каталоге, включая оставшиеся от другого числа сегментов
+        return sorted(glob.glob(os.path.join(self.directory, SHARD_PATTERN)))
+
+    def _snapshot(self) -> dict:
+        return {path: _mtime(path) for path in [self.base_path] + self._shard_files()}
+
+    def changed(self) -> bool:
+        return self._mtimes is None or self._snapshot() != self._mtimes
+
+    @staticmethod
+    def _read_file(path: str) -> list:
+        try:
+            with open(path, 'r') as f:
+                return _inbound(json.load(f))['settings']['clients']
+        except FileNotFoundError:
+            return []
+
+    def _write_shard(self, config: dict, shard: int) -> int:
+        path = self.shard_path(shard)
+        size = atomic_write_json(path, self._fragment(config, list(self._shards[shard].values())), indent=None)
+        self._mtimes[path] = _mtime(path)
+        return size
+
+    def load(self):
+        if not os.path.exists(self.base_path):
+            logger.info(f"Каталог фрагментов {self.directory} не найден, переносим {self.merged_path}")
+            migrate_to_shards(self.merged_path, self.directory, self.shards)
+        self._mtimes = self._snapshot()
+        with open(self.base_path, 'r') as f:
+            config = json.load(f)
+        self._shards = [{} for _ in range(self.shards)]
+        expected = {self.shard_path(shard) for shard in range(self.shards)}
+        stale = [path for path in self._mtimes if path != self.base_path and path not in expected]
+        misplaced = False
+        for path in self._mtimes:
+            if path == self.base_path:
+                continue
+            for client in self._read_file(path):
+                email = client.get('email', '')
+                target = self.shard_of(email)
+                misplaced = misplaced or self.shard_path(target) != path
+                self._shards[target][email] = client
+        if misplaced:
+            # Изменилось число сегментов или клиент добавлен вручную не в свой сегмент:
+            # раскладываем клиентов заново
+            logger.warning(f"Клиенты в {self.directory} не в своих сегментах, перезаписываем фрагменты")
+            for shard in range(self.shards):
+                self._write_shard(config, shard)
+            for path in stale:
+                os.unlink(path)
+                self._mtimes.pop(path, None)
+        clients = [client for shard in self._shards for client in shard.values()]
+        return config, clients
+
+    def read_clients(self) -> list:
+        return [client for path in self._shard_files() for client in self._read_file(path)]
+
+    def _fragment(self, config: dict, clients: list) -> dict:
+        return {"inbounds": [{"tag": _inbound(config).get('tag'), "settings": {"clients": clients}}]}
+
+    def save(self, config: dict, registry, emails) -> int:
+        """
+        Перезаписывает только сегменты, в которых изменились клиенты из emails
+        """
+        dirty = set()
+        for email in emails:
+            shard = self.shard_of(email)
+            client = registry.get_by_email(email)
+            if client is None:
+                self._shards[shard].pop(email, None)
+            else:
+                self._shards[shard][email] = client
+            dirty.add(shard)
+        return sum(self._write_shard(config, shard) for shard in sorted(dirty))
+
+    def export(self, config: dict, registry) -> int:
+        """
+        Собирает полную конфигурацию в основной файл (для сверки и возврата к одному файлу)
+        """
+        merged = json.loads(json.dumps(config))
+        _inbound(merged)['settings']['clients'] = registry.clients()
+        return atomic_write_json(self.merged_path, merged)
+
+
+def migrate_to_shards(config_path: str, directory: str, shards: int) -> int:
+    """
+    Переносит конфигурацию из одного файла в каталог фрагментов.
+    Возвращает количество перенесенных клиентов.
+    """
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    clients = _inbound(config)['settings']['clients']
+    os.makedirs(directory, exist_ok=True)
+    store = ShardedStore(directory, shards, config_path)
+    buckets = [[] for _ in range(shards)]
+    for client in clients:
+        buckets[store.shard_of(client.get('email', ''))].append(client)
+
+    base = json.loads(json.dumps(config))
+    _inbound(base)['settings']['clients'] = []
+    # Сначала фрагменты, затем базовый файл: его наличие означает завершенный перенос
+    for shard, bucket in enumerate(buckets):
+        atomic_write_json(store.shard_path(shard), store._fragment(base, bucket), indent=None)
+    # Фрагменты, оставшиеся от переноса с другим числом сегментов
+    expected = {store.shard_path(shard) for shard in range(shards)}
+    for path in store._shard_files():
+        if path not in expected:
+            os.unlink(path)
+    atomic_write_json(store.base_path, base)
+    return len(clients)
+
+
+def export_shards(config_path: str, directory: str, shards: int) -> int:
+    """
+    Собирает полную конфигурацию из фрагментов в основной файл.
+    Возвращает количество клиентов.
+    """
+    from vpn.client_registry import ClientRegistry
+
+    store = ShardedStore(directory, shards, config_path)
+    config, clients = store.load()
+    registry = ClientRegistry(clients)
+    store.export(config, registry)
+    return len(registry)
+
+
+def verify_shards(config_path: str, directory: str, shards: int) -> dict:
+    """
+    Сравнивает собранную из фрагментов конфигурацию с основным файлом.
+    Возвращает расхождения: клиенты (missing - есть во фрагментах, но нет в файле,
+    extra - есть в файле, но нет во фрагментах, uuid_mismatch), misplaced - клиенты не в своем сегменте,
+    static - различаются ли статические разделы.
+    """
+    from vpn.client_registry import ClientRegistry
+
+    store = ShardedStore(directory, shards, config_path)
+    with open(config_path, 'r') as f:
+        merged = json.load(f)
+    with open(store.base_path, 'r') as f:
+        base = json.load(f)
+
+    registry = ClientRegistry()
+    misplaced = []
+    for path in store._shard_files():
+        for client in store._read_file(path):
+            registry.add(client)
+            if store.shard_path(store.shard_of(client.get('email', ''))) != path:
+                misplaced.append(client.get('email'))
+
+    report = registry.diff_clients(_inbound(merged)['settings']['clients'])
+    _inbound(merged)['settings']['clients'] = []
+    report['misplaced'] = sorted(misplaced)
+    report['static'] = merged != base
+    return report
@@ -0,0 +1,130 @@
+"""
+Локальная заглушка gRPC API V2Ray (HandlerService и StatsService) для тестирования
+без реального сервера.
+
+Запуск: python -m vpn.fake_v2ray_api --port 10085
+"""
+import argparse
+import asyncio
+import logging
+from vpn.v2ray_api import decode_message, encode_query_stats_response, type_name, V2RAY_API_FLAVOR
+
+logger = logging.getLogger(__name__)
+
+
+class FakeV2RayApiServer:
+    """
+    Имитирует HandlerService.AlterInbound и StatsService.QueryStats,
+    хранит клиентов и счетчики трафика в памяти
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, flavor: str = None):
+        self.host = host
+        self.port = port
+        self.flavor = flavor or V2RAY_API_FLAVOR
+        # Формат: {inbound_tag: {email: {'id': uuid, 'flow': str, 'level': int}}}
+        self.inbounds = {}
+        self.calls = 0
+        # Счетчики StatsService: {имя: значение}
+        self.stats = {}
+        self.stats_calls = 0
+        self._server = None
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def users(self, tag: str) -> dict:
+        return self.inbounds.setdefault(tag, {})
+
+    def add_traffic(self, email: str, uplink: int = 0, downlink: int = 0):
+        """
+        Увеличивает счетчики трафика пользователя
+        """
+        for direction, value in (("uplink", uplink), ("downlink", downlink)):
+            name = f"user>>>{email}>>>traffic>>>{direction}"
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    async def _query_stats(self, request: bytes, context):
+        self.stats_calls += 1
+        fields = decode_message(request)
+        pattern = fields.get(1, [b""])[0].decode()
+        reset = bool(fields.get(2, [0])[0])
+        result = {name: value for name, value in self.stats.items() if pattern in name}
+        if reset:
+            for name in result:
+                self.stats[name] = 0
+        return encode_query_stats_response(result)
+
+    async def _alter_inbound(self, request: bytes, context):
+        import grpc
+        self.calls += 1
+        fields = decode_message(request)
+        tag = fields.get(1, [b""])[0].decode()
+        operation = decode_message(fields[2][0])
+        op_type = operation[1][0].decode()
+        op_value = decode_message(operation.get(2, [b""])[0])
+        users = self.users(tag)
+
+        if op_type == type_name("app.proxyman.command.AddUserOperation", self.flavor):
+            user = decode_message(op_value[1][0])
+            email = user[2][0].decode()
+            account = decode_message(decode_message(user[3][0])[2][0])
+            if email in users:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} already exists.")
+            users[email] = {
+                'id': account[1][0].decode(),
+                'flow': account.get(2, [b""])[0].decode(),
+                'level': user.get(1, [0])[0],
+            }
+        elif op_type == type_name("app.proxyman.command.RemoveUserOperation", self.flavor):
+            email = op_value[1][0].decode()
+            if email not in users:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+            del users[email]
+        else:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, f"Неизвестная операция {op_type}")
+        return b""
+
+    def _handlers(self):
+        import grpc
+        return [
+            grpc.method_handlers_generic_handler(
+                type_name("app.proxyman.command.HandlerService", self.flavor),
+                {"AlterInbound": grpc.unary_unary_rpc_method_handler(self._alter_inbound)},
+            ),
+            grpc.method_handlers_generic_handler(
+                type_name("app.stats.command.StatsService", self.flavor),
+                {"QueryStats": grpc.unary_unary_rpc_method_handler(self._query_stats)},
+            ),
+        ]
+
+    async def start(self):
+        import grpc
+        self._server = grpc.aio.server()
+        self._server.add_generic_rpc_handlers(self._handlers())
+        self.port = self._server.add_insecure_port(f"{self.host}:{self.port}")
+        await self._server.start()
+        logger.info(f"Заглушка V2Ray API запущена на {self.address}")
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            await self._server.stop(grace=None)
+            self._server = None
+
+
+async def _serve(port: int):
+    server = await FakeV2RayApiServer(port=port).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка gRPC API V2Ray")
+    parser.add_argument("--port", type=int, default=10085)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(args.port))
@@ -0,0 +1,296 @@
+"""
+Пул узлов V2Ray и размещение пользователей по узлам.
+
+Узлы хранятся в таблице nodes (адрес для клиентов, адрес gRPC API, емкость,
+статус), назначение пользователя - в users.node_id. Новые пользователи
+размещаются на наименее загруженном исправном узле. Пользователи с узлов в
+статусе draining, а также излишек с перегруженных узлов переносятся на другие
+узлы (rebalance) с сохранением UUID.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+from dotenv import load_dotenv
+from db.async_database import (
+    get_nodes, upsert_node, set_node_status, get_node_loads, assign_user_node, get_node_users
+)
+from vpn.client_registry import make_client, client_email
+from vpn.config_mutator import ConfigMutator
+from vpn.v2ray_api import V2RayApiClient
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Емкость узла по умолчанию (число пользователей с активной подпиской)
+NODE_CAPACITY = int(os.getenv("V2RAY_NODE_CAPACITY", "1000"))
+# JSON-файл со списком узлов: [{"node_id", "address", "port", "api_address", "config_path", "capacity"}]
+NODES_FILE = os.getenv("V2RAY_NODES_FILE", "")
+# Допустимое превышение средней загрузки (доля емкости), после которого узел разгружается
+REBALANCE_TOLERANCE = float(os.getenv("V2RAY_REBALANCE_TOLERANCE", "0.1"))
+# Максимальное число переносов за один проход
+REBALANCE_MAX_MOVES = int(os.getenv("V2RAY_REBALANCE_MAX_MOVES", "200"))
+NODE_HEALTH_TIMEOUT = float(os.getenv("V2RAY_NODE_HEALTH_TIMEOUT", "3"))
+
+NODE_STATUSES = ("active", "draining", "disabled")
+
+
+class NodePool:
+    """
+    Узлы V2Ray с обработчиками изменений (ConfigMutator) и клиентами API для каждого
+    """
+
+    def __init__(self, default_node: dict, use_api: bool = True, restart=None, fence=None):
+        self.default_node = default_node
+        self.use_api = use_api
+        self.restart = restart
+        self.fence = fence
+        self.nodes = {default_node['node_id']: default_node}
+        self.healthy = {}
+        # Число активных пользователей по узлам (обновляется из базы в refresh_loads)
+        self.loads = {}
+        self._mutators = {}
+        self._api_clients = {}
+
+    @property
+    def default_node_id(self) -> str:
+        return self.default_node['node_id']
+
+    def node(self, node_id: str) -> dict:
+        return self.nodes.get(node_id or self.default_node_id) or self.default_node
+
+    async def load(self):
+        """
+        Загружает узлы из базы. Узлы из V2RAY_NODES_FILE добавляются или обновляются,
+        узел по умолчанию создается, если узлов еще нет.
+        """
+        if NODES_FILE:
+            with open(NODES_FILE) as f:
+                for node in json.load(f):
+                    await upsert_node(
+                        node['node_id'], node['address'], int(node.get('port', 443)),
+                        node.get('api_address'), node.get('config_path'),
+                        int(node.get('capacity', NODE_CAPACITY))
+                    )
+        nodes = await get_nodes()
+        if not nodes:
+            node = self.default_node
+            await upsert_node(node['node_id'], node['address'], node['port'], node['api_address'],
+                              node['config_path'], node['capacity'])
+            nodes = await get_nodes()
+
+        for node in nodes:
+            previous = self.nodes.get(node['node_id'])
+            if previous is not None and (previous['api_address'], previous['config_path']) != (
+                    node['api_address'], node['config_path']):
+                # Изменился адрес API или путь конфигурации - создаем обработчик заново
+                await self._close_node(node['node_id'])
+        self.nodes = {node['node_id']: node for node in nodes}
+        await self.refresh_loads()
+        return self.nodes
+
+    def set_fence(self, fence):
+        """
+        Назначает проверку fencing token для всех обработчиков изменений
+        """
+        self.fence = fence
+        for mutator in self._mutators.values():
+            mutator.fence = fence
+
+    async def refresh_loads(self):
+        self.loads = await get_node_loads()
+        return self.loads
+
+    def api_client(self, node_id: str):
+        node = self.node(node_id)
+        if not self.use_api or not node['api_address']:
+            return None
+        client = self._api_clients.get(node['node_id'])
+        if client is None:
+            client = self._api_clients[node['node_id']] = V2RayApiClient(node['api_address'])
+        return client
+
+    def mutator(self, node_id: str = None) -> ConfigMutator:
+        """
+        Обработчик изменений конфигурации узла
+        """
+        node = self.node(node_id)
+        mutator = self._mutators.get(node['node_id'])
+        if mutator is None:
+            mutator = self._mutators[node['node_id']] = ConfigMutator(
+                node['config_path'],
+                api_client=self.api_client(node['node_id']),
+                # Перезапуск возможен только для локального узла с файлом конфигурации
+                restart=self.restart if node['config_path'] else None,
+                fence=self.fence,
+                node_id=node['node_id']
+            )
+        return mutator
+
+    def pending_mutations(self) -> dict:
+        """
+        Изменения конфигурации в очередях по узлам
+        """
+        return {node_id: mutator.pending for node_id, mutator in self._mutators.items()}
+
+    def usable(self, node_id: str) -> bool:
+        node = self.nodes.get(node_id)
+        return node is not None and node['status'] == "active" and self.healthy.get(node_id, True)
+
+    async def check_health(self):
+        """
+        Проверяет доступность API узлов. Возвращает ID узлов, которые снова стали доступны.
+        """
+        async def probe(node_id):
+            client = self.api_client(node_id)
+            if client is None:
+                return True
+            try:
+                await asyncio.wait_for(client.ping(), NODE_HEALTH_TIMEOUT)
+                return True
+            except Exception as e:
+                logger.warning(f"Узел {node_id} недоступен: {e}")
+                return False
+
+        node_ids = [node_id for node_id, node in self.nodes.items() if node['status'] != "disabled"]
+        results = await asyncio.gather(*(probe(node_id) for node_id in node_ids))
+        recovered = []
+        for node_id, healthy in zip(node_ids, results):
+            if healthy and self.healthy.get(node_id) is False:
+                recovered.append(node_id)
+                logger.info(f"Узел {node_id} снова доступен")
+            self.healthy[node_id] = healthy
+        return recovered
+
+    def choose(self, exclude=()) -> str:
+        """
+        Наименее загруженный (по доле емкости) исправный узел со свободным местом или None
+        """
+        best, best_ratio = None, None
+        for node_id, node in self.nodes.items():
+            if node_id in exclude or not self.usable(node_id):
+                continue
+            load = self.loads.get(node_id, 0)
+            if load >= node['capacity']:
+                continue
+            ratio = load / node['capacity']
+            if best_ratio is None or ratio < best_ratio:
+                best, best_ratio = node_id, ratio
+        return best
+
+    async def place(self, user_id: int):
+        """
+        Назначает пользователю узел и возвращает его ID (None - нет свободных узлов)
+        """
+        node_id = self.choose()
+        if node_id is None:
+            return None
+        # Учитываем сразу, чтобы одновременные размещения не попали на один узел
+        self.loads[node_id] = self.loads.get(node_id, 0) + 1
+        await assign_user_node(user_id, node_id)
+        return node_id
+
+    def release(self, node_id: str):
+        """
+        Учитывает отключение пользователя от узла
+        """
+        if self.loads.get(node_id):
+            self.loads[node_id] -= 1
+
+    async def set_status(self, node_id: str, status: str) -> bool:
+        if status not in NODE_STATUSES:
+            raise ValueError(f"Неизвестный статус узла: {status}")
+        if not await set_node_status(node_id, status):
+            return False
+        if node_id in self.nodes:
+            self.nodes[node_id]['status'] = status
+        return True
+
+    async def sync_node(self, node_id: str) -> int:
+        """
+        Повторно добавляет всех пользователей узла в работающий сервер.
+        Нужно для узлов без файла конфигурации: после их перезапуска клиенты,
+        добавленные через API, теряются.
+        """
+        users = await get_node_users(node_id)
+        mutator = self.mutator(node_id)
+        await asyncio.gather(*(
+            mutator.add_client(make_client(user_id, user_uuid)) for user_id, user_uuid in users if user_uuid
+        ))
+        logger.info(f"Узел {node_id}: синхронизировано клиентов: {len(users)}")
+        return len(users)
+
+    async def move_user(self, user_id: int, user_uuid: str, source: str, target: str):
+        """
+        Переносит пользователя на другой узел с сохранением UUID
+        """
+        await self.mutator(target).add_client(make_client(user_id, user_uuid))
+        await assign_user_node(user_id, target)
+        self.loads[target] = self.loads.get(target, 0) + 1
+        self.release(source)
+        try:
+            await self.mutator(source).remove_client(client_email(user_id))
+        except Exception as e:
+            # Источник может быть недоступен; клиент будет удален при сверке
+            logger.warning(f"Не удалось удалить пользователя {user_id} с узла {source}: {e}")
+
+    def _excess(self) -> dict:
+        """
+        Сколько пользователей нужно снять с каждого узла
+        """
+        excess = {}
+        usable = [node_id for node_id in self.nodes if self.usable(node_id)]
+        for node_id, node in self.nodes.items():
+            if node_id not in usable and node['status'] != "active":
+                # draining и disabled освобождаются полностью
+                excess[node_id] = self.loads.get(node_id, 0)
+        capacity = sum(self.nodes[node_id]['capacity'] for node_id in usable)
+        if capacity:
+            total = sum(self.loads.get(node_id, 0) for node_id in usable)
+            mean = total / capacity
+            for node_id in usable:
+                node = self.nodes[node_id]
+                load = self.loads.get(node_id, 0)
+                if load / node['capacity'] > mean + REBALANCE_TOLERANCE:
+                    excess[node_id] = load - math.ceil(node['capacity'] * mean)
+        return {node_id: count for node_id, count in excess.items() if count > 0}
+
+    async def rebalance(self, max_moves: int = REBALANCE_MAX_MOVES):
+        """
+        Переносит пользователей с выводимых и перегруженных узлов.
+        Возвращает список перенесенных пользователей [(user_id, source, target)].
+        """
+        await self.refresh_loads()
+        moved = []
+        for source, count in self._excess().items():
+            for user_id, user_uuid in await get_node_users(source, min(count, max_moves - len(moved))):
+                target = self.choose(exclude=(source,))
+                if target is None:
+                    logger.warning("Rebalance: нет узлов со свободным местом")
+                    return moved
+                if not user_uuid:
+                    await assign_user_node(user_id, target)
+                    self.loads[target] = self.loads.get(target, 0) + 1
+                    self.release(source)
+                else:
+                    await self.move_user(user_id, user_uuid, source, target)
+                moved.append((user_id, source, target))
+            if len(moved) >= max_moves:
+                break
+        if moved:
+            logger.info(f"Rebalance: перенесено пользователей: {len(moved)}")
+        return moved
+
+    async def _close_node(self, node_id: str):
+        mutator = self._mutators.pop(node_id, None)
+        if mutator is not None:
+            await mutator.close()
+        client = self._api_clients.pop(node_id, None)
+        if client is not None:
+            await client.close()
+
+    async def close(self):
+        for node_id in list(set(self._mutators) | set(self._api_clients)):
+            await self._close_node(node_id)
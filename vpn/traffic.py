@@ -0,0 +1,126 @@
+"""
+Учет трафика пользователей через StatsService V2Ray.
+
+Раз в TRAFFIC_INTERVAL секунд с каждого узла одним запросом QueryStats (с
+обнулением) забирается прирост счетчиков всех пользователей, и он записывается
+одной транзакцией в минутную таблицу. Старые записи периодически прореживаются
+в часовые и дневные (db.database.rollup_traffic).
+"""
+import asyncio
+import logging
+import os
+import time
+from db.async_database import record_traffic, rollup_traffic
+from vpn.client_registry import user_id_from_email
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_INTERVAL = float(os.getenv("TRAFFIC_INTERVAL", "60"))
+TRAFFIC_ROLLUP_INTERVAL = float(os.getenv("TRAFFIC_ROLLUP_INTERVAL", "600"))
+# Сроки хранения по уровням детализации (часы для минут и часов, дни для дней)
+TRAFFIC_MINUTE_RETENTION_HOURS = float(os.getenv("TRAFFIC_MINUTE_RETENTION_HOURS", "2"))
+TRAFFIC_HOUR_RETENTION_HOURS = float(os.getenv("TRAFFIC_HOUR_RETENTION_HOURS", "48"))
+TRAFFIC_DAY_RETENTION_DAYS = float(os.getenv("TRAFFIC_DAY_RETENTION_DAYS", "400"))
+
+
+def format_bytes(value: int) -> str:
+    """
+    Размер в читаемом виде: 1.5 ГБ, 320.0 МБ
+    """
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if value < 1024:
+            return f"{value:.1f} {unit}" if unit != "Б" else f"{value} {unit}"
+        value /= 1024
+    return f"{value:.1f} ТБ"
+
+
+class TrafficCollector:
+    """
+    Периодический сбор трафика со всех узлов пула
+    """
+
+    def __init__(self, pool, interval: float = TRAFFIC_INTERVAL,
+                 rollup_interval: float = TRAFFIC_ROLLUP_INTERVAL):
+        self.pool = pool
+        self.interval = interval
+        self.rollup_interval = rollup_interval
+        # Прирост, который не удалось записать: {user_id: [uplink, downlink]}.
+        # Счетчики на сервере уже обнулены, поэтому он добавляется к следующей записи.
+        self._pending = {}
+        self._task = None
+        self._last_rollup = time.monotonic()
+        self.cycles = 0
+        self.rows_written = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _query_node(self, node_id: str) -> dict:
+        client = self.pool.api_client(node_id)
+        if client is None:
+            return {}
+        try:
+            return await client.query_user_traffic(reset=True)
+        except Exception as e:
+            logger.warning(f"Узел {node_id}: не удалось получить статистику трафика: {e}")
+            return {}
+
+    async def collect_once(self, now: float = None) -> int:
+        """
+        Один цикл сбора: по одному запросу на узел и одна транзакция записи.
+        Возвращает количество записанных строк.
+        """
+        now = time.time() if now is None else now
+        node_ids = [node_id for node_id, node in self.pool.nodes.items() if node['status'] != "disabled"]
+        results = await asyncio.gather(*(self._query_node(node_id) for node_id in node_ids))
+
+        for traffic in results:
+            for email, (uplink, downlink) in traffic.items():
+                user_id = user_id_from_email(email)
+                if user_id is None or not (uplink or downlink):
+                    continue
+                totals = self._pending.setdefault(user_id, [0, 0])
+                totals[0] += uplink
+                totals[1] += downlink
+
+        if not self._pending:
+            return 0
+        minute = int(now // 60 * 60)
+        rows = [(user_id, minute, up, down) for user_id, (up, down) in self._pending.items()]
+        await record_traffic(rows)
+        self._pending = {}
+        self.rows_written += len(rows)
+        return len(rows)
+
+    async def rollup(self, now: float = None):
+        now = time.time() if now is None else now
+        result = await rollup_traffic(
+            now,
+            TRAFFIC_MINUTE_RETENTION_HOURS * 3600,
+            TRAFFIC_HOUR_RETENTION_HOURS * 3600,
+            TRAFFIC_DAY_RETENTION_DAYS * 86400
+        )
+        logger.debug(f"Трафик: прорежено записей {result}")
+        return result
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.collect_once()
+                self.cycles += 1
+                if time.monotonic() - self._last_rollup >= self.rollup_interval:
+                    self._last_rollup = time.monotonic()
+                    await self.rollup()
+            except Exception as e:
+                logger.error(f"Ошибка при сборе статистики трафика: {e}", exc_info=True)
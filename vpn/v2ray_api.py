@@ -0,0 +1,276 @@
+"""
+Клиент gRPC API V2Ray/Xray для изменения списка клиентов без перезапуска сервиса.
+
+Используется HandlerService.AlterInbound (AddUserOperation / RemoveUserOperation),
+а для учета трафика - StatsService.QueryStats.
+Сообщения protobuf кодируются вручную: нужны всего несколько простых сообщений,
+поэтому генерировать стабы из .proto файлов V2Ray не требуется.
+"""
+import os
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+V2RAY_API_ADDRESS = os.getenv("V2RAY_API_ADDRESS", "127.0.0.1:10085")
+V2RAY_API_FLAVOR = os.getenv("V2RAY_API_FLAVOR", "xray").lower()  # xray или v2ray
+V2RAY_API_TIMEOUT = float(os.getenv("V2RAY_API_TIMEOUT", "5"))
+V2RAY_INBOUND_TAG = os.getenv("V2RAY_INBOUND_TAG", "vless-in")
+V2RAY_API_MAX_MESSAGE = int(os.getenv("V2RAY_API_MAX_MESSAGE", str(64 * 1024 * 1024)))
+
+# Префиксы пакетов protobuf отличаются у Xray и V2Fly
+_PACKAGE_PREFIXES = {
+    "xray": "xray",
+    "v2ray": "v2ray.core",
+}
+
+
+class V2RayApiError(Exception):
+    """Ошибка при обращении к API V2Ray"""
+
+
+# --- Минимальная реализация формата protobuf ---
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    value &= (1 << 64) - 1
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field_varint(number: int, value: int) -> bytes:
+    if not value:
+        return b""
+    return _encode_varint(number << 3) + _encode_varint(value)
+
+
+def _field_bytes(number: int, value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode()
+    if not value:
+        return b""
+    return _encode_varint((number << 3) | 2) + _encode_varint(len(value)) + value
+
+
+def _decode_varint(data: bytes, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def decode_message(data: bytes) -> dict:
+    """
+    Разбирает сообщение protobuf в словарь {номер поля: [значения]}.
+    Вложенные сообщения возвращаются как bytes и разбираются повторным вызовом.
+    """
+    fields = {}
+    pos = 0
+    length = len(data)
+    while pos < length:
+        key, pos = _decode_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = _decode_varint(data, pos)
+        elif wire_type == 2:
+            size, pos = _decode_varint(data, pos)
+            value = data[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise V2RayApiError(f"Неподдерживаемый тип поля protobuf: {wire_type}")
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def _typed_message(type_name: str, value: bytes) -> bytes:
+    return _field_bytes(1, type_name) + _field_bytes(2, value)
+
+
+def type_name(name: str, flavor: str = None) -> str:
+    """Полное имя типа protobuf с учетом варианта сервера (Xray/V2Fly)"""
+    prefix = _PACKAGE_PREFIXES.get(flavor or V2RAY_API_FLAVOR, "xray")
+    return f"{prefix}.{name}"
+
+
+def encode_add_user(tag: str, uuid: str, email: str, flow: str = "", level: int = 0,
+                    flavor: str = None) -> bytes:
+    """AlterInboundRequest с AddUserOperation для клиента VLESS"""
+    account = _field_bytes(1, uuid) + _field_bytes(2, flow) + _field_bytes(3, "none")
+    user = (
+        _field_varint(1, level)
+        + _field_bytes(2, email)
+        + _field_bytes(3, _typed_message(type_name("proxy.vless.Account", flavor), account))
+    )
+    operation = _field_bytes(1, user)
+    return _field_bytes(1, tag) + _field_bytes(
+        2, _typed_message(type_name("app.proxyman.command.AddUserOperation", flavor), operation)
+    )
+
+
+def encode_query_stats(pattern: str, reset: bool = False) -> bytes:
+    """QueryStatsRequest: счетчики, имя которых содержит pattern"""
+    return _field_bytes(1, pattern) + _field_varint(2, 1 if reset else 0)
+
+
+def encode_query_stats_response(stats: dict) -> bytes:
+    """QueryStatsResponse из словаря {имя счетчика: значение}"""
+    return b"".join(
+        _field_bytes(1, _field_bytes(1, name) + _field_varint(2, value))
+        for name, value in stats.items()
+    )
+
+
+def decode_query_stats_response(data: bytes) -> dict:
+    """Разбирает QueryStatsResponse в словарь {имя счетчика: значение}"""
+    stats = {}
+    for stat in decode_message(data).get(1, []):
+        fields = decode_message(stat)
+        name = fields.get(1, [b""])[0].decode()
+        stats[name] = fields.get(2, [0])[0]
+    return stats
+
+
+def parse_user_traffic(stats: dict) -> dict:
+    """
+    Трафик пользователей из счетчиков вида user>>>email>>>traffic>>>uplink:
+    {email: (uplink, downlink)}
+    """
+    traffic = {}
+    for name, value in stats.items():
+        parts = name.split(">>>")
+        if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic":
+            continue
+        uplink, downlink = traffic.get(parts[1], (0, 0))
+        if parts[3] == "uplink":
+            uplink += value
+        elif parts[3] == "downlink":
+            downlink += value
+        traffic[parts[1]] = (uplink, downlink)
+    return traffic
+
+
+def encode_remove_user(tag: str, email: str, flavor: str = None) -> bytes:
+    """AlterInboundRequest с RemoveUserOperation"""
+    operation = _field_bytes(1, email)
+    return _field_bytes(1, tag) + _field_bytes(
+        2, _typed_message(type_name("app.proxyman.command.RemoveUserOperation", flavor), operation)
+    )
+
+
+class V2RayApiClient:
+    """
+    Асинхронный клиент HandlerService поверх одного долгоживущего gRPC-канала
+    """
+
+    def __init__(self, address: str = None, inbound_tag: str = None, flavor: str = None,
+                 timeout: float = None):
+        self.address = address or V2RAY_API_ADDRESS
+        self.inbound_tag = inbound_tag or V2RAY_INBOUND_TAG
+        self.flavor = flavor or V2RAY_API_FLAVOR
+        self.timeout = timeout or V2RAY_API_TIMEOUT
+        self._channel = None
+        self._alter_inbound = None
+        self._query_stats = None
+
+    def _service_method(self, service: str, method: str) -> str:
+        return f"/{type_name('app.' + service, self.flavor)}/{method}"
+
+    def _ensure_channel(self):
+        if self._channel is None:
+            import grpc
+            # Ответ QueryStats для десятков тысяч пользователей больше стандартных 4 МБ
+            self._channel = grpc.aio.insecure_channel(
+                self.address, options=[("grpc.max_receive_message_length", V2RAY_API_MAX_MESSAGE)]
+            )
+            # Сериализаторы не заданы: запросы и ответы передаются как bytes
+            self._alter_inbound = self._channel.unary_unary(
+                self._service_method("proxyman.command.HandlerService", "AlterInbound")
+            )
+            self._query_stats = self._channel.unary_unary(
+                self._service_method("stats.command.StatsService", "QueryStats")
+            )
+        return self._channel
+
+    async def _call_alter_inbound(self, request: bytes, ignore: str):
+        """
+        Выполняет AlterInbound. ignore - точный текст ошибки уровня пользователя
+        ("User <email> not found." и т.п.), которая означает, что операция уже
+        применена; остальные ошибки (например, "handler not found") пробрасываются.
+        """
+        import grpc
+        self._ensure_channel()
+        try:
+            await self._alter_inbound(request, timeout=self.timeout)
+        except grpc.aio.AioRpcError as e:
+            details = (e.details() or "").lower()
+            if e.code() == grpc.StatusCode.UNKNOWN and ignore.lower() in details:
+                # Операция уже применена (например, пользователь был добавлен ранее)
+                logger.debug(f"V2Ray API: {e.details()}")
+                return
+            raise V2RayApiError(f"AlterInbound завершился ошибкой {e.code()}: {e.details()}") from e
+
+    async def add_user(self, uuid: str, email: str, flow: str = "", level: int = 0):
+        """
+        Добавляет клиента VLESS во входящее соединение без перезапуска V2Ray
+        """
+        request = encode_add_user(self.inbound_tag, uuid, email, flow, level, self.flavor)
+        await self._call_alter_inbound(request, ignore=f"user {email} already exists")
+
+    async def remove_user(self, email: str):
+        """
+        Удаляет клиента из входящего соединения без перезапуска V2Ray
+        """
+        request = encode_remove_user(self.inbound_tag, email, self.flavor)
+        await self._call_alter_inbound(request, ignore=f"user {email} not found")
+
+    async def query_stats(self, pattern: str = "", reset: bool = False) -> dict:
+        """
+        Счетчики StatsService одним запросом: {имя: значение}.
+        При reset=True счетчики обнуляются, то есть возвращается прирост с прошлого запроса.
+        """
+        import grpc
+        self._ensure_channel()
+        try:
+            response = await self._query_stats(encode_query_stats(pattern, reset), timeout=self.timeout)
+        except grpc.aio.AioRpcError as e:
+            raise V2RayApiError(f"QueryStats завершился ошибкой {e.code()}: {e.details()}") from e
+        return decode_query_stats_response(response)
+
+    async def query_user_traffic(self, reset: bool = True) -> dict:
+        """
+        Трафик всех пользователей одним запросом: {email: (uplink, downlink)}
+        """
+        return parse_user_traffic(await self.query_stats("user>>>", reset))
+
+    async def ping(self):
+        """
+        Проверяет доступность API: удаление несуществующего клиента
+        завершается ответом "not found" у работающего сервера
+        """
+        await self.remove_user("healthcheck@localhost")
+
+    async def close(self):
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+            self._alter_inbound = None
+            self._query_stats = None
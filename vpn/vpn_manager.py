@@ -5,6 +5,16 @@ import asyncio
 import logging
 from datetime import datetime
 from db.database import get_user
+from db.async_database import (
+    get_user as get_user_async, save_user_v2ray_id, get_users_with_v2ray_id, get_all_users,
+    save_users_v2ray_ids, assign_users_nodes, get_suspensions
+)
+from vpn.artifacts import get_artifact, evict_uuid
+from vpn.client_registry import client_email, make_client
+from vpn.config_mutator import ConfigMutator, check_layout
+from vpn.nodes import NodePool, NODE_CAPACITY
+from vpn.traffic import TrafficCollector
+from vpn.v2ray_api import V2RayApiClient, V2RAY_API_ADDRESS, V2RAY_INBOUND_TAG
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,8 +22,13 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 VPN_SERVER_IP = os.getenv("VPN_SERVER_IP", "127.0.0.1")
+VPN_SERVER_PORT = int(os.getenv("VPN_SERVER_PORT", "443"))
 V2RAY_CONFIG_PATH = os.getenv("V2RAY_CONFIG_PATH", "/etc/v2ray/config.json")
+# Идентификатор основного (локального) узла в таблице nodes
+V2RAY_NODE_ID = os.getenv("V2RAY_NODE_ID", "main")
 MOCK_MODE = os.getenv("MOCK_V2RAY", "false").lower() == "true"  # Режим тестирования
+# Изменение списка клиентов через gRPC API без перезапуска (при ошибке - перезапуск сервиса)
+USE_V2RAY_API = os.getenv("V2RAY_USE_API", "true").lower() == "true"
 
 # Шаблон конфигурации для v2ray
 V2RAY_CONFIG_TEMPLATE = {
@@ -22,8 +37,23 @@ V2RAY_CONFIG_TEMPLATE = {
         "error": "/var/log/v2ray/error.log",
         "loglevel": "info"
     },
+    "api": {
+        "tag": "api",
+        "services": ["HandlerService", "StatsService"]
+    },
+    # Счетчики трафика по пользователям (email) для учета через StatsService
+    "stats": {},
+    "policy": {
+        "levels": {
+            "0": {
+                "statsUserUplink": True,
+                "statsUserDownlink": True
+            }
+        }
+    },
     "inbounds": [
         {
+            "tag": V2RAY_INBOUND_TAG,
             "port": 443,
             "protocol": "vless",
             "settings": {
@@ -41,6 +71,15 @@ V2RAY_CONFIG_TEMPLATE = {
                     ]
                 }
             }
+        },
+        {
+            "tag": "api",
+            "listen": V2RAY_API_ADDRESS.rsplit(":", 1)[0],
+            "port": int(V2RAY_API_ADDRESS.rsplit(":", 1)[1]),
+            "protocol": "dokodemo-door",
+            "settings": {
+                "address": "127.0.0.1"
+            }
         }
     ],
     "outbounds": [
@@ -48,17 +87,123 @@ V2RAY_CONFIG_TEMPLATE = {
             "protocol": "freedom",
             "settings": {}
         }
-    ]
+    ],
+    "routing": {
+        "rules": [
+            {
+                "type": "field",
+                "inboundTag": ["api"],
+                "outboundTag": "api"
+            }
+        ]
+    }
 }
 
+_node_pool = None
+_traffic_collector = None
+
+def get_node_pool() -> NodePool:
+    """
+    Возвращает общий пул узлов V2Ray. Узел по умолчанию описывается переменными
+    VPN_SERVER_IP, VPN_SERVER_PORT, V2RAY_API_ADDRESS и V2RAY_CONFIG_PATH.
+    """
+    global _node_pool
+    if _node_pool is None:
+        _node_pool = NodePool(
+            {
+                'node_id': V2RAY_NODE_ID,
+                'address': VPN_SERVER_IP,
+                'port': VPN_SERVER_PORT,
+                'api_address': V2RAY_API_ADDRESS,
+                'config_path': V2RAY_CONFIG_PATH,
+                'capacity': NODE_CAPACITY,
+                'status': "active",
+                'created_at': None
+            },
+            use_api=USE_V2RAY_API,
+            restart=restart_v2ray
+        )
+    return _node_pool
+
+def set_mutation_fence(fence):
+    """
+    Разрешает изменения конфигурации V2Ray только при fence() == True
+    (проверка fencing token ведущего процесса, bot/leader.py)
+    """
+    get_node_pool().set_fence(fence)
+
+def get_traffic_collector():
+    """
+    Возвращает сборщик статистики трафика (None в режиме MOCK или без gRPC API)
+    """
+    global _traffic_collector
+    if MOCK_MODE or not USE_V2RAY_API:
+        return None
+    if _traffic_collector is None:
+        _traffic_collector = TrafficCollector(get_node_pool())
+    return _traffic_collector
+
+def get_api_client(node_id: str = None) -> V2RayApiClient:
+    """
+    Возвращает клиент gRPC API узла V2Ray (по умолчанию - основного)
+    """
+    return get_node_pool().api_client(node_id)
+
+def _client_email(user_id: int) -> str:
+    return client_email(user_id)
+
+async def _systemctl(action: str):
+    process = await asyncio.create_subprocess_exec(
+        "systemctl", action, "v2ray",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, f"systemctl {action} v2ray", stderr=stderr.decode(errors="replace")
+        )
+
+async def restart_v2ray():
+    """
+    Перезапускает сервис v2ray, не блокируя цикл событий
+    """
+    await _systemctl("restart")
+
+async def ensure_v2ray_running():
+    """
+    Запускает сервис v2ray, если он остановлен. Работающий сервис не перезапускается,
+    поэтому смена ведущего процесса не разрывает VPN-соединения.
+    """
+    await _systemctl("start")
+
+def get_config_mutator(node_id: str = None) -> ConfigMutator:
+    """
+    Возвращает обработчик изменений конфигурации узла V2Ray (по умолчанию - основного)
+    """
+    return get_node_pool().mutator(node_id)
+
+def user_endpoint(user: dict):
+    """
+    Адрес и порт узла, на котором размещен пользователь
+    """
+    node = get_node_pool().node(user.get('node_id'))
+    return node['address'], node['port']
+
 async def initialize_v2ray_server():
     """
     Инициализирует v2ray сервер с начальной конфигурацией
     """
+    # Узлы и их загрузка нужны для размещения пользователей и в режиме MOCK
+    await get_node_pool().load()
+    
     if MOCK_MODE:
         logger.info("V2Ray: режим тестирования (MOCK), инициализация пропущена")
         return
     
+    # Фрагменты поддерживает только v2fly: с Xray запуск прерывается
+    check_layout()
+    
     try:
         # Создаем директорию для конфигов, если не существует
         config_dir = os.path.dirname(V2RAY_CONFIG_PATH)
@@ -71,16 +216,18 @@ async def initialize_v2ray_server():
             with open(V2RAY_CONFIG_PATH, 'w') as f:
                 json.dump(V2RAY_CONFIG_TEMPLATE, f, indent=2)
             logger.info(f"Создана базовая конфигурация V2Ray: {V2RAY_CONFIG_PATH}")
-        
-        # Перезапускаем v2ray сервис
-        result = subprocess.run(
-            ["systemctl", "restart", "v2ray"], 
-            check=True,
-            capture_output=True,
-            text=True
-        )
+            # Новую конфигурацию сервис прочитает только после перезапуска
+            await restart_v2ray()
+        else:
+            # Изменения клиентов уже применены к работающему сервису через API или
+            # перезапуском, поэтому при смене ведущего сервис только запускается, если остановлен
+            await ensure_v2ray_running()
         logger.info("V2Ray сервер успешно инициализирован")
         
+        # Проверяем доступность узлов, загружаем реестры клиентов и сверяем их с базой данных
+        await get_node_pool().check_health()
+        await check_client_drift()
+        
     except PermissionError as e:
         logger.error(f"Нет прав для записи в {V2RAY_CONFIG_PATH}. Запустите с sudo или измените права: {e}")
     except subprocess.CalledProcessError as e:
@@ -88,186 +235,257 @@ async def initialize_v2ray_server():
     except Exception as e:
         logger.error(f"Неожиданная ошибка при инициализации V2Ray: {e}", exc_info=True)
 
+async def check_client_drift() -> dict:
+    """
+    Сверяет реестры клиентов узлов с их файлами конфигурации и столбцом users.v2ray_id.
+    Расхождения записываются в лог; возвращается {node_id: отчет ConfigMutator.check_drift}.
+    """
+    pool = get_node_pool()
+    users = await get_users_with_v2ray_id()
+    # Временно заблокированные пользователи (vpn/access_log.py) не должны иметь клиента
+    suspended = {row[0] for row in await get_suspensions()}
+    users = [(user_id, v2ray_id, None if user_id in suspended else end_date, node_id)
+             for user_id, v2ray_id, end_date, node_id in users]
+    
+    reports = {}
+    for node_id in pool.nodes:
+        mutator = pool.mutator(node_id)
+        node_users = [
+            (user_id, v2ray_id, end_date) for user_id, v2ray_id, end_date, user_node in users
+            if (user_node or pool.default_node_id) == node_id
+        ]
+        try:
+            report = await mutator.check_drift(node_users)
+        except Exception as e:
+            logger.error(f"Узел {node_id}: не удалось выполнить сверку: {e}")
+            continue
+        reports[node_id] = report
+        
+        file_drift, users_drift = report['file'], report['users']
+        if any(file_drift.values()):
+            logger.warning(
+                f"Узел {node_id}: реестр расходится с файлом конфигурации: нет в файле {len(file_drift['missing'])}, "
+                f"лишних в файле {len(file_drift['extra'])}, другой UUID {len(file_drift['uuid_mismatch'])}"
+            )
+        if any(users_drift.values()):
+            logger.warning(
+                f"Узел {node_id}: реестр расходится с базой данных: активных без клиента {len(users_drift['missing'])}, "
+                f"другой UUID {len(users_drift['uuid_mismatch'])}, клиентов без подписки {len(users_drift['orphaned'])}"
+            )
+        logger.info(f"Узел {node_id}: в реестре {len(mutator.registry)} клиентов")
+    return reports
+
+async def reconcile_clients(dry_run: bool = False) -> dict:
+    """
+    Приводит клиентов V2Ray в соответствие с базой данных за один проход:
+    активным пользователям без UUID выдается UUID, без узла - назначается узел,
+    затем на каждом узле все недостающие, лишние и устаревшие клиенты
+    исправляются одним пакетом (одна запись конфигурации и одна перезагрузка).
+    При dry_run изменения только подсчитываются.
+    Возвращает {'uuids': N, 'placed': N, 'nodes': {node_id: отчет}}.
+    """
+    import uuid
+    
+    pool = get_node_pool()
+    await pool.load()
+    now = datetime.now()
+    users = []
+    new_uuids, placements = [], []
+    unplaced = 0
+    suspended = {row[0] for row in await get_suspensions()}
+    for user_id, v2ray_id, end_date, node_id in await get_all_users():
+        if user_id in suspended:
+            # Временная блокировка за превышение числа устройств: клиент удаляется
+            end_date = None
+        if end_date and datetime.fromisoformat(end_date) > now:
+            if not v2ray_id:
+                v2ray_id = str(uuid.uuid4())
+                new_uuids.append((user_id, v2ray_id))
+            if node_id not in pool.nodes:
+                target = pool.choose()
+                if target is None:
+                    # Нет свободного места: пользователь остается на узле по умолчанию
+                    unplaced += 1
+                    node_id = None
+                else:
+                    node_id = target
+                    pool.loads[node_id] = pool.loads.get(node_id, 0) + 1
+                    placements.append((user_id, node_id))
+        users.append((user_id, v2ray_id, end_date, node_id))
+    if unplaced:
+        logger.warning(f"Сверка: нет свободных узлов для {unplaced} пользователей, они остаются на узле по умолчанию")
+    
+    report = {'uuids': len(new_uuids), 'placed': len(placements), 'nodes': {}}
+    if not dry_run:
+        if new_uuids:
+            await save_users_v2ray_ids(new_uuids)
+        if placements:
+            await assign_users_nodes(placements)
+    if MOCK_MODE:
+        await pool.refresh_loads()
+        return report
+    
+    for node_id in pool.nodes:
+        mutator = pool.mutator(node_id)
+        try:
+            registry = await mutator.load()
+        except Exception as e:
+            logger.error(f"Сверка: не удалось загрузить конфигурацию узла {node_id}: {e}")
+            report['nodes'][node_id] = {'error': str(e)}
+            continue
+        node_users = [
+            (user_id, v2ray_id, end_date) for user_id, v2ray_id, end_date, user_node in users
+            if (user_node or pool.default_node_id) == node_id
+        ]
+        uuids = {user_id: v2ray_id for user_id, v2ray_id, _ in node_users}
+        drift = registry.diff_users(node_users, now)
+        node_report = {key: len(value) for key, value in drift.items()}
+        
+        removes = [client_email(user_id) for user_id in drift['orphaned'] + drift['uuid_mismatch']]
+        adds = [make_client(user_id, uuids[user_id]) for user_id in drift['missing'] + drift['uuid_mismatch']]
+        if not dry_run and (adds or removes):
+            try:
+                node_report.update(await mutator.apply_bulk(adds, removes))
+            except Exception as e:
+                logger.error(f"Сверка: не удалось применить изменения на узле {node_id}: {e}")
+                node_report['error'] = str(e)
+        report['nodes'][node_id] = node_report
+    await pool.refresh_loads()
+    return report
+
+async def maintain_nodes():
+    """
+    Обслуживание пула узлов: перечитывает список узлов, проверяет их доступность,
+    восстанавливает клиентов на перезапущенных удаленных узлах и переносит
+    пользователей с выводимых и перегруженных узлов.
+    Возвращает ID перенесенных пользователей (им нужна новая конфигурация).
+    """
+    pool = get_node_pool()
+    await pool.load()
+    if MOCK_MODE:
+        recovered = []
+    else:
+        recovered = await pool.check_health()
+    for node_id in recovered:
+        if not pool.node(node_id)['config_path']:
+            await pool.sync_node(node_id)
+    
+    moved = []
+    for user_id, source, target in await pool.rebalance():
+        old = pool.node(source)
+        user = await get_user_async(user_id)
+        if user and user['v2ray_id']:
+            evict_uuid(user['v2ray_id'], old['address'], old['port'])
+        moved.append(user_id)
+    return moved
+
+def _evict_previous_uuid(previous_uuid, user_uuid: str, node_id: str = None):
+    """
+    При смене UUID прежние файлы подключения больше недействительны
+    """
+    if previous_uuid and previous_uuid != user_uuid:
+        node = get_node_pool().node(node_id)
+        evict_uuid(previous_uuid, node['address'], node['port'])
+
+async def _user_node(user_id: int):
+    """
+    Узел пользователя: прежний, если он доступен, иначе наименее загруженный
+    """
+    pool = get_node_pool()
+    user = await get_user_async(user_id)
+    node_id = user.get('node_id') if user else None
+    if node_id and pool.usable(node_id):
+        return node_id
+    return await pool.place(user_id)
+
 async def create_v2ray_user(user_id: int):
     """
-    Добавляет нового пользователя в конфигурацию v2ray
+    Добавляет нового пользователя в конфигурацию узла v2ray.
+    При ошибке выбрасывает исключение (задача выдачи доступа будет повторена).
     """
+    import uuid
+    
+    node_id = await _user_node(user_id)
+    if node_id is None:
+        raise RuntimeError(f"Нет доступных узлов V2Ray для пользователя {user_id}")
+    
     if MOCK_MODE:
-        import uuid
         user_uuid = str(uuid.uuid4())
-        from db.database import save_user_v2ray_id
-        save_user_v2ray_id(user_id, user_uuid)
-        logger.info(f"V2Ray (MOCK): пользователь {user_id} создан с UUID {user_uuid}")
+        _evict_previous_uuid(await save_user_v2ray_id(user_id, user_uuid), user_uuid, node_id)
+        logger.info(f"V2Ray (MOCK): пользователь {user_id} создан на узле {node_id} с UUID {user_uuid}")
         return
     
     try:
         # Генерируем UUID для пользователя
-        import uuid
         user_uuid = str(uuid.uuid4())
         
-        # Читаем текущую конфигурацию
-        if not os.path.exists(V2RAY_CONFIG_PATH):
-            logger.error(f"Конфигурация V2Ray не найдена: {V2RAY_CONFIG_PATH}")
-            return
-            
-        with open(V2RAY_CONFIG_PATH, 'r') as f:
-            config = json.load(f)
-        
-        # Добавляем нового клиента
-        new_client = {
-            "id": user_uuid,
-            "flow": "xtls-rprx-vision",
-            "level": 0,
-            "email": f"user_{user_id}@vpn.example.com"
-        }
-        
-        # Проверяем, что пользователь не существует
-        existing_clients = config['inbounds'][0]['settings']['clients']
-        client_exists = any(client.get('email') == new_client['email'] for client in existing_clients)
+        config_path = get_node_pool().node(node_id)['config_path']
+        if config_path and not os.path.exists(config_path):
+            raise FileNotFoundError(f"Конфигурация V2Ray не найдена: {config_path}")
         
-        if not client_exists:
-            existing_clients.append(new_client)
-        
-        # Сохраняем конфигурацию
-        with open(V2RAY_CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=2)
+        # Добавляем нового клиента; если клиент уже есть, остается прежний UUID,
+        # чтобы конфигурация и база данных не расходились
+        client = await get_config_mutator(node_id).add_client(make_client(user_id, user_uuid))
         
         # Сохраняем UUID пользователя в базе данных
-        from db.database import save_user_v2ray_id
-        save_user_v2ray_id(user_id, user_uuid)
-        
-        # Перезапускаем v2ray
-        subprocess.run(["systemctl", "restart", "v2ray"], check=True, capture_output=True)
-        logger.info(f"Пользователь {user_id} успешно добавлен в V2Ray")
+        _evict_previous_uuid(await save_user_v2ray_id(user_id, client['id']), client['id'], node_id)
+        logger.info(f"Пользователь {user_id} успешно добавлен в V2Ray (узел {node_id})")
         
     except Exception as e:
         logger.error(f"Ошибка при создании пользователя {user_id} в V2Ray: {e}", exc_info=True)
+        raise
 
 async def remove_v2ray_user(user_id: int):
     """
-    Удаляет пользователя из конфигурации v2ray
+    Удаляет пользователя из конфигурации его узла v2ray
     """
+    pool = get_node_pool()
+    user = await get_user_async(user_id)
+    node_id = (user.get('node_id') if user else None) or pool.default_node_id
+    pool.release(node_id)
+    
     if MOCK_MODE:
-        logger.info(f"V2Ray (MOCK): пользователь {user_id} удален")
+        logger.info(f"V2Ray (MOCK): пользователь {user_id} удален с узла {node_id}")
         return
     
     try:
-        # Получаем UUID пользователя из базы
-        from db.database import get_user_v2ray_id
-        user_uuid = get_user_v2ray_id(user_id)
-        
-        if not user_uuid:
-            logger.warning(f"UUID для пользователя {user_id} не найден")
+        removed = await get_config_mutator(node_id).remove_client(_client_email(user_id))
+        if not removed:
+            logger.warning(f"Пользователь {user_id} не найден в конфигурации узла {node_id}")
             return
-        
-        # Читаем текущую конфигурацию
-        with open(V2RAY_CONFIG_PATH, 'r') as f:
-            config = json.load(f)
-        
-        # Удаляем клиента
-        clients = config['inbounds'][0]['settings']['clients']
-        updated_clients = [client for client in clients if client['id'] != user_uuid]
-        config['inbounds'][0]['settings']['clients'] = updated_clients
-        
-        # Сохраняем конфигурацию
-        with open(V2RAY_CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=2)
-        
-        # Перезапускаем v2ray
-        subprocess.run(["systemctl", "restart", "v2ray"], check=True, capture_output=True)
-        logger.info(f"Пользователь {user_id} удален из V2Ray")
+        logger.info(f"Пользователь {user_id} удален из V2Ray (узел {node_id})")
         
     except Exception as e:
         logger.error(f"Ошибка при удалении пользователя {user_id}: {e}", exc_info=True)
 
+def _user_for_artifact(user_id: int) -> dict:
+    user = get_user(user_id)
+    if not user:
+        raise ValueError(f"Пользователь {user_id} не найден")
+    if not user['v2ray_id']:
+        raise ValueError(f"UUID для пользователя {user_id} не найден")
+    return user
+
 def generate_v2ray_config(user_id: int):
     """
-    Генерирует конфигурационный файл для конкретного пользователя
+    Возвращает конфигурационный файл пользователя (формируется в памяти и кэшируется).
+    Результат: {'key', 'kind', 'uuid', 'filename', 'data'}
     """
     try:
-        user = get_user(user_id)
-        if not user:
-            raise ValueError(f"Пользователь {user_id} не найден")
-        
-        # Получаем UUID пользователя из базы
-        from db.database import get_user_v2ray_id
-        user_uuid = get_user_v2ray_id(user_id)
-        
-        if not user_uuid:
-            raise ValueError(f"UUID для пользователя {user_id} не найден")
-        
-        # Создаем конфигурацию для клиента
-        client_config = {
-            "remarks": f"VPN Config for User {user_id}",
-            "v": "2",
-            "ps": f"VPN for User {user_id}",
-            "add": VPN_SERVER_IP,
-            "port": "443",
-            "id": user_uuid,
-            "aid": "0",
-            "net": "tcp",
-            "type": "none",
-            "host": "",
-            "path": "",
-            "tls": "tls"
-        }
-        
-        # Сохраняем конфигурацию в файл
-        config_dir = "configs"
-        os.makedirs(config_dir, exist_ok=True)
-        config_path = os.path.join(config_dir, f"user_{user_id}_config.json")
-        
-        with open(config_path, 'w') as f:
-            json.dump(client_config, f, indent=2)
-        
-        logger.info(f"Конфигурация для пользователя {user_id} создана: {config_path}")
-        
-        return {
-            "file_path": config_path,
-            "config": client_config
-        }
+        user = _user_for_artifact(user_id)
+        return get_artifact("config", user_id, user['v2ray_id'], *user_endpoint(user))
     except Exception as e:
         logger.error(f"Ошибка при генерации конфигурации для {user_id}: {e}", exc_info=True)
         raise
 
 def generate_v2ray_qr(user_id: int):
     """
-    Генерирует QR-код для подключения к VPN
+    Возвращает PNG с QR-кодом для подключения к VPN (формируется в памяти и кэшируется).
+    Результат: {'key', 'kind', 'uuid', 'filename', 'data'}
     """
     try:
-        import qrcode
-        from io import BytesIO
-        
-        user = get_user(user_id)
-        if not user:
-            raise ValueError(f"Пользователь {user_id} не найден")
-        
-        # Получаем UUID пользователя из базы
-        from db.database import get_user_v2ray_id
-        user_uuid = get_user_v2ray_id(user_id)
-        
-        if not user_uuid:
-            raise ValueError(f"UUID для пользователя {user_id} не найден")
-        
-        # Формируем vless URL
-        vless_url = f"vless://{user_uuid}@{VPN_SERVER_IP}:443?security=tls&type=tcp#VPN-User-{user_id}"
-        
-        # Создаем QR-код
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(vless_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill='black', back_color='white')
-        
-        # Сохраняем QR-код
-        qr_dir = "qrcodes"
-        os.makedirs(qr_dir, exist_ok=True)
-        qr_path = os.path.join(qr_dir, f"user_{user_id}_qr.png")
-        img.save(qr_path)
-        
-        logger.info(f"QR-код для пользователя {user_id} создан: {qr_path}")
-        
-        return qr_path
+        user = _user_for_artifact(user_id)
+        return get_artifact("qr", user_id, user['v2ray_id'], *user_endpoint(user))
     except Exception as e:
         logger.error(f"Ошибка при генерации QR-кода для {user_id}: {e}", exc_info=True)
         raise